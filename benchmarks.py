@@ -0,0 +1,1145 @@
+"""Benchmarks for the feature pipeline, run against synthetic KKBox-shaped data.
+
+Usage:
+    python benchmarks.py ulog --num-users 100000 --num-rows 5000000
+    python benchmarks.py ulog-scaling --workers 1 2 4 8
+    python benchmarks.py ulog-windows --num-users 100000 --num-rows 5000000
+    python benchmarks.py cache --num-users 1000000
+    python benchmarks.py stats --num-users 2000000 --num-rows 21000000
+    python benchmarks.py ingest --num-users 1000000 --num-rows 10000000
+    python benchmarks.py merge-csvs --num-rows 20000000
+    python benchmarks.py compile-parts --num-parts 300 --rows-per-part 5000
+    python benchmarks.py vw --num-users 1000000 --workers 4
+    python benchmarks.py one-hot --num-users 2000000
+    python benchmarks.py scoring --num-users 1000000 --clients 32
+    python benchmarks.py incremental --num-users 200000 --num-rows 5000000 --num-deltas 3
+    python benchmarks.py partitioned --num-users 2000000 --num-rows 20000000 --memory-limit-mb 512
+    python benchmarks.py suite --num-users 1000000 --num-ulog-rows 100000000
+
+`suite` runs the main pipeline stages end to end on a generated dataset and appends the timings
+to ./data/benchmarks/results.jsonl under the current git commit, then compares them with the
+last run of another commit at the same scale.
+"""
+import argparse
+import csv
+import datetime
+import glob
+import http.client
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+from cache import CACHE_BACKENDS, get_cache_backend
+from csv_tools import merge_csvs
+from features import ULOG_AGG_COLS, ULOG_WINDOWS, USER_CATEGORICAL
+from incremental import apply_delta
+from msno_dictionary import MSNO_ID, get_msno_dictionary
+from one_hot import SparseOneHotEncoder, build_sparse_feature_matrix
+from partitioned import build_partitioned_training_or_validation_df, read_partitioned_df
+from profiling import MIN_COMPARED_SECS, REGRESSION_THRESHOLD
+from scoring import (
+    MAX_BATCH_SIZE, MAX_BATCH_WAIT_SECS, ChurnModel, FeatureIndex, Scorer, make_scoring_server,
+)
+from schemas import LABELS_SCHEMA, MEMBERS_SCHEMA, TRANSACTIONS_SCHEMA, read_csv_with_schema
+from synthetic_data import (
+    make_msnos, make_synthetic_members_df, make_synthetic_training_df,
+    make_synthetic_transactions_df, write_synthetic_kkbox_dataset, write_synthetic_labels,
+    write_synthetic_training_inputs, write_synthetic_ulog_dataset, write_synthetic_user_logs,
+)
+from ulog_features import (
+    ULOG_FEATURES, aggregate_trailing_windows, build_ulog_features_df,
+    build_windowed_ulog_features_df, get_or_build_ulog_features_df, to_day_numbers,
+)
+from utils import (
+    STATISTICS_COLUMNS, TRAIN_ULOG_PATH, build_statistics_df, build_vw_json_obj_from_csv_dict,
+    compile_csv_parts_to_larger_csv, get_or_build_members_df, get_or_build_statistics_df,
+    get_or_build_training_or_validation_df, read_labels_df, write_vw_json_lines,
+)
+from vw_export import write_vw_examples
+
+BENCHMARK_DATA_PATH = './data/benchmarks'
+BENCHMARK_RESULTS_PATH = os.path.join(BENCHMARK_DATA_PATH, 'results.jsonl')
+SUITE_DATASET_MARKER = 'dataset.json'
+SUITE_ULOG_PARTS = 'train_ulog_features_parts'
+SUITE_VW_CSV = 'train_df_vw.csv'
+
+
+def timed(fn, *args, **kwargs):
+    start = time.time()
+    result = fn(*args, **kwargs)
+    return result, time.time() - start
+
+
+def assert_frames_close(expected_df, actual_df, rtol=1e-6):
+    """Check two msno-keyed feature frames hold the same users and (nearly) the same values."""
+    expected_df = expected_df.set_index('msno').sort_index()
+    actual_df = actual_df.set_index('msno').sort_index()
+    assert expected_df.index.equals(actual_df.index), "Frames hold different msnos"
+    for col in expected_df.columns:
+        np.testing.assert_allclose(
+            actual_df[col].values.astype(np.float64),
+            expected_df[col].values.astype(np.float64),
+            rtol=rtol,
+            err_msg=col,
+        )
+
+
+def build_ulog_features_df_with_spark(labels_csv_path, ulogs_csv_path):
+    """The aggregation as the Spark notebooks do it: one groupby per function, then joins.
+
+    Returns None if pyspark isn't installed.
+    """
+    try:
+        from pyspark.sql import SparkSession
+    except ImportError:
+        return None
+
+    spark = SparkSession.builder.appName("WSDM User Logs Benchmark").getOrCreate()
+    df_labels = spark.read.csv(labels_csv_path, inferSchema=True, header=True).select('msno')
+    df_userlogs = spark.read.csv(ulogs_csv_path, inferSchema=True, header=True)
+    df_labels_userlogs = df_userlogs.join(df_labels, 'msno', how='inner')
+
+    df_result = df_labels
+    for agg_name in ['avg', 'max', 'min', 'sum', 'stddev']:
+        df_agg = df_labels_userlogs.groupby('msno').agg(
+            dict((cname, agg_name) for cname in ULOG_AGG_COLS)
+        )
+        for cname in ULOG_AGG_COLS:
+            df_agg = df_agg.withColumnRenamed(
+                '{}({})'.format(agg_name, cname),
+                '{}_{}'.format(agg_name, cname),
+            )
+        df_result = df_result.join(df_agg, 'msno', how='inner')
+    return df_result.toPandas()[['msno'] + ULOG_FEATURES]
+
+
+def bench_ulog_aggregation(args):
+    data_dir = os.path.join(BENCHMARK_DATA_PATH, 'ulog')
+    labels_path, ulogs_path = write_synthetic_ulog_dataset(data_dir, args.num_users, args.num_rows)
+    ulogs_size_mb = os.path.getsize(ulogs_path) / 1024. / 1024.
+
+    streaming_df, streaming_secs = timed(build_ulog_features_df, labels_path, ulogs_path)
+    print("\nStreaming aggregator: {:.2f}s ({:.1f} MB/s, {} users)".format(
+        streaming_secs, ulogs_size_mb / streaming_secs, len(streaming_df),
+    ))
+
+    # Reference result straight from pandas, to check correctness on any box.
+    def build_with_pandas():
+        msnos = pd.read_csv(labels_path, usecols=['msno'])
+        ulogs = pd.merge(pd.read_csv(ulogs_path), msnos, how='inner', on='msno')
+        grouped = ulogs.groupby('msno')[ULOG_AGG_COLS]
+        pandas_df = pd.DataFrame(index=grouped.size().index)
+        for agg_name, pandas_fn in [('avg', 'mean'), ('max', 'max'), ('min', 'min'),
+                                    ('sum', 'sum'), ('stddev', 'std')]:
+            agg_df = grouped.agg(pandas_fn)
+            for cname in ULOG_AGG_COLS:
+                pandas_df['{}_{}'.format(agg_name, cname)] = agg_df[cname]
+        return pandas_df.reset_index()[['msno'] + ULOG_FEATURES]
+
+    pandas_df, pandas_secs = timed(build_with_pandas)
+    print("In-memory pandas groupby: {:.2f}s".format(pandas_secs))
+    assert_frames_close(pandas_df, streaming_df)
+    print("Streaming output matches pandas")
+
+    spark_df, spark_secs = timed(build_ulog_features_df_with_spark, labels_path, ulogs_path)
+    if spark_df is None:
+        print("pyspark is not installed, skipping the Spark comparison")
+        return
+    print("Spark notebook path: {:.2f}s ({:.1f}x slower than streaming)".format(
+        spark_secs, spark_secs / streaming_secs,
+    ))
+    assert_frames_close(spark_df, streaming_df)
+    print("Streaming output matches Spark")
+
+
+def bench_ulog_scaling(args):
+    data_dir = os.path.join(BENCHMARK_DATA_PATH, 'ulog')
+    labels_path, ulogs_path = write_synthetic_ulog_dataset(data_dir, args.num_users, args.num_rows)
+
+    results = []
+    baseline_df = None
+    for num_workers in args.workers:
+        ulog_df, secs = timed(
+            build_ulog_features_df, labels_path, ulogs_path, num_workers=num_workers,
+        )
+        if baseline_df is None:
+            baseline_df = ulog_df
+        else:
+            assert_frames_close(baseline_df, ulog_df)
+        results.append((num_workers, secs))
+
+    base_secs = results[0][1]
+    print("\n{:>8} {:>10} {:>8} {:>11}".format('workers', 'seconds', 'speedup', 'efficiency'))
+    for num_workers, secs in results:
+        speedup = base_secs / secs
+        print("{:>8} {:>10.2f} {:>7.2f}x {:>10.0%}".format(
+            num_workers, secs, speedup, speedup * results[0][0] / num_workers,
+        ))
+
+
+def build_windowed_ulog_features_with_groupbys(ulogs, windows):
+    """The windowed features the straightforward way: filter and group by msno once per window."""
+    days = to_day_numbers(ulogs.date.values)
+    end_day = days.max()
+    window_df = None
+    for window in windows:
+        grouped = ulogs[days > end_day - window].groupby('msno')[ULOG_AGG_COLS]
+        agg_df = pd.DataFrame({'num_days_{}d'.format(window): grouped.size()})
+        sums = grouped.sum()
+        means = grouped.mean()
+        for col in ULOG_AGG_COLS:
+            agg_df['sum_{}_{}d'.format(col, window)] = sums[col]
+            agg_df['avg_{}_{}d'.format(col, window)] = means[col]
+        window_df = agg_df if window_df is None else window_df.join(agg_df, how='outer')
+    window_df = window_df.reset_index()
+    # Users with logs in the longest window only have zero rows in the shorter ones.
+    day_cols = [col for col in window_df.columns if col.startswith('num_days_')]
+    sum_cols = [col for col in window_df.columns if col.startswith('sum_')]
+    window_df[day_cols + sum_cols] = window_df[day_cols + sum_cols].fillna(0)
+    return window_df
+
+
+def bench_ulog_windows(args):
+    data_dir = os.path.join(BENCHMARK_DATA_PATH, 'ulog')
+    labels_path, ulogs_path = write_synthetic_ulog_dataset(data_dir, args.num_users, args.num_rows)
+
+    sweep_df, sweep_secs = timed(
+        build_windowed_ulog_features_df, labels_path, ulogs_path, args.windows,
+    )
+    print("\nStreaming read + sweep: {:.2f}s ({} users)".format(sweep_secs, len(sweep_df)))
+
+    # The aggregation alone, over logs that are already in memory.
+    msnos = pd.read_csv(labels_path, usecols=['msno']).msno.values
+    ulogs = pd.merge(pd.read_csv(ulogs_path), pd.DataFrame({'msno': msnos}), on='msno')
+    groupby_df, groupby_secs = timed(
+        build_windowed_ulog_features_with_groupbys, ulogs, args.windows,
+    )
+
+    def sweep_in_memory():
+        days = to_day_numbers(ulogs.date.values)
+        recent = days > days.max() - max(args.windows)
+        return aggregate_trailing_windows(
+            msnos, pd.Index(msnos).get_indexer(ulogs.msno[recent]), days[recent],
+            ulogs[ULOG_AGG_COLS].values[recent].astype(np.float64), days.max(), args.windows,
+        )
+
+    in_memory_df, in_memory_secs = timed(sweep_in_memory)
+    print("In memory, {} windows: sweep {:.2f}s, one groupby per window {:.2f}s ({:.1f}x slower)"
+          .format(len(args.windows), in_memory_secs, groupby_secs, groupby_secs / in_memory_secs))
+    assert_frames_close(groupby_df[list(sweep_df.columns)], sweep_df)
+    assert_frames_close(groupby_df[list(sweep_df.columns)], in_memory_df)
+    print("Sweep output matches the groupbys")
+
+
+def peak_rss_kb():
+    """Peak resident set size of this process in KB.
+
+    Prefers VmHWM from /proc, because Linux carries `ru_maxrss` over from the parent across exec.
+    """
+    try:
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _run_and_measure(fn, args, kwargs):
+    rss_before_kb = peak_rss_kb()
+    result, secs = timed(fn, *args, **kwargs)
+    rss_after_kb = peak_rss_kb()
+    dtypes = result.dtypes.to_dict() if hasattr(result, 'dtypes') else None
+    return secs, (rss_after_kb - rss_before_kb) / 1024., dtypes
+
+
+def measure_in_fresh_process(fn, *args, **kwargs):
+    """Run `fn` in a freshly spawned process.
+
+    Returns the wall time, the growth in peak RSS in MB (so only what `fn` itself needed) and the
+    dtypes of the returned frame (None if `fn` doesn't return a DataFrame).
+    """
+    pool = multiprocessing.get_context('spawn').Pool(1)
+    try:
+        return pool.apply(_run_and_measure, (fn, args, kwargs))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def read_cache(backend_name, path, columns=None):
+    return get_cache_backend(backend_name).read(path, columns=columns)
+
+
+def bench_cache_backends(args):
+    data_dir = os.path.join(BENCHMARK_DATA_PATH, 'cache')
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    df = make_synthetic_training_df(args.num_users)
+    projected_columns = ['msno', 'is_churn', 'gender', 'city', 'registered_via']
+
+    rows = []
+    for backend_name in args.backends:
+        backend = get_cache_backend(backend_name)
+        path = backend.path(os.path.join(data_dir, 'train_df'))
+        _, write_secs = timed(backend.write, df, path)
+        size_mb = os.path.getsize(path) / 1024. / 1024.
+        for label, columns in [('all', None), ('5 cols', projected_columns)]:
+            secs, peak_mb, dtypes = measure_in_fresh_process(
+                read_cache, backend_name, path, columns=columns,
+            )
+            assert str(dtypes['gender']) == 'category', "{} lost categoricals".format(backend_name)
+            rows.append((backend_name, label, size_mb, write_secs, secs, peak_mb))
+
+    print("\n{:>8} {:>7} {:>9} {:>9} {:>9} {:>13}".format(
+        'backend', 'columns', 'size MB', 'write s', 'load s', 'peak RSS MB',
+    ))
+    for row in rows:
+        print("{:>8} {:>7} {:>9.1f} {:>9.2f} {:>9.3f} {:>13.1f}".format(*row))
+
+
+def build_statistics_df_with_lambdas(df_transactions):
+    """The statistics as `get_or_build_statistics_df` used to compute them, with per-row and
+    per-group Python lambdas (minus the nested-dict renaming newer pandas no longer accepts).
+    """
+    df_transactions = df_transactions.copy()
+    df_transactions['discount'] = (
+        df_transactions['plan_list_price'] - df_transactions['actual_amount_paid']
+    )
+    df_transactions['is_discount'] = df_transactions.discount.apply(lambda x: 1 if x > 0 else 0)
+    df_transactions['amt_per_day'] = (
+        df_transactions['actual_amount_paid'] / df_transactions['payment_plan_days']
+    )
+    for col in ['transaction_date', 'membership_expire_date']:
+        df_transactions[col] = pd.to_datetime(df_transactions[col], format='%Y%m%d')
+    df_transactions['membership_duration'] = (
+        (df_transactions.membership_expire_date - df_transactions.transaction_date) /
+        np.timedelta64(1, 'D')
+    )
+    grouped_transactions = df_transactions.groupby('msno')
+    stats_df = grouped_transactions.agg({
+        'plan_list_price': 'sum',
+        'actual_amount_paid': ['mean', 'sum'],
+        'is_cancel': lambda x: sum(x == 1),
+        'is_discount': lambda x: sum(x == 1),
+        'discount': 'sum',
+        'membership_duration': ['mean', 'sum'],
+        'amt_per_day': ['mean', 'sum'],
+    })
+    stats_df.columns = STATISTICS_COLUMNS[1:]
+    stats_df.insert(0, 'num_transactions', grouped_transactions.size())
+    return stats_df.reset_index()
+
+
+def bench_statistics(args):
+    msnos = make_msnos(args.num_users)
+    df_transactions = make_synthetic_transactions_df(msnos, args.num_rows)
+    print("Built {} synthetic transactions for {} users".format(args.num_rows, args.num_users))
+
+    vectorized_df, vectorized_secs = timed(build_statistics_df, df_transactions, key='msno')
+    print("\nVectorized statistics: {:.2f}s".format(vectorized_secs))
+    lambda_df, lambda_secs = timed(build_statistics_df_with_lambdas, df_transactions)
+    print("Lambda statistics: {:.2f}s ({:.1f}x slower)".format(
+        lambda_secs, lambda_secs / vectorized_secs,
+    ))
+    assert_frames_close(lambda_df, vectorized_df)
+    print("Vectorized output matches the lambda implementation")
+
+
+def bench_typed_ingestion(args):
+    data_dir = os.path.join(BENCHMARK_DATA_PATH, 'ingest')
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    msnos = make_msnos(args.num_users)
+    paths = dict((name, os.path.join(data_dir, name + '.csv'))
+                 for name in ['train', 'members', 'transactions'])
+    write_synthetic_labels(paths['train'], msnos)
+    make_synthetic_members_df(msnos).to_csv(paths['members'], index=False)
+    make_synthetic_transactions_df(msnos, args.num_rows).to_csv(
+        paths['transactions'], index=False,
+    )
+    schemas = {
+        'train': LABELS_SCHEMA,
+        'members': MEMBERS_SCHEMA,
+        'transactions': TRANSACTIONS_SCHEMA,
+    }
+
+    print("\n{:>13} {:>12} {:>10} {:>12} {:>10} {:>8}".format(
+        'file', 'bare peak MB', 'bare s', 'typed peak MB', 'typed s', 'saved',
+    ))
+    total_bare_mb = total_typed_mb = 0.
+    for name in ['train', 'members', 'transactions']:
+        bare_secs, bare_mb, _ = measure_in_fresh_process(pd.read_csv, paths[name])
+        typed_secs, typed_mb, _ = measure_in_fresh_process(
+            read_csv_with_schema, paths[name], schemas[name],
+        )
+        total_bare_mb += bare_mb
+        total_typed_mb += typed_mb
+        print("{:>13} {:>12.1f} {:>10.2f} {:>12.1f} {:>10.2f} {:>7.0%}".format(
+            name, bare_mb, bare_secs, typed_mb, typed_secs, 1 - typed_mb / bare_mb,
+        ))
+    print("Reading every input of the training frame: {:.1f} MB -> {:.1f} MB peak".format(
+        total_bare_mb, total_typed_mb,
+    ))
+
+
+def merge_csvs_with_sed_and_cat(csv_path1, csv_path2):
+    # What 'get_data.merge_csvs' used to do, with GNU sed's in-place syntax so it runs on Linux.
+    sed_flag = "-i ''" if sys.platform == 'darwin' else '-i'
+    subprocess.check_call("sed {} 1d {}".format(sed_flag, csv_path2), shell=True)
+    subprocess.check_call("cat {} >> {}".format(csv_path2, csv_path1), shell=True)
+
+
+def bench_merge_csvs(args):
+    data_dir = os.path.join(BENCHMARK_DATA_PATH, 'merge_csvs')
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    msnos = make_msnos(100000)
+    source_paths = [os.path.join(data_dir, 'part{}.csv'.format(i)) for i in range(2)]
+    for i, path in enumerate(source_paths):
+        write_synthetic_user_logs(path, msnos, args.num_rows // 2, seed=i)
+    total_mb = sum(os.path.getsize(path) for path in source_paths) / 1024. / 1024.
+
+    def fresh_copies():
+        copies = [path + '.copy' for path in source_paths]
+        for path, copy_path in zip(source_paths, copies):
+            shutil.copyfile(path, copy_path)
+        return copies
+
+    results = []
+    copies = fresh_copies()
+    _, secs = timed(merge_csvs_with_sed_and_cat, *copies)
+    results.append(('sed + cat (in place)', secs))
+    merged_reference = copies[0]
+
+    copies = fresh_copies()
+    _, secs = timed(merge_csvs, copies)
+    results.append(('merge_csvs (in place)', secs))
+    assert open(copies[0], 'rb').read() == open(merged_reference, 'rb').read()
+
+    out_path = os.path.join(data_dir, 'merged.csv')
+    _, secs = timed(merge_csvs, source_paths, out_path)
+    results.append(('merge_csvs (new file)', secs))
+    _, secs = timed(merge_csvs, source_paths, out_path + '.gz', compression='gzip')
+    results.append(('merge_csvs (gzip)', secs))
+
+    print("\nMerging {:.0f} MB of CSVs:".format(total_mb))
+    for name, secs in results:
+        print("{:<24} {:>8.2f}s {:>10.0f} MB/s".format(name, secs, total_mb / secs))
+
+
+def compile_csv_parts_with_dict_reader(csv_parts_path, to_write_path):
+    # What 'compile_csv_parts_to_larger_csv' used to do, with the fieldnames taken from the header
+    # rather than a hardcoded list.
+    part_paths = sorted(glob.glob(os.path.join(csv_parts_path, '*.csv')))
+    with open(part_paths[0], 'r') as first_part:
+        fieldnames = first_part.readline().rstrip('\n').split(',')
+    with open(to_write_path, 'w') as csv_to_write:
+        writer = csv.DictWriter(csv_to_write, fieldnames=fieldnames, lineterminator='\n')
+        writer.writeheader()
+        for fname in part_paths:
+            with open(fname, 'r') as csv_file:
+                for line in csv.DictReader(csv_file):
+                    writer.writerow(line)
+
+
+def bench_compile_csv_parts(args):
+    parts_dir = os.path.join(BENCHMARK_DATA_PATH, 'compile_parts', 'parts')
+    if not os.path.isdir(parts_dir):
+        os.makedirs(parts_dir)
+    for stale_path in glob.glob(os.path.join(parts_dir, '*.csv')):
+        os.remove(stale_path)
+    # Parts shaped like the Spark output of the user log notebooks: msno plus the aggregates.
+    msnos = make_msnos(args.num_parts * args.rows_per_part)
+    features_df = make_synthetic_training_df(len(msnos))[['msno'] + ULOG_FEATURES]
+    features_df['msno'] = msnos
+    for i in range(args.num_parts):
+        part_df = features_df.iloc[i * args.rows_per_part:(i + 1) * args.rows_per_part]
+        part_df.to_csv(
+            os.path.join(parts_dir, 'part-{:05d}-synthetic.csv'.format(i)),
+            index=False,
+        )
+    total_mb = sum(
+        os.path.getsize(path) for path in glob.glob(os.path.join(parts_dir, '*.csv'))
+    ) / 1024. / 1024.
+
+    out_dir = os.path.dirname(parts_dir)
+    results = []
+    reference_path = os.path.join(out_dir, 'dict_reader.csv')
+    _, secs = timed(compile_csv_parts_with_dict_reader, parts_dir, reference_path)
+    results.append(('csv.DictReader/DictWriter', secs))
+    csv_path = os.path.join(out_dir, 'compiled.csv')
+    _, secs = timed(compile_csv_parts_to_larger_csv, parts_dir, csv_path)
+    results.append(('block copy to CSV', secs))
+    assert open(csv_path, 'rb').read() == open(reference_path, 'rb').read()
+    parquet_path = os.path.join(out_dir, 'compiled.parquet')
+    _, secs = timed(
+        compile_csv_parts_to_larger_csv, parts_dir, parquet_path, output_format='parquet',
+    )
+    results.append(('Parquet', secs))
+    assert len(pd.read_parquet(parquet_path)) == len(features_df)
+
+    print("\nCompiling {} parts ({:.0f} MB):".format(args.num_parts, total_mb))
+    for name, secs in results:
+        print("{:<28} {:>8.2f}s {:>10.0f} MB/s".format(name, secs, total_mb / secs))
+
+
+def write_vw_json_lines_with_dict_reader(csv_file_to_read, json_file_to_write):
+    # What 'write_vw_json_lines' used to do.
+    with open(json_file_to_write, 'w') as json_file:
+        with open(csv_file_to_read, 'r') as csv_file:
+            for row in csv.DictReader(csv_file):
+                json_file.write('{}\n'.format(json.dumps(build_vw_json_obj_from_csv_dict(row))))
+
+
+def bench_vw_export(args):
+    data_dir = os.path.join(BENCHMARK_DATA_PATH, 'vw')
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    df = make_synthetic_training_df(args.num_users)
+    csv_path = os.path.join(data_dir, 'train_df_vw.csv')
+    df.to_csv(csv_path, index=False)
+
+    results = []
+    reference_path = os.path.join(data_dir, 'dict_reader.json')
+    _, secs = timed(write_vw_json_lines_with_dict_reader, csv_path, reference_path)
+    results.append(('csv.DictReader + json.dumps', secs))
+    json_path = os.path.join(data_dir, 'examples.json')
+    _, secs = timed(write_vw_examples, df, json_path, output_format='json')
+    results.append(('JSON', secs))
+    text_path = os.path.join(data_dir, 'examples.vw')
+    _, secs = timed(write_vw_examples, df, text_path)
+    results.append(('text', secs))
+    _, secs = timed(write_vw_examples, df, text_path + '.gz', compression='gzip')
+    results.append(('text, gzip', secs))
+    for num_workers in args.workers:
+        _, secs = timed(
+            write_vw_examples, df, text_path + '.gz', compression='gzip', num_workers=num_workers,
+        )
+        results.append(('text, gzip, {} workers'.format(num_workers), secs))
+
+    # The old exporter labelled every row 1 (it compared the CSV string to 0), so only the
+    # namespaces are compared, and floats only up to the 9 digits VW_FLOAT_FORMAT keeps.
+    with open(reference_path, 'r') as reference_file, open(json_path, 'r') as json_file:
+        for reference_line, line in zip(reference_file, json_file):
+            reference_obj, obj = json.loads(reference_line), json.loads(line)
+            for namespace, features in reference_obj.items():
+                if namespace == '_label':
+                    continue
+                for name, value in features.items():
+                    if isinstance(value, float):
+                        assert np.isclose(value, obj[namespace][name], rtol=1e-8), (name, value)
+                    else:
+                        assert value == obj[namespace][name], (name, value)
+
+    print("\nExporting {} rows to VW:".format(len(df)))
+    for name, secs in results:
+        print("{:<30} {:>8.2f}s {:>10.0f} rows/s".format(name, secs, len(df) / secs))
+
+
+def one_hot_encode_with_get_dummies(df_path):
+    # What 'get_or_build_training_or_validation_df' used to do for the non-VW frames.
+    df = pd.read_feather(df_path)
+    df = pd.concat([df, pd.get_dummies(df.gender)], axis=1).drop('gender', axis=1)
+    df = pd.concat([df, pd.get_dummies(df.city, prefix='city')], axis=1).drop('city', axis=1)
+    df = pd.concat(
+        [df, pd.get_dummies(df.registered_via, prefix='registered_via')],
+        axis=1,
+    ).drop('registered_via', axis=1)
+    return df
+
+
+def one_hot_encode_sparse(df_path):
+    df = pd.read_feather(df_path)
+    one_hot = SparseOneHotEncoder().fit_transform(df)
+    df = df.drop(USER_CATEGORICAL, axis=1)
+    return one_hot
+
+
+def bench_one_hot(args):
+    data_dir = os.path.join(BENCHMARK_DATA_PATH, 'one_hot')
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    df = make_synthetic_training_df(args.num_users)
+    df_path = os.path.join(data_dir, 'train_df_vw.feather')
+    df.to_feather(df_path)
+
+    # Compare the size of the one-hot columns only; the rest of the frame is the same either way.
+    dense_df = one_hot_encode_with_get_dummies(df_path)
+    one_hot = one_hot_encode_sparse(df_path)
+    dense_mb = dense_df.iloc[:, len(df.columns) - len(USER_CATEGORICAL):].memory_usage(
+        index=False).sum() / 1024. / 1024.
+    sparse_mb = one_hot.data.nbytes + one_hot.indices.nbytes + one_hot.indptr.nbytes
+    sparse_mb /= 1024. * 1024.
+    assert one_hot.shape[1] == dense_df.shape[1] - len(df.columns) + len(USER_CATEGORICAL)
+    assert one_hot.nnz == len(df) * len(USER_CATEGORICAL)
+    del dense_df, one_hot
+
+    dense_secs, dense_peak_mb, _ = measure_in_fresh_process(
+        one_hot_encode_with_get_dummies, df_path,
+    )
+    sparse_secs, sparse_peak_mb, _ = measure_in_fresh_process(one_hot_encode_sparse, df_path)
+    print("\nOne-hot encoding {} rows:".format(len(df)))
+    print("{:<28} {:>8} {:>14} {:>14}".format('', 'secs', 'peak RSS MB', 'one-hot MB'))
+    print("{:<28} {:>8.2f} {:>14.1f} {:>14.1f}".format(
+        'pd.get_dummies + concat', dense_secs, dense_peak_mb, dense_mb,
+    ))
+    print("{:<28} {:>8.2f} {:>14.1f} {:>14.1f}".format(
+        'SparseOneHotEncoder (CSR)', sparse_secs, sparse_peak_mb, sparse_mb,
+    ))
+
+
+class LinearChurnModel(object):
+    """A fixed logistic model, standing in for a fitted sklearn `LogisticRegression`."""
+
+    def __init__(self, weights):
+        self.weights = weights
+
+    def predict_proba(self, matrix):
+        churn = 1. / (1. + np.exp(-matrix.dot(self.weights)))
+        return np.column_stack([1. - churn, churn])
+
+
+def _score_over_http(port, msnos, num_requests, latencies):
+    connection = http.client.HTTPConnection('localhost', port)
+    for i in range(num_requests):
+        body = json.dumps({'msnos': [msnos[i % len(msnos)]]})
+        start = time.time()
+        connection.request('POST', '/score', body, {'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        assert response.status == 200, response.read()
+        response.read()
+        latencies.append(time.time() - start)
+    connection.close()
+
+
+def bench_scoring(args):
+    df = make_synthetic_training_df(args.num_users)
+    encoder = SparseOneHotEncoder().fit(df)
+    matrix, feature_names = build_sparse_feature_matrix(df, encoder)
+    # The last row of the index stands for unknown users; all zeros will do here.
+    index = FeatureIndex(
+        df.msno.values,
+        scipy.sparse.vstack([matrix, scipy.sparse.csr_matrix((1, matrix.shape[1]))], format='csr'),
+    )
+    weights = np.random.RandomState(0).normal(scale=0.01, size=matrix.shape[1])
+    scorer = Scorer(ChurnModel(LinearChurnModel(weights), feature_names), index)
+    msnos = list(np.random.RandomState(1).permutation(df.msno.values))
+    del df, matrix
+
+    print("\nIn-process scoring:")
+    for batch_size in [1, 16, 256, 1024]:
+        num_batches = max(10, 20000 // batch_size)
+        start = time.time()
+        for i in range(num_batches):
+            scorer.score(msnos[i * batch_size % len(msnos):][:batch_size])
+        secs = time.time() - start
+        print("batch size {:>5}: {:>10.0f} msnos/s".format(
+            batch_size, num_batches * batch_size / secs,
+        ))
+
+    print("\nHTTP, {} clients sending one msno per request:".format(args.clients))
+    print("{:<28} {:>10} {:>10} {:>12}".format('', 'p50 ms', 'p99 ms', 'requests/s'))
+    configs = [
+        ('no batching', 1, 0.),
+        ('micro-batching', MAX_BATCH_SIZE, MAX_BATCH_WAIT_SECS),
+    ]
+    for name, max_batch_size, max_wait_secs in configs:
+        server = make_scoring_server(
+            scorer, port=0, max_batch_size=max_batch_size, max_wait_secs=max_wait_secs,
+        )
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        latencies = []
+        clients = [
+            threading.Thread(target=_score_over_http, args=(
+                server.server_address[1], msnos[i::args.clients], args.requests_per_client,
+                latencies,
+            ))
+            for i in range(args.clients)
+        ]
+        start = time.time()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        secs = time.time() - start
+        server.shutdown()
+        server.server_close()
+        server.batcher.close()
+        p50, p99 = np.percentile(latencies, [50, 99]) * 1000.
+        print("{:<28} {:>10.2f} {:>10.2f} {:>12.0f}".format(name, p50, p99, len(latencies) / secs))
+
+
+def _write_incremental_day(data_dir, name, msnos, num_ulog_rows, num_transaction_rows, seed):
+    """Write one day's (or the history's) user logs and transactions, returning their paths."""
+    ulogs_path = os.path.join(data_dir, '{}_user_logs.csv'.format(name))
+    transactions_path = os.path.join(data_dir, '{}_transactions.csv'.format(name))
+    write_synthetic_user_logs(ulogs_path, msnos, num_ulog_rows, seed=seed)
+    make_synthetic_transactions_df(msnos, num_transaction_rows, seed=seed).to_csv(
+        transactions_path, index=False, date_format='%Y%m%d',
+    )
+    return ulogs_path, transactions_path
+
+
+def bench_incremental(args):
+    data_dir = os.path.join(BENCHMARK_DATA_PATH, 'incremental')
+    if os.path.isdir(data_dir):
+        shutil.rmtree(data_dir)
+    os.makedirs(data_dir)
+    state_path = os.path.join(data_dir, 'feature_state.npz')
+    msnos = make_msnos(args.num_users)
+    # The history covers most users; every delta touches a slice of them plus some new sign-ups.
+    num_history_users = int(args.num_users * 0.9)
+    history = _write_incremental_day(
+        data_dir, 'history', msnos[:num_history_users], args.num_rows, args.num_rows // 10, seed=0,
+    )
+    num_new_per_delta = (args.num_users - num_history_users) // max(args.num_deltas, 1)
+    deltas = []
+    for day in range(args.num_deltas):
+        rng = np.random.RandomState(day + 1)
+        active = rng.choice(num_history_users, size=num_history_users // 5, replace=False)
+        new_users = num_history_users + day * num_new_per_delta + np.arange(num_new_per_delta)
+        day_msnos = [msnos[i] for i in np.concatenate([active, new_users])]
+        deltas.append(_write_incremental_day(
+            data_dir, 'day{}'.format(day + 1), day_msnos, args.num_rows // 30, args.num_rows // 300,
+            seed=day + 1,
+        ))
+    labels_path = os.path.join(data_dir, 'labels.csv')
+    write_synthetic_labels(labels_path, msnos)
+
+    _, history_secs = timed(apply_delta, history[0], history[1], state_path)
+    delta_secs = []
+    for ulogs_path, transactions_path in deltas:
+        _, secs = timed(apply_delta, ulogs_path, transactions_path, state_path)
+        delta_secs.append(secs)
+    state, reapply_secs = timed(apply_delta, deltas[-1][0], deltas[-1][1], state_path)
+
+    # The full rebuild after the last delta: aggregate the history and every delta from scratch.
+    def rebuild():
+        all_ulogs_path = os.path.join(data_dir, 'all_user_logs.csv')
+        merge_csvs([history[0]] + [d[0] for d in deltas], all_ulogs_path)
+        ulog_df = build_ulog_features_df(labels_path, all_ulogs_path)
+        df_transactions = pd.concat(
+            [pd.read_csv(path) for path in [history[1]] + [d[1] for d in deltas]],
+            ignore_index=True,
+        )
+        labels_df = pd.read_csv(labels_path, usecols=['msno'])
+        stats_df = build_statistics_df(
+            pd.merge(labels_df, df_transactions, how='left', on='msno'), key='msno',
+        )
+        return ulog_df, stats_df
+
+    (rebuilt_ulog_df, rebuilt_stats_df), rebuild_secs = timed(rebuild)
+
+    label_msnos = pd.read_csv(labels_path, usecols=['msno']).msno.values
+    assert_frames_close(rebuilt_ulog_df, state.ulog_features_df(label_msnos))
+    stats_df = state.statistics_df(get_msno_dictionary().encode(label_msnos))
+    stats_df.insert(0, 'msno', label_msnos)
+    assert_frames_close(rebuilt_stats_df, stats_df.drop(MSNO_ID, axis=1))
+    print("Incremental state matches a full rebuild")
+
+    print("\nInitial history load: {:.2f}s".format(history_secs))
+    for day, secs in enumerate(delta_secs):
+        print("Delta {}: {:.2f}s".format(day + 1, secs))
+    print("Re-applying the last delta (skipped): {:.2f}s".format(reapply_secs))
+    print("Full rebuild: {:.2f}s ({:.1f}x slower than a delta)".format(
+        rebuild_secs, rebuild_secs / np.mean(delta_secs),
+    ))
+
+
+def _build_in_memory(root_dir):
+    os.chdir(root_dir)
+    return len(get_or_build_training_or_validation_df(for_vw=True, force_build=True))
+
+
+def _build_partitioned(root_dir, memory_limit_mb, num_workers):
+    os.chdir(root_dir)
+    return build_partitioned_training_or_validation_df(
+        for_vw=True, memory_limit_mb=memory_limit_mb, num_workers=num_workers, force_build=True,
+    )
+
+
+def bench_partitioned(args):
+    root_dir = os.path.abspath(os.path.join(BENCHMARK_DATA_PATH, 'partitioned'))
+    if os.path.isdir(root_dir):
+        shutil.rmtree(root_dir)
+    data_dir = os.path.join(root_dir, 'data')
+    write_synthetic_training_inputs(data_dir, args.num_users, args.num_rows)
+
+    # Both builds start without any cached stages, so each reads every input from scratch.
+    in_memory_secs, in_memory_mb, _ = measure_in_fresh_process(_build_in_memory, root_dir)
+    for path in glob.glob(os.path.join(data_dir, '*_df.*')):
+        os.remove(path)
+    partitioned_secs, partitioned_mb, _ = measure_in_fresh_process(
+        _build_partitioned, root_dir, args.memory_limit_mb, args.workers,
+    )
+
+    cwd = os.getcwd()
+    os.chdir(root_dir)
+    try:
+        in_memory_df = get_or_build_training_or_validation_df(for_vw=True)
+        partitioned_df = read_partitioned_df(build_partitioned_training_or_validation_df(
+            for_vw=True, memory_limit_mb=args.memory_limit_mb, num_workers=args.workers,
+        ))
+    finally:
+        os.chdir(cwd)
+    for col in USER_CATEGORICAL:
+        in_memory_values = in_memory_df.set_index('msno')[col].astype(str)
+        partitioned_values = partitioned_df.set_index('msno')[col].astype(str)
+        assert in_memory_values.sort_index().equals(partitioned_values.sort_index()), col
+    assert_frames_close(
+        in_memory_df.drop(USER_CATEGORICAL, axis=1), partitioned_df.drop(USER_CATEGORICAL, axis=1),
+    )
+    print("Partitioned output matches the in-memory build")
+
+    print("\n{:>12} {:>10} {:>13}".format('build', 'seconds', 'peak RSS MB'))
+    print("{:>12} {:>10.2f} {:>13.1f}".format('in memory', in_memory_secs, in_memory_mb))
+    print("{:>12} {:>10.2f} {:>13.1f}".format('partitioned', partitioned_secs, partitioned_mb))
+    if args.workers > 1:
+        print("(The partitioned peak is the parent's only; each of the {} workers adds its "
+              "own)".format(args.workers))
+
+
+def _suite_ulog_features(root_dir):
+    os.chdir(root_dir)
+    for validation in [False, True]:
+        get_or_build_ulog_features_df(validation=validation, force_build=True)
+
+
+def _suite_write_ulog_parts(root_dir, num_parts):
+    # Split the train user log features into part files, like the Spark notebooks write them.
+    os.chdir(root_dir)
+    ulog_df = pd.read_csv(TRAIN_ULOG_PATH)
+    parts_dir = os.path.join('data', SUITE_ULOG_PARTS)
+    os.makedirs(parts_dir)
+    part_size = len(ulog_df) // num_parts + 1
+    for i in range(num_parts):
+        ulog_df.iloc[i * part_size:(i + 1) * part_size].to_csv(
+            os.path.join(parts_dir, 'part-{:05d}-synthetic.csv'.format(i)), index=False,
+        )
+
+
+def _suite_compile_parts(root_dir):
+    os.chdir(root_dir)
+    compile_csv_parts_to_larger_csv(
+        os.path.join('data', SUITE_ULOG_PARTS), os.path.join('data', 'compiled_ulog_features.csv'),
+    )
+
+
+def _suite_members(root_dir):
+    os.chdir(root_dir)
+    get_or_build_members_df(force_build=True)
+
+
+def _suite_statistics(root_dir):
+    os.chdir(root_dir)
+    get_or_build_statistics_df(read_labels_df(), force_build=True)
+
+
+def _suite_training_df(root_dir, for_vw):
+    os.chdir(root_dir)
+    get_or_build_training_or_validation_df(for_vw=for_vw, force_build=True)
+
+
+def _suite_write_vw_csv(root_dir):
+    os.chdir(root_dir)
+    get_or_build_training_or_validation_df(for_vw=True).to_csv(
+        os.path.join('data', SUITE_VW_CSV), index=False,
+    )
+
+
+def _suite_vw_json_lines(root_dir):
+    os.chdir(root_dir)
+    write_vw_json_lines(os.path.join('data', SUITE_VW_CSV), os.path.join('data', 'train.json'))
+
+
+# (step, function, extra args). The steps run in this order, each in a fresh process, and each
+# relies on the caches the ones before it left behind.
+SUITE_STEPS = [
+    ('ulog_features', _suite_ulog_features, ()),
+    ('compile_csv_parts_to_larger_csv', _suite_compile_parts, ()),
+    ('get_or_build_members_df', _suite_members, ()),
+    ('get_or_build_statistics_df', _suite_statistics, ()),
+    ('get_or_build_training_or_validation_df', _suite_training_df, (False,)),
+    ('get_or_build_training_or_validation_df (for_vw)', _suite_training_df, (True,)),
+    ('write_vw_json_lines', _suite_vw_json_lines, ()),
+]
+
+
+def get_or_write_suite_dataset(num_users, num_ulog_rows, transactions_per_user):
+    """Return the root directory of a generated dataset, writing it if it isn't there yet.
+
+    Everything in its './data' besides the generated CSVs is removed, so every suite run starts
+    from the raw inputs only.
+    """
+    root_dir = os.path.abspath(os.path.join(
+        BENCHMARK_DATA_PATH, 'suite',
+        '{}u_{}r_{}t'.format(num_users, num_ulog_rows, transactions_per_user),
+    ))
+    data_dir = os.path.join(root_dir, 'data')
+    marker_path = os.path.join(data_dir, SUITE_DATASET_MARKER)
+    if os.path.isfile(marker_path):
+        with open(marker_path, 'r') as marker_file:
+            dataset_paths = json.load(marker_file)
+    else:
+        if os.path.isdir(root_dir):
+            shutil.rmtree(root_dir)
+        dataset_paths = write_synthetic_kkbox_dataset(
+            data_dir, num_users, num_ulog_rows, transactions_per_user,
+        )
+        with open(marker_path, 'w') as marker_file:
+            json.dump(dataset_paths, marker_file)
+
+    keep = set(os.path.basename(path) for path in dataset_paths.values())
+    keep.add(SUITE_DATASET_MARKER)
+    for fname in os.listdir(data_dir):
+        if fname in keep:
+            continue
+        path = os.path.join(data_dir, fname)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    return root_dir
+
+
+def git_revision():
+    """Return the current commit (short hash) and whether tracked files have uncommitted changes.
+
+    Both are None outside a git checkout.
+    """
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_dir, stderr=subprocess.DEVNULL,
+        ).decode('ascii').strip()
+        status = subprocess.check_output(
+            ['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo_dir,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(status.strip())
+
+
+def read_suite_results(results_path):
+    if not os.path.isfile(results_path):
+        return []
+    with open(results_path, 'r') as results_file:
+        return [json.loads(line) for line in results_file if line.strip()]
+
+
+def find_baseline_results(results, run, compare_to=None):
+    """Return the results of the last suite run at the same scale as `run`, by step.
+
+    That's the last run of commit `compare_to` if given, else of any other commit.
+    """
+    baseline_run_id = None
+    for result in results:
+        if result['scale'] != run['scale'] or result['run_id'] == run['run_id']:
+            continue
+        if compare_to is not None:
+            if result['commit'] is None or not result['commit'].startswith(compare_to):
+                continue
+        elif result['commit'] == run['commit']:
+            continue
+        baseline_run_id = result['run_id']
+    return dict(
+        (result['step'], result) for result in results if result['run_id'] == baseline_run_id
+    )
+
+
+def bench_suite(args):
+    root_dir = get_or_write_suite_dataset(
+        args.num_users, args.num_ulog_rows, args.transactions_per_user,
+    )
+    commit, dirty = git_revision()
+    run = {
+        'run_id': datetime.datetime.now().strftime('%Y%m%d%H%M%S'),
+        'commit': commit,
+        'dirty': dirty,
+        'scale': {
+            'num_users': args.num_users,
+            'num_ulog_rows': args.num_ulog_rows,
+            'transactions_per_user': args.transactions_per_user,
+        },
+    }
+
+    run_results = []
+    for step, fn, step_args in SUITE_STEPS:
+        print("\n=== {} ===".format(step))
+        secs, peak_mb, _ = measure_in_fresh_process(fn, root_dir, *step_args)
+        result = dict(run, step=step, secs=round(secs, 3), peak_rss_mb=round(peak_mb, 1))
+        run_results.append(result)
+        # Set up the inputs of the steps that don't build their own; not timed.
+        if step == 'ulog_features':
+            measure_in_fresh_process(_suite_write_ulog_parts, root_dir, args.num_parts)
+        elif step == 'get_or_build_training_or_validation_df (for_vw)':
+            measure_in_fresh_process(_suite_write_vw_csv, root_dir)
+
+    results_path = os.path.abspath(args.results)
+    baseline = find_baseline_results(read_suite_results(results_path), run, args.compare_to)
+    if args.save:
+        with open(results_path, 'a') as results_file:
+            for result in run_results:
+                results_file.write(json.dumps(result, sort_keys=True) + '\n')
+        print("\nAppended the results to {}".format(results_path))
+
+    print("\nCommit {}{}, {} users, {} user log rows, {} transactions per user:".format(
+        commit, ' (with uncommitted changes)' if dirty else '', args.num_users,
+        args.num_ulog_rows, args.transactions_per_user,
+    ))
+    if baseline:
+        print("Compared with commit {} ({})".format(
+            next(iter(baseline.values()))['commit'], next(iter(baseline.values()))['run_id'],
+        ))
+    print("{:<50} {:>10} {:>10} {:>13} {:>10}".format(
+        'step', 'seconds', 'baseline', 'peak RSS MB', 'baseline',
+    ))
+    num_regressions = 0
+    for result in run_results:
+        base = baseline.get(result['step'])
+        flag = ''
+        # Steps that only take a moment are too noisy to flag.
+        if (base is not None and max(result['secs'], base['secs']) >= MIN_COMPARED_SECS and
+                result['secs'] > base['secs'] * (1 + REGRESSION_THRESHOLD)):
+            flag = '  slower'
+            num_regressions += 1
+        print("{:<50} {:>10.2f} {:>10} {:>13.1f} {:>10}{}".format(
+            result['step'], result['secs'],
+            '-' if base is None else '{:.2f}'.format(base['secs']),
+            result['peak_rss_mb'],
+            '-' if base is None else '{:.1f}'.format(base['peak_rss_mb']),
+            flag,
+        ))
+    if num_regressions:
+        print("{} steps got over {:.0f}% slower".format(
+            num_regressions, REGRESSION_THRESHOLD * 100,
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the WSDM feature pipeline")
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    ulog_parser = subparsers.add_parser('ulog', help="User log aggregation vs. Spark")
+    ulog_parser.add_argument('--num-users', type=int, default=100000)
+    ulog_parser.add_argument('--num-rows', type=int, default=5000000)
+    ulog_parser.set_defaults(run=bench_ulog_aggregation)
+
+    scaling_parser = subparsers.add_parser(
+        'ulog-scaling',
+        help="User log aggregation per worker count",
+    )
+    scaling_parser.add_argument('--num-users', type=int, default=100000)
+    scaling_parser.add_argument('--num-rows', type=int, default=5000000)
+    scaling_parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    scaling_parser.set_defaults(run=bench_ulog_scaling)
+
+    windows_parser = subparsers.add_parser(
+        'ulog-windows',
+        help="Trailing-window user log features, one sweep vs. a groupby per window",
+    )
+    windows_parser.add_argument('--num-users', type=int, default=100000)
+    windows_parser.add_argument('--num-rows', type=int, default=5000000)
+    windows_parser.add_argument('--windows', type=int, nargs='+', default=ULOG_WINDOWS)
+    windows_parser.set_defaults(run=bench_ulog_windows)
+
+    cache_parser = subparsers.add_parser('cache', help="Cache backend load time and peak RSS")
+    cache_parser.add_argument('--num-users', type=int, default=1000000)
+    cache_parser.add_argument(
+        '--backends', nargs='+', default=sorted(CACHE_BACKENDS), choices=sorted(CACHE_BACKENDS),
+    )
+    cache_parser.set_defaults(run=bench_cache_backends)
+
+    stats_parser = subparsers.add_parser(
+        'stats',
+        help="Transactions statistics, vectorized vs. lambdas",
+    )
+    stats_parser.add_argument('--num-users', type=int, default=2000000)
+    stats_parser.add_argument('--num-rows', type=int, default=21000000)
+    stats_parser.set_defaults(run=bench_statistics)
+
+    ingest_parser = subparsers.add_parser('ingest', help="Peak memory of typed vs. bare CSV reads")
+    ingest_parser.add_argument('--num-users', type=int, default=1000000)
+    ingest_parser.add_argument('--num-rows', type=int, default=10000000)
+    ingest_parser.set_defaults(run=bench_typed_ingestion)
+
+    merge_parser = subparsers.add_parser('merge-csvs', help="CSV concatenation throughput")
+    merge_parser.add_argument('--num-rows', type=int, default=20000000)
+    merge_parser.set_defaults(run=bench_merge_csvs)
+
+    compile_parser = subparsers.add_parser('compile-parts', help="Compiling Spark part files")
+    compile_parser.add_argument('--num-parts', type=int, default=300)
+    compile_parser.add_argument('--rows-per-part', type=int, default=5000)
+    compile_parser.set_defaults(run=bench_compile_csv_parts)
+
+    vw_parser = subparsers.add_parser('vw', help="Vowpal Wabbit export throughput")
+    vw_parser.add_argument('--num-users', type=int, default=200000)
+    vw_parser.add_argument('--workers', type=int, nargs='+', default=[2, 4])
+    vw_parser.set_defaults(run=bench_vw_export)
+
+    one_hot_parser = subparsers.add_parser('one-hot', help="Dense vs. sparse one-hot encoding")
+    one_hot_parser.add_argument('--num-users', type=int, default=1000000)
+    one_hot_parser.set_defaults(run=bench_one_hot)
+
+    scoring_parser = subparsers.add_parser('scoring', help="Scoring latency and throughput")
+    scoring_parser.add_argument('--num-users', type=int, default=200000)
+    scoring_parser.add_argument('--clients', type=int, default=16)
+    scoring_parser.add_argument('--requests-per-client', type=int, default=200)
+    scoring_parser.set_defaults(run=bench_scoring)
+
+    incremental_parser = subparsers.add_parser(
+        'incremental',
+        help="Applying daily deltas vs. a full rebuild",
+    )
+    incremental_parser.add_argument('--num-users', type=int, default=200000)
+    incremental_parser.add_argument('--num-rows', type=int, default=5000000)
+    incremental_parser.add_argument('--num-deltas', type=int, default=3)
+    incremental_parser.set_defaults(run=bench_incremental)
+
+    partitioned_parser = subparsers.add_parser(
+        'partitioned',
+        help="Peak memory of the in-memory vs. partitioned training frame build",
+    )
+    partitioned_parser.add_argument('--num-users', type=int, default=1000000)
+    partitioned_parser.add_argument('--num-rows', type=int, default=10000000)
+    partitioned_parser.add_argument('--memory-limit-mb', type=int, default=256)
+    partitioned_parser.add_argument('--workers', type=int, default=1)
+    partitioned_parser.set_defaults(run=bench_partitioned)
+
+    suite_parser = subparsers.add_parser(
+        'suite',
+        help="The main pipeline stages end to end, with results kept per commit",
+    )
+    suite_parser.add_argument('--num-users', type=int, default=100000)
+    suite_parser.add_argument('--num-ulog-rows', type=int, default=10000000)
+    suite_parser.add_argument('--transactions-per-user', type=int, default=10)
+    suite_parser.add_argument('--num-parts', type=int, default=200)
+    suite_parser.add_argument('--results', default=BENCHMARK_RESULTS_PATH)
+    suite_parser.add_argument(
+        '--compare-to', default=None, help="Commit to compare with; the last other one by default",
+    )
+    suite_parser.add_argument('--no-save', dest='save', action='store_false')
+    suite_parser.set_defaults(run=bench_suite)
+
+    args = parser.parse_args()
+    if not hasattr(args, 'run'):
+        parser.print_help()
+        return
+    args.run(args)
+
+if __name__ == '__main__':
+    main()
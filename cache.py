@@ -0,0 +1,145 @@
+"""Pluggable on-disk cache backends for the DataFrames built in `utils.py`.
+
+Every backend exposes the same small interface:
+
+    backend.path(base_path, fingerprint) - The on-disk path of a cache entry.
+    backend.read(path, columns=None) - Load a cached frame, optionally only some of its columns.
+    backend.write(df, path) - Store a frame.
+
+The columnar backends (Feather/Arrow IPC and Parquet) can read a subset of columns without
+deserializing the rest, keep categorical dtypes, and don't depend on the pandas version that wrote
+them the way pickles do. Feather files are written uncompressed so that they can be memory-mapped.
+
+Cache entries are content-addressed: the file name carries a fingerprint of everything the cached
+frame was built from (source file sizes/mtimes, parameters, feature lists, upstream fingerprints),
+so a stale entry is simply never looked up again instead of being returned.
+"""
+import glob
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+# How many entries (i.e. fingerprints) to keep around per cached frame. Keeping more than one means
+# flipping back and forth between two inputs (say, train and validation users) doesn't rebuild.
+CACHE_ENTRIES_TO_KEEP = 2
+
+
+def fingerprint(*parts):
+    """Return a short, stable hash of JSON-serializable `parts`."""
+    serialized = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha1(serialized.encode('utf-8')).hexdigest()[:16]
+
+
+def file_fingerprint(path, hash_contents=False):
+    """Identify the current contents of a file.
+
+    By default this is the file's size and modification time, which is cheap even for the multi-GB
+    CSVs. With `hash_contents`, the file is hashed instead, which survives touches and copies.
+    Missing files fingerprint as None.
+    """
+    if not os.path.isfile(path):
+        return None
+    if not hash_contents:
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime]
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def series_fingerprint(series):
+    """Fingerprint the values of a Series, e.g. the set of msnos a frame was built for."""
+    hashed = pd.util.hash_pandas_object(series, index=False).values
+    return hashlib.sha1(hashed.tobytes()).hexdigest()
+
+
+class PickleCache(object):
+    name = 'pickle'
+    extension = '.pkl'
+
+    def path(self, base_path, fingerprint=None):
+        if fingerprint is None:
+            return base_path + self.extension
+        return '{}.{}{}'.format(base_path, fingerprint, self.extension)
+
+    def prune(self, base_path, num_to_keep=CACHE_ENTRIES_TO_KEEP):
+        """Delete all but the `num_to_keep` most recently written entries for `base_path`."""
+        entries = glob.glob('{}.*{}'.format(glob.escape(base_path), self.extension))
+        entries.sort(key=os.path.getmtime, reverse=True)
+        for stale_path in entries[num_to_keep:]:
+            os.remove(stale_path)
+
+    def read(self, path, columns=None):
+        df = pd.read_pickle(path)
+        if columns is not None:
+            df = df[columns]
+        return df
+
+    def write(self, df, path):
+        df.to_pickle(path)
+
+
+class FeatherCache(PickleCache):
+    name = 'feather'
+    extension = '.feather'
+
+    def read(self, path, columns=None):
+        from pyarrow import feather
+        table = feather.read_table(path, columns=columns, memory_map=True)
+        return table.to_pandas()
+
+    def write(self, df, path):
+        from pyarrow import feather
+        # Feather can't store an index, and uncompressed files are what make memory-mapping pay off.
+        feather.write_feather(
+            df.reset_index(drop=True),
+            path,
+            compression='uncompressed',
+        )
+
+
+class ParquetCache(PickleCache):
+    name = 'parquet'
+    extension = '.parquet'
+
+    def read(self, path, columns=None):
+        from pyarrow import parquet
+        table = parquet.read_table(path, columns=columns, memory_map=True)
+        return table.to_pandas()
+
+    def write(self, df, path):
+        from pyarrow import parquet
+        table = pyarrow.Table.from_pandas(df.reset_index(drop=True), preserve_index=False)
+        parquet.write_table(table, path)
+
+
+CACHE_BACKENDS = {
+    backend.name: backend for backend in [PickleCache(), FeatherCache(), ParquetCache()]
+}
+
+
+def get_cache_backend(name=None):
+    """Return the cache backend called `name`.
+
+    With no name, this uses the WSDM_CACHE_BACKEND environment variable if it's set, and otherwise
+    Feather when pyarrow is installed and pickles when it isn't.
+    """
+    if name is None:
+        name = os.environ.get('WSDM_CACHE_BACKEND') or ('feather' if pyarrow else 'pickle')
+    if name not in CACHE_BACKENDS:
+        raise ValueError("Unknown cache backend '{}', expected one of {}".format(
+            name, sorted(CACHE_BACKENDS),
+        ))
+    if name != 'pickle' and pyarrow is None:
+        raise ImportError("The '{}' cache backend requires pyarrow".format(name))
+    return CACHE_BACKENDS[name]
@@ -0,0 +1,220 @@
+"""A memory-mapped float32 copy of the training (or validation) frame, for model input.
+
+`export_feature_store` writes the (one-hot encoded) frame from
+`get_or_build_training_or_validation_df` into a directory holding
+
+    features.npy - The features as one C-contiguous float32 matrix, a row per user.
+    msnos.npy - The msno of every row, as fixed-width bytes. Rows are sorted by msno.
+    labels.npy - The 'is_churn' label of every row (train users only).
+    manifest.json - The shape, plus the name of every matrix column, the `features.py` group it
+                    belongs to and the frame column it comes from.
+
+Every file is a plain `.npy`, so any consumer can `np.load(path, mmap_mode='r')` it. A
+`FeatureStore` does that, which makes opening one instant, and reading a range of rows or the
+rows of a few users only pages in those rows. Processes on the same host that open the same
+store share its pages through the page cache instead of each holding a copy.
+
+Like the cached frames, the directory name carries the fingerprint of the frame it was exported
+from, so stale stores are never opened.
+
+Usage:
+    python feature_store.py --validation
+"""
+import argparse
+import json
+import os
+import shutil
+
+import numpy as np
+
+from features import (
+    LABEL, NUMERICAL_AGG_AVG, NUMERICAL_AGG_MAX, NUMERICAL_AGG_MIN, NUMERICAL_AGG_STDDEV,
+    NUMERICAL_AGG_SUM, NUMERICAL_NON_ULOG, NUMERICAL_WINDOW_AVG, NUMERICAL_WINDOW_DAYS,
+    NUMERICAL_WINDOW_SUM, USER_CATEGORICAL,
+)
+from msno_dictionary import MSNO_ID
+from profiling import annotate, profiled
+from utils import (
+    STATISTICS_COLUMNS, TRAIN_CSV_PATH, TRAIN_ULOG_PATH, VALIDATION_CSV_PATH, VALIDATION_ULOG_PATH,
+    get_or_build_training_or_validation_df, get_or_fit_one_hot_encoder,
+    training_or_validation_df_fingerprint,
+)
+
+TRAIN_FEATURE_STORE = './data/train_features'
+VALIDATION_FEATURE_STORE = './data/validation_features'
+SUCCESS_MARKER = '_SUCCESS'
+# Rows are converted to float32 and written this many at a time.
+EXPORT_BLOCK_ROWS = 100000
+
+# Member columns that are used as they are, so they aren't in any of the `features.py` lists.
+MEMBER_COLUMNS = ['bd']
+# The manifest group of a column, by the list it's in. Columns in several lists get the first one.
+FEATURE_GROUPS = [
+    ('user_categorical', USER_CATEGORICAL),
+    ('member', MEMBER_COLUMNS),
+    ('numerical_non_ulog', NUMERICAL_NON_ULOG),
+    ('statistics', STATISTICS_COLUMNS),
+    ('numerical_agg_avg', NUMERICAL_AGG_AVG),
+    ('numerical_agg_max', NUMERICAL_AGG_MAX),
+    ('numerical_agg_min', NUMERICAL_AGG_MIN),
+    ('numerical_agg_sum', NUMERICAL_AGG_SUM),
+    ('numerical_agg_stddev', NUMERICAL_AGG_STDDEV),
+    ('numerical_window_days', NUMERICAL_WINDOW_DAYS),
+    ('numerical_window_sum', NUMERICAL_WINDOW_SUM),
+    ('numerical_window_avg', NUMERICAL_WINDOW_AVG),
+]
+
+
+def build_manifest_columns(feature_cols, encoder):
+    """Describe each of `feature_cols` (frame columns, one-hot encoded with `encoder`).
+
+    Every source column has to be in one of the `FEATURE_GROUPS`, so a new feature can't end up in
+    the store without a group to select it by.
+    """
+    source_cols = dict(zip(encoder.feature_names, encoder.feature_columns))
+    group_of = {}
+    for group, cols in FEATURE_GROUPS:
+        for col in cols:
+            group_of.setdefault(col, group)
+    manifest_columns = []
+    for col in feature_cols:
+        source_col = source_cols.get(col, col)
+        if source_col not in group_of:
+            raise ValueError(
+                "Column {} isn't in any of the feature groups; add it to the list it belongs to "
+                "in 'features.py' (or to MEMBER_COLUMNS)".format(source_col)
+            )
+        manifest_columns.append({
+            'name': col,
+            'group': group_of[source_col],
+            'source': source_col,
+        })
+    return manifest_columns
+
+
+@profiled()
+def export_feature_store(validation=False, force_build=False):
+    """Write the train (or validation) frame as a feature store, unless it's already there.
+
+    Returns:
+        The store's directory, to open with `FeatureStore`.
+    """
+    if not validation:
+        csv_path, ulog_path, base_path = TRAIN_CSV_PATH, TRAIN_ULOG_PATH, TRAIN_FEATURE_STORE
+    else:
+        csv_path = VALIDATION_CSV_PATH
+        ulog_path = VALIDATION_ULOG_PATH
+        base_path = VALIDATION_FEATURE_STORE
+    encoder = get_or_fit_one_hot_encoder()
+    store_path = '{}.{}'.format(
+        base_path, training_or_validation_df_fingerprint(csv_path, ulog_path, validation, False),
+    )
+    if os.path.isfile(os.path.join(store_path, SUCCESS_MARKER)) and not force_build:
+        annotate(cache_hit=True)
+        return store_path
+
+    df = get_or_build_training_or_validation_df(validation)
+    feature_cols = [col for col in df.columns if col not in ('msno', MSNO_ID, LABEL)]
+    manifest_columns = build_manifest_columns(feature_cols, encoder)
+    if os.path.isdir(store_path):
+        shutil.rmtree(store_path)
+    os.makedirs(store_path)
+    feature_positions = df.columns.get_indexer(feature_cols)
+    msnos = df.msno.values.astype(np.bytes_)
+    order = np.argsort(msnos, kind='mergesort')
+    num_rows = len(df)
+
+    print("Writing {} rows of {} features to {}...".format(num_rows, len(feature_cols), store_path))
+    features = np.lib.format.open_memmap(
+        os.path.join(store_path, 'features.npy'), mode='w+', dtype=np.float32,
+        shape=(num_rows, len(feature_cols)),
+    )
+    for start in range(0, num_rows, EXPORT_BLOCK_ROWS):
+        rows = order[start:start + EXPORT_BLOCK_ROWS]
+        features[start:start + len(rows)] = df.iloc[rows, feature_positions].to_numpy(np.float32)
+    features.flush()
+    del features
+    np.save(os.path.join(store_path, 'msnos.npy'), msnos[order])
+    if LABEL in df.columns:
+        np.save(os.path.join(store_path, 'labels.npy'), df[LABEL].values[order].astype(np.int8))
+    with open(os.path.join(store_path, 'manifest.json'), 'w') as manifest_file:
+        json.dump({
+            'shape': [num_rows, len(feature_cols)],
+            'columns': manifest_columns,
+            'validation': validation,
+        }, manifest_file, indent=2)
+    open(os.path.join(store_path, SUCCESS_MARKER), 'w').close()
+    annotate(cache_hit=False, rows_out=num_rows)
+    print("All done writing {}!".format(store_path))
+    return store_path
+
+
+class FeatureStore(object):
+    """A feature store written by `export_feature_store`, memory-mapped read-only.
+
+    Args:
+        store_path - The store's directory.
+    """
+
+    def __init__(self, store_path):
+        with open(os.path.join(store_path, 'manifest.json'), 'r') as manifest_file:
+            self.manifest = json.load(manifest_file)
+        self.features = np.load(os.path.join(store_path, 'features.npy'), mmap_mode='r')
+        self.msnos = np.load(os.path.join(store_path, 'msnos.npy'), mmap_mode='r')
+        labels_path = os.path.join(store_path, 'labels.npy')
+        self.labels = np.load(labels_path, mmap_mode='r') if os.path.isfile(labels_path) else None
+        self.columns = [column['name'] for column in self.manifest['columns']]
+
+    def __len__(self):
+        return self.features.shape[0]
+
+    def column_indices(self, names=None, groups=None):
+        """The positions of the columns with the given names, or in the given manifest groups."""
+        return [
+            i for i, column in enumerate(self.manifest['columns'])
+            if (names is not None and column['name'] in names) or
+            (groups is not None and column['group'] in groups)
+        ]
+
+    def rows(self, start, stop):
+        """The features of rows `start` to `stop`, a view straight into the mapped file."""
+        return self.features[start:stop]
+
+    def positions(self, msnos):
+        """The row of every msno in `msnos`, or -1 for users that aren't in the store."""
+        msnos = np.asarray(msnos).astype(np.bytes_)
+        if len(self) == 0:
+            return np.full(len(msnos), -1, dtype=np.int64)
+        # Anything longer than the stored msnos can't be in the store, but would match once cut.
+        fits = np.char.str_len(msnos) <= self.msnos.dtype.itemsize
+        msnos = msnos.astype(self.msnos.dtype)
+        positions = np.searchsorted(self.msnos, msnos)
+        positions[positions == len(self)] = 0
+        known = fits & (self.msnos[positions] == msnos)
+        return np.where(known, positions, -1)
+
+    def lookup(self, msnos):
+        """Return the features of `msnos` (zeros for unknown users) and whether each was known."""
+        positions = self.positions(msnos)
+        known = positions >= 0
+        features = np.zeros((len(positions), self.features.shape[1]), dtype=np.float32)
+        # Sorted positions read the file front to back.
+        known_positions = positions[known]
+        order = np.argsort(known_positions)
+        known_features = np.empty((len(known_positions), self.features.shape[1]), np.float32)
+        known_features[order] = self.features[known_positions[order]]
+        features[known] = known_features
+        return features, known
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a frame as a memory-mapped feature store")
+    parser.add_argument('--validation', action='store_true')
+    parser.add_argument('--force-build', action='store_true')
+    args = parser.parse_args()
+    store = FeatureStore(export_feature_store(args.validation, args.force_build))
+    print("{} rows, {} columns".format(len(store), len(store.columns)))
+
+
+if __name__ == '__main__':
+    main()
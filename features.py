@@ -73,3 +73,28 @@ NUMERICAL_AGG_STDDEV = [
     'stddev_num_985',
     'stddev_num_100',
 ]
+
+# The user log columns the aggregates above are over, in the same order.
+ULOG_AGG_COLS = ['num_unq', 'total_secs', 'num_25', 'num_50', 'num_75', 'num_985', 'num_100']
+# Trailing windows, in days, of the windowed user log features below.
+ULOG_WINDOWS = [7, 14, 30]
+
+
+def window_feature_names(windows):
+    """Name the features of `ulog_features.aggregate_trailing_windows` over `windows`.
+
+    Returns:
+        A (days, sums, averages) tuple of name lists; sums and averages go window by window, in
+        `ULOG_AGG_COLS` order within each window.
+    """
+    day_names = ['num_days_{}d'.format(window) for window in windows]
+    sum_names = ['sum_{}_{}d'.format(col, window) for window in windows for col in ULOG_AGG_COLS]
+    avg_names = ['avg_{}_{}d'.format(col, window) for window in windows for col in ULOG_AGG_COLS]
+    return day_names, sum_names, avg_names
+
+
+# Aggregates over each user's trailing `ULOG_WINDOWS` days of logs, up to the last day in the logs
+# (see `ulog_features.build_windowed_ulog_features_df`).
+NUMERICAL_WINDOW_DAYS, NUMERICAL_WINDOW_SUM, NUMERICAL_WINDOW_AVG = window_feature_names(
+    ULOG_WINDOWS
+)
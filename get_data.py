@@ -1,10 +1,17 @@
+import concurrent.futures
 import getpass
+import hashlib
 import os
 import subprocess
+import threading
+import time
 
-import pyunpack
 import requests
 
+# 'merge_csvs' used to live here; keep it importable from this module.
+from csv_tools import merge_csvs, write_line_break_if_needed
+from profiling import profiled, stage
+
 CUR_SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
 
 KAGGLE_BASE_DATA_PATH = 'https://www.kaggle.com/c/kkbox-churn-prediction-challenge/download/'
@@ -56,61 +63,276 @@ LOCAL_V2_ULOGS_DATA_ARCHIVE_PATH = os.path.join(
     '{}.7z'.format(ULOGS_DATA_V2_FNAME),
 )
 
-# Kaggle archives ending in 'v2' will be extracted to this base directory
-KAGGLE_V2_ARCHIVE_BASE_PATH = 'data/churn_comp_refresh'
-
-FILE_CHUNK_SIZE = 512 * 1024
+# Each CSV we end up with, and the archives it's streamed out of (in order). The v1 and v2 halves of
+# the transactions and user logs are concatenated on the fly, without the v2 header.
+KAGGLE_DATA_FILES = [
+    (TRAIN_DATA_V2_FNAME, [(KAGGLE_TRAIN_DATA_PATH, LOCAL_TRAIN_DATA_ARCHIVE_PATH)]),
+    (VALIDATION_DATA_V2_FNAME, [(KAGGLE_VALIDATION_DATA_PATH, LOCAL_VALIDATION_DATA_ARCHIVE_PATH)]),
+    (MEMBERS_DATA_V3_FNAME, [(KAGGLE_MEMBERS_DATA_PATH, LOCAL_MEMBERS_DATA_ARCHIVE_PATH)]),
+    (TRANSACTIONS_DATA_V1_FNAME, [
+        (KAGGLE_V1_TRANSACTIONS_DATA_PATH, LOCAL_V1_TRANSACTIONS_DATA_ARCHIVE_PATH),
+        (KAGGLE_V2_TRANSACTIONS_DATA_PATH, LOCAL_V2_TRANSACTIONS_DATA_ARCHIVE_PATH),
+    ]),
+    (ULOGS_DATA_V1_FNAME, [
+        (KAGGLE_V1_ULOGS_DATA_PATH, LOCAL_V1_ULOGS_DATA_ARCHIVE_PATH),
+        (KAGGLE_V2_ULOGS_DATA_PATH, LOCAL_V2_ULOGS_DATA_ARCHIVE_PATH),
+    ]),
+]
+
+# Used to stream archive contents to stdout ('7z x -so').
+SEVEN_ZIP_BINARY = '7z'
+
+FILE_CHUNK_SIZE = 8 * 1024 * 1024
+# How many archives to download at the same time
+DOWNLOAD_WORKERS = 4
+# How many times a download is resumed after a connection error before giving up
+DOWNLOAD_RETRIES = 5
+# Seconds between progress reports while downloading
+PROGRESS_REPORT_INTERVAL = 10
+# Known SHA-256 digests of the Kaggle archives, keyed by file name. Downloads of files listed here
+# are verified; for the others the digest is printed so it can be added.
+KAGGLE_ARCHIVE_SHA256 = {}
 # Set this variable if you don't want to keep typing in your Kaggle username everytime you run
 # this script
 KAGGLE_USERNAME = ''
 
 
+class DownloadProgress(object):
+    """Thread-safe byte counter for concurrent downloads that prints a report now and then."""
+
+    def __init__(self, report_interval=PROGRESS_REPORT_INTERVAL):
+        self.report_interval = report_interval
+        self.lock = threading.Lock()
+        self.bytes_by_path = {}
+        self.start_time = time.time()
+        self.last_report_time = self.start_time
+        self.bytes_since_start = 0
+
+    def update(self, path, num_bytes):
+        with self.lock:
+            self.bytes_by_path[path] = self.bytes_by_path.get(path, 0) + num_bytes
+            self.bytes_since_start += num_bytes
+            now = time.time()
+            if now - self.last_report_time < self.report_interval:
+                return
+            self.last_report_time = now
+            rate = self.bytes_since_start / (now - self.start_time) / 1024 / 1024
+            print("Downloaded {} at {:.1f} MB/s".format(
+                ', '.join('{}: {:.0f} MB'.format(os.path.basename(p), b / 1024. / 1024.)
+                          for p, b in sorted(self.bytes_by_path.items())),
+                rate,
+            ))
+
+
+def build_download_session(num_workers=DOWNLOAD_WORKERS):
+    """A requests session whose connection pool (and login cookies) all download threads share."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=num_workers, pool_maxsize=num_workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def sha256_of_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(FILE_CHUNK_SIZE), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def _request_archive(session, kaggle_user_info, kaggle_archive_path, offset):
+    headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+    resp = session.get(kaggle_archive_path)
+    # Login to Kaggle and retrieve the data, starting at 'offset' if the server supports ranges.
+    return session.post(resp.url, data=kaggle_user_info, headers=headers, stream=True)
+
+
 def download_kaggle_archive_and_write_to_local_path(kaggle_user_info, kaggle_archive_path,
-                                                    local_archive_path):
+                                                    local_archive_path, session=None,
+                                                    progress=None, expected_sha256=None):
+    """Download an archive to `local_archive_path`, resuming a previous partial download.
+
+    Data goes to '<local_archive_path>.part' first, and is only moved into place once it's complete
+    (and its checksum matched, if one was given). If the connection drops, the download picks up
+    where it left off with an HTTP Range request, up to `DOWNLOAD_RETRIES` times.
+    """
+    if os.path.isfile(local_archive_path):
+        print("{} already downloaded, skipping".format(local_archive_path))
+        return local_archive_path
+    session = session or build_download_session(1)
+    part_path = local_archive_path + '.part'
+
     print("Downloading Kaggle data to {}...".format(local_archive_path))
-    resp = requests.get(kaggle_archive_path)
-    # Login to Kaggle and retrieve the data.
-    resp = requests.post(resp.url, data=kaggle_user_info)
-    # Writes the data to a local file one chunk at a time.
-    with open(local_archive_path, 'wb') as local_data_archive_file:
-         # Reads CHUNK_SIZE MB at a time into memory
-        for chunk in resp.iter_content(chunk_size=FILE_CHUNK_SIZE):
-            # filter out keep-alive new chunks
-            if chunk:
-                local_data_archive_file.write(chunk)
-    print("Finished downloading Kaggle data to {}!".format(local_archive_path))
-
-
-def extract_kaggle_archive_to_local_path(local_archive_path, local_fname):
-    # Annoyingly we have to special case Kaggle files that have the string 'v2' in them.
-    is_v2_archive = 'v2' in local_archive_path
-
-    print("Extracting {} to {}...".format(local_archive_path, local_fname))
-    archive = pyunpack.Archive(local_archive_path)
-    archive.extractall(LOCAL_DATA_PATH)
-    if is_v2_archive:
-        # This is the directory to which the archive was extracted
-        extract_dir = os.path.join(LOCAL_DATA_PATH, KAGGLE_V2_ARCHIVE_BASE_PATH)
-        extracted_location = os.path.join(extract_dir, local_fname)
-        desired_location = os.path.join(LOCAL_DATA_PATH, local_fname)
-        os.rename(extracted_location, desired_location)
-        print("Removing needless extracted directories...")
-        os.rmdir(extract_dir)
-        os.rmdir(os.path.join(LOCAL_DATA_PATH, 'data'))
-        print("Done removing those needless directories!")
-
-    print("Done with extraction, removing {}...".format(local_archive_path))
-    os.remove(local_archive_path)
-    print("All done extracting!")
-
-
-def merge_csvs(csv_path1, csv_path2):
-    # Do some tricky Unix stuff to delete the header of the second CSV and append that to the end of
-    # the first CSV.
-    sed_call = "sed -i '' 1d {}".format(csv_path2)
-    cat_call = "cat {} >> {}".format(csv_path2, csv_path1)
-    subprocess.call(sed_call, shell=True)
-    subprocess.call(cat_call, shell=True)
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+        try:
+            resp = _request_archive(session, kaggle_user_info, kaggle_archive_path, offset)
+            if resp.status_code == 416 and offset:
+                # We asked for bytes past the end, i.e. the '.part' file is already complete.
+                break
+            resp.raise_for_status()
+            if offset and resp.status_code != 206:
+                print("Server ignored the Range request, restarting {}".format(local_archive_path))
+                offset = 0
+            # Writes the data to a local file one chunk at a time.
+            with open(part_path, 'ab' if offset else 'wb') as local_data_archive_file:
+                for chunk in resp.iter_content(chunk_size=FILE_CHUNK_SIZE):
+                    # filter out keep-alive new chunks
+                    if chunk:
+                        local_data_archive_file.write(chunk)
+                        if progress is not None:
+                            progress.update(local_archive_path, len(chunk))
+            break
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout) as e:
+            if attempt == DOWNLOAD_RETRIES:
+                raise
+            print("Download of {} interrupted ({}), resuming...".format(local_archive_path, e))
+
+    digest = sha256_of_file(part_path)
+    if expected_sha256 is not None and digest != expected_sha256:
+        os.remove(part_path)
+        raise ValueError("Checksum mismatch for {}: expected {}, got {}".format(
+            local_archive_path, expected_sha256, digest,
+        ))
+    os.rename(part_path, local_archive_path)
+    print("Finished downloading Kaggle data to {} (sha256 {})!".format(local_archive_path, digest))
+    return local_archive_path
+
+
+class StageTimer(object):
+    """Thread-safe record of how long each pipeline stage took."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = []
+
+    def record(self, stage, name, start_time):
+        with self.lock:
+            self.timings.append((stage, name, start_time, time.time()))
+
+    def report(self):
+        print("\n{:<10} {:<30} {:>10} {:>10}".format('stage', 'file', 'start s', 'seconds'))
+        first_start = min(start for _, _, start, _ in self.timings)
+        for stage, name, start, end in sorted(self.timings, key=lambda t: t[2]):
+            print("{:<10} {:<30} {:>10.1f} {:>10.1f}".format(
+                stage, name, start - first_start, end - start,
+            ))
+        wall = max(end for _, _, _, end in self.timings) - first_start
+        for stage in ['download', 'extract']:
+            busy = sum(end - start for s, _, start, end in self.timings if s == stage)
+            print("Total {} time: {:.1f}s".format(stage, busy))
+        print("Wall clock: {:.1f}s".format(wall))
+
+
+def stream_archive_to_file(local_archive_path, out_file, skip_header=False, last_byte=None):
+    """Decompress a single-file archive straight into an open binary file, without temp files.
+
+    With `skip_header`, everything up to and including the first newline is dropped, which is how
+    the second half of a v1/v2 pair gets appended to the first. `last_byte` is the last byte
+    already in `out_file`; if that didn't end a line, one is ended before the archive's rows.
+
+    Returns:
+        The last byte now in `out_file` (`last_byte` if the archive added nothing).
+    """
+    extractor = subprocess.Popen(
+        [SEVEN_ZIP_BINARY, 'x', '-so', local_archive_path],
+        stdout=subprocess.PIPE,
+    )
+    try:
+        header_done = not skip_header
+        for block in iter(lambda: extractor.stdout.read(FILE_CHUNK_SIZE), b''):
+            if not header_done:
+                newline = block.find(b'\n')
+                if newline < 0:
+                    continue
+                block = block[newline + 1:]
+                header_done = True
+            if not block:
+                continue
+            write_line_break_if_needed(out_file, last_byte)
+            out_file.write(block)
+            last_byte = block[-1:]
+    finally:
+        extractor.stdout.close()
+        returncode = extractor.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, SEVEN_ZIP_BINARY)
+    return last_byte
+
+
+def extract_kaggle_archives_to_csv(download_futures, local_fname, timer=None):
+    """Wait for the archives of one CSV to download, then stream them into that CSV.
+
+    Each archive is deleted as soon as it has been decompressed, so the disk never holds an
+    extracted copy of an archive next to the final CSV.
+    """
+    csv_path = os.path.join(LOCAL_DATA_PATH, local_fname)
+    part_path = csv_path + '.part'
+    with open(part_path, 'wb') as csv_file:
+        last_byte = None
+        for i, future in enumerate(download_futures):
+            local_archive_path = future.result()
+            start_time = time.time()
+            print("Extracting {} into {}...".format(local_archive_path, csv_path))
+            with stage('extract', file=os.path.basename(local_archive_path)):
+                last_byte = stream_archive_to_file(
+                    local_archive_path, csv_file, skip_header=i > 0, last_byte=last_byte,
+                )
+            os.remove(local_archive_path)
+            if timer is not None:
+                timer.record('extract', os.path.basename(local_archive_path), start_time)
+    os.rename(part_path, csv_path)
+    print("All done writing {}!".format(csv_path))
+    return csv_path
+
+
+@profiled()
+def download_and_extract_kaggle_data(kaggle_user_info, data_files=KAGGLE_DATA_FILES,
+                                     num_workers=DOWNLOAD_WORKERS):
+    """Download all archives concurrently, extracting each CSV while later downloads continue.
+
+    Extraction runs on its own single thread, in the order of `data_files`, as soon as a CSV's
+    archives are all downloaded. Returns a `StageTimer` with per-stage timings.
+    """
+    session = build_download_session(num_workers)
+    progress = DownloadProgress()
+    timer = StageTimer()
+
+    def download(kaggle_archive_path, local_archive_path):
+        start_time = time.time()
+        with stage('download', file=os.path.basename(local_archive_path)):
+            download_kaggle_archive_and_write_to_local_path(
+                kaggle_user_info,
+                kaggle_archive_path,
+                local_archive_path,
+                session=session,
+                progress=progress,
+                expected_sha256=KAGGLE_ARCHIVE_SHA256.get(os.path.basename(local_archive_path)),
+            )
+        timer.record('download', os.path.basename(local_archive_path), start_time)
+        return local_archive_path
+
+    download_executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_workers)
+    extract_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    try:
+        extract_futures = []
+        for local_fname, archives in data_files:
+            download_futures = [
+                download_executor.submit(download, kaggle_archive_path, local_archive_path)
+                for kaggle_archive_path, local_archive_path in archives
+            ]
+            extract_futures.append(extract_executor.submit(
+                extract_kaggle_archives_to_csv, download_futures, local_fname, timer,
+            ))
+        for future in extract_futures:
+            future.result()
+    finally:
+        download_executor.shutdown(wait=True)
+        extract_executor.shutdown(wait=True)
+    timer.report()
+    return timer
 
 
 def main():
@@ -122,103 +344,9 @@ def main():
         'Password': pw,
     }
 
-    print("Beginning download and extraction of training data...\n")
-    download_kaggle_archive_and_write_to_local_path(
-        kaggle_user_info,
-        KAGGLE_TRAIN_DATA_PATH,
-        LOCAL_TRAIN_DATA_ARCHIVE_PATH,
-    )
-    extract_kaggle_archive_to_local_path(
-        LOCAL_TRAIN_DATA_ARCHIVE_PATH,
-        TRAIN_DATA_V2_FNAME,
-    )
-    print("\nAll done downloading and extracting training data!\n")
-
-    print("Beginning download and extraction of validation data...\n")
-    download_kaggle_archive_and_write_to_local_path(
-        kaggle_user_info,
-        KAGGLE_VALIDATION_DATA_PATH,
-        LOCAL_VALIDATION_DATA_ARCHIVE_PATH,
-    )
-    extract_kaggle_archive_to_local_path(
-        LOCAL_VALIDATION_DATA_ARCHIVE_PATH,
-        VALIDATION_DATA_V2_FNAME,
-    )
-    print("\nAll done downloading and extracting validation data!\n")
-
-    print("Beginning download and extraction of members data...\n")
-    download_kaggle_archive_and_write_to_local_path(
-        kaggle_user_info,
-        KAGGLE_MEMBERS_DATA_PATH,
-        LOCAL_MEMBERS_DATA_ARCHIVE_PATH,
-    )
-    extract_kaggle_archive_to_local_path(
-        LOCAL_MEMBERS_DATA_ARCHIVE_PATH,
-        MEMBERS_DATA_V3_FNAME,
-    )
-    print("\nAll done downloading and extracting members data!\n")
-
-    print("Beginning download and extraction of transactions data (v1)...\n")
-    download_kaggle_archive_and_write_to_local_path(
-        kaggle_user_info,
-        KAGGLE_V1_TRANSACTIONS_DATA_PATH,
-        LOCAL_V1_TRANSACTIONS_DATA_ARCHIVE_PATH,
-    )
-    extract_kaggle_archive_to_local_path(
-        LOCAL_V1_TRANSACTIONS_DATA_ARCHIVE_PATH,
-        TRANSACTIONS_DATA_V1_FNAME,
-    )
-    print("\nAll done downloading and extracting transactions data (v1)!\n")
-
-    print("Beginning download and extraction of transactions data (v2)...\n")
-    download_kaggle_archive_and_write_to_local_path(
-        kaggle_user_info,
-        KAGGLE_V2_TRANSACTIONS_DATA_PATH,
-        LOCAL_V2_TRANSACTIONS_DATA_ARCHIVE_PATH,
-    )
-    extract_kaggle_archive_to_local_path(
-        LOCAL_V2_TRANSACTIONS_DATA_ARCHIVE_PATH,
-        TRANSACTIONS_DATA_V2_FNAME,
-    )
-    print("\nAll done downloading and extracting transactions data (v2)!\n")
-
-    print("Beginning merge of v1 and v2 transactions data...\n")
-    transactions_v1_path = os.path.join(LOCAL_DATA_PATH, TRANSACTIONS_DATA_V1_FNAME)
-    transactions_v2_path = os.path.join(LOCAL_DATA_PATH, TRANSACTIONS_DATA_V2_FNAME)
-    merge_csvs(transactions_v1_path, transactions_v2_path)
-    os.remove(transactions_v2_path)
-    print("All done merging v1 and v2 transactions data files!")
-
-    print("Beginning download and extraction of user logs data (v1)...\n")
-    download_kaggle_archive_and_write_to_local_path(
-        kaggle_user_info,
-        KAGGLE_V1_ULOGS_DATA_PATH,
-        LOCAL_V1_ULOGS_DATA_ARCHIVE_PATH,
-    )
-    extract_kaggle_archive_to_local_path(
-        LOCAL_V1_ULOGS_DATA_ARCHIVE_PATH,
-        ULOGS_DATA_V1_FNAME,
-    )
-    print("\nAll done downloading and extracting user logs data (v1)!\n")
-
-    print("Beginning download and extraction of user logs data (v2)...\n")
-    download_kaggle_archive_and_write_to_local_path(
-        kaggle_user_info,
-        KAGGLE_V2_ULOGS_DATA_PATH,
-        LOCAL_V2_ULOGS_DATA_ARCHIVE_PATH,
-    )
-    extract_kaggle_archive_to_local_path(
-        LOCAL_V2_ULOGS_DATA_ARCHIVE_PATH,
-        ULOGS_DATA_V2_FNAME,
-    )
-    print("\nAll done downloading and extracting user logs data (v2)!\n")
-
-    print("Beginning merge of v1 and v2 user logs data...\n")
-    ulogs_v1_path = os.path.join(LOCAL_DATA_PATH, ULOGS_DATA_V1_FNAME)
-    ulogs_v2_path = os.path.join(LOCAL_DATA_PATH, ULOGS_DATA_V2_FNAME)
-    merge_csvs(ulogs_v1_path, ulogs_v2_path)
-    os.remove(ulogs_v2_path)
-    print("All done merging v1 and v2 user logs data files!\n")
+    print("Beginning download and extraction of all Kaggle data...\n")
+    download_and_extract_kaggle_data(kaggle_user_info)
+    print("\nAll done downloading and extracting Kaggle data!\n")
 
     print("All done with everything, happy modeling!")
 
@@ -0,0 +1,400 @@
+"""Persisted per-user feature state that daily user log and transaction deltas can be folded into.
+
+The user log features and the transaction statistics are both built from sums, counts, sums of
+squares, minima and maxima, which merge across files. `FeatureState` keeps those per user, in
+arrays indexed by 'msno_id' (ids never change, see 'msno_dictionary.py'), together with each user's
+last log, transaction and membership expiry dates. The trailing-window features can't be merged
+that way, as the windows move with every new day of logs, so the state also keeps the log rows of
+the last `max(ULOG_WINDOWS)` days themselves, and sweeps them like the full build does.
+`apply_delta` folds a new file such as 'user_logs_v2.csv' or 'transactions_v2.csv' into the saved
+state, reading only that file, and the features for any set of users are computed from the state
+without touching the history.
+
+Usage:
+    python incremental.py --user-logs ./data/user_logs_v2.csv \
+        --transactions ./data/transactions_v2.csv
+
+Every applied file is recorded by its content hash, so applying the same delta twice is a no-op.
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from cache import file_fingerprint, fingerprint
+from features import ULOG_AGG_COLS, ULOG_WINDOWS
+from msno_dictionary import MSNO_ID, get_msno_dictionary
+from profiling import annotate, profiled
+from schemas import (
+    LABELS_SCHEMA, READ_CHUNK_SIZE, TRANSACTIONS_SCHEMA, USER_LOGS_SCHEMA, iter_csv_with_schema,
+    read_csv_with_schema,
+)
+from ulog_features import (
+    ULOG_CHUNK_SIZE, UlogAccumulator, aggregate_trailing_windows, to_day_numbers,
+)
+from utils import (
+    STATISTICS_COLUMNS, TRAIN_CSV_PATH, TRAIN_ULOG_PATH, VALIDATION_CSV_PATH,
+    VALIDATION_ULOG_PATH, build_transaction_features_df,
+)
+
+FEATURE_STATE_PATH = './data/feature_state.npz'
+# The per-transaction columns of `build_transaction_features_df` that are summed per user, and the
+# ones that are also averaged (pandas' mean skips NaNs, so those need their own non-null counts).
+TRANSACTION_SUM_COLS = [
+    'plan_list_price', 'actual_amount_paid', 'is_cancel', 'is_discount', 'discount',
+    'membership_duration', 'amt_per_day',
+]
+TRANSACTION_MEAN_COLS = ['actual_amount_paid', 'membership_duration', 'amt_per_day']
+# How many days of log rows, back from the last one, the state keeps for the windowed features.
+RECENT_LOG_DAYS = max(ULOG_WINDOWS)
+
+
+def _yyyymmdd(dates):
+    """Turn dates, as '%Y%m%d' ints or datetime64, into '%Y%m%d' ints with 0 for missing dates."""
+    dates = pd.Series(dates)
+    if np.issubdtype(dates.dtype, np.datetime64):
+        dates = dates.dt.year * 10000 + dates.dt.month * 100 + dates.dt.day
+    return dates.fillna(0).values.astype(np.int32)
+
+
+def _fold_max(target, ids, values):
+    """target[ids] = max(target[ids], values), for ids that may repeat."""
+    per_user = pd.Series(values).groupby(ids).max()
+    target[per_user.index.values] = np.maximum(target[per_user.index.values], per_user.values)
+
+
+class FeatureState(object):
+    """Mergeable per-user aggregates over every user log and transaction row folded in so far."""
+
+    def __init__(self):
+        self.generation = get_msno_dictionary().generation
+        self.applied = []
+        self.ulog = UlogAccumulator(np.arange(0))
+        self.last_log_date = np.zeros(0, dtype=np.int32)
+        self.transaction_count = np.zeros(0, dtype=np.int64)
+        self.transaction_sums = np.zeros((0, len(TRANSACTION_SUM_COLS)))
+        self.transaction_nonnull = np.zeros((0, len(TRANSACTION_MEAN_COLS)), dtype=np.int64)
+        self.last_transaction_date = np.zeros(0, dtype=np.int32)
+        self.last_expire_date = np.zeros(0, dtype=np.int32)
+        # The log rows of the last `RECENT_LOG_DAYS` days up to `last_log_day` (in days since the
+        # epoch, None before any logs), as ids, days and `ULOG_AGG_COLS` values.
+        self.last_log_day = None
+        self.recent_ids = np.zeros(0, dtype=np.int32)
+        self.recent_days = np.zeros(0, dtype=np.int32)
+        self.recent_values = np.zeros((0, len(ULOG_AGG_COLS)))
+
+    def __len__(self):
+        return len(self.transaction_count)
+
+    def _grow(self, num_users):
+        """Make room for the users with ids below `num_users`; new users start out empty."""
+        num_new = num_users - len(self)
+        if num_new <= 0:
+            return
+        # The accumulator's "msnos" are the ids themselves, so its rows line up with the ids.
+        self.ulog.extend(np.arange(len(self), num_users))
+        self.last_log_date = np.concatenate([self.last_log_date, np.zeros(num_new, np.int32)])
+        self.transaction_count = np.concatenate(
+            [self.transaction_count, np.zeros(num_new, np.int64)],
+        )
+        self.transaction_sums = np.vstack(
+            [self.transaction_sums, np.zeros((num_new, len(TRANSACTION_SUM_COLS)))],
+        )
+        self.transaction_nonnull = np.vstack([
+            self.transaction_nonnull,
+            np.zeros((num_new, len(TRANSACTION_MEAN_COLS)), dtype=np.int64),
+        ])
+        self.last_transaction_date = np.concatenate(
+            [self.last_transaction_date, np.zeros(num_new, np.int32)],
+        )
+        self.last_expire_date = np.concatenate([self.last_expire_date, np.zeros(num_new, np.int32)])
+
+    def _encode(self, msnos):
+        ids = get_msno_dictionary().encode(msnos)
+        self._grow(len(get_msno_dictionary()))
+        return ids
+
+    @profiled()
+    def add_user_logs(self, ulogs_csv_path, chunksize=ULOG_CHUNK_SIZE):
+        """Fold every row of a user log file into the state."""
+        num_rows = 0
+        recent = [(self.recent_ids, self.recent_days, self.recent_values)]
+        for ulog_chunk in iter_csv_with_schema(ulogs_csv_path, USER_LOGS_SCHEMA,
+                                               ['msno', 'date'] + ULOG_AGG_COLS, chunksize):
+            ids = self._encode(ulog_chunk.msno.values)
+            values = ulog_chunk[ULOG_AGG_COLS].values.astype(np.float64)
+            self.ulog.update_arrays(ids, values)
+            _fold_max(self.last_log_date, ids, _yyyymmdd(ulog_chunk.date.values))
+            if len(ulog_chunk):
+                days = to_day_numbers(ulog_chunk.date.values)
+                chunk_last_day = int(days.max())
+                if self.last_log_day is None or chunk_last_day > self.last_log_day:
+                    self.last_log_day = chunk_last_day
+                keep = days > self.last_log_day - RECENT_LOG_DAYS
+                recent.append((
+                    ids[keep].astype(np.int32), days[keep].astype(np.int32), values[keep],
+                ))
+            num_rows += len(ulog_chunk)
+            print("Folded {} user log rows from {} so far...".format(num_rows, ulogs_csv_path))
+
+        # Rows kept against an earlier last day may have fallen out of the windows since.
+        recent_ids = np.concatenate([chunk_ids for chunk_ids, _, _ in recent])
+        recent_days = np.concatenate([chunk_days for _, chunk_days, _ in recent])
+        recent_values = np.vstack([chunk_values for _, _, chunk_values in recent])
+        if self.last_log_day is not None:
+            keep = recent_days > self.last_log_day - RECENT_LOG_DAYS
+            self.recent_ids = recent_ids[keep]
+            self.recent_days = recent_days[keep]
+            self.recent_values = recent_values[keep]
+        annotate(csv_path=ulogs_csv_path, rows_in=num_rows, recent_rows=len(self.recent_ids))
+
+    @profiled()
+    def add_transactions(self, transactions_csv_path, chunksize=READ_CHUNK_SIZE):
+        """Fold every row of a transactions file into the state."""
+        num_rows = 0
+        for transactions_chunk in iter_csv_with_schema(transactions_csv_path, TRANSACTIONS_SCHEMA,
+                                                       chunksize=chunksize):
+            ids = self._encode(transactions_chunk.msno.values)
+            transactions_chunk[MSNO_ID] = ids
+            features_df = build_transaction_features_df(transactions_chunk)
+            num_users = len(self)
+            self.transaction_count += np.bincount(ids, minlength=num_users)
+            for j, col in enumerate(TRANSACTION_SUM_COLS):
+                values = features_df[col].values.astype(np.float64)
+                self.transaction_sums[:, j] += np.bincount(
+                    ids, weights=np.where(np.isnan(values), 0., values), minlength=num_users,
+                )
+            for j, col in enumerate(TRANSACTION_MEAN_COLS):
+                self.transaction_nonnull[:, j] += np.bincount(
+                    ids, weights=features_df[col].notnull().values, minlength=num_users,
+                ).astype(np.int64)
+            _fold_max(
+                self.last_transaction_date, ids,
+                _yyyymmdd(transactions_chunk.transaction_date.values),
+            )
+            _fold_max(
+                self.last_expire_date, ids,
+                _yyyymmdd(transactions_chunk.membership_expire_date.values),
+            )
+            num_rows += len(transactions_chunk)
+            print("Folded {} transaction rows from {} so far...".format(
+                num_rows, transactions_csv_path,
+            ))
+        annotate(csv_path=transactions_csv_path, rows_in=num_rows)
+
+    def ulog_features_df(self, msnos):
+        """The user log features of those `msnos` with any logs, like `build_ulog_features_df`."""
+        ids = get_msno_dictionary().encode(pd.unique(np.asarray(msnos)), add_missing=False)
+        ids = ids[(ids >= 0) & (ids < len(self))]
+        # An accumulator over just these users, so 'to_df' only computes their rows.
+        accumulator = UlogAccumulator(np.arange(0))
+        accumulator.msno_index = pd.Index(ids)
+        accumulator.count = self.ulog.count[ids]
+        accumulator.sum = self.ulog.sum[ids]
+        accumulator.sumsq = self.ulog.sumsq[ids]
+        accumulator.min = self.ulog.min[ids]
+        accumulator.max = self.ulog.max[ids]
+        ulog_df = accumulator.to_df()
+        ulog_df['msno'] = get_msno_dictionary().decode(ulog_df.msno.values.astype(np.int64))
+        return ulog_df
+
+    def windowed_ulog_features_df(self, msnos, windows=ULOG_WINDOWS):
+        """The trailing-window features of `msnos`, like `build_windowed_ulog_features_df`."""
+        if max(windows) > RECENT_LOG_DAYS:
+            raise ValueError("The state only keeps the last {} days of logs, not {}".format(
+                RECENT_LOG_DAYS, max(windows),
+            ))
+        ids = get_msno_dictionary().encode(pd.unique(np.asarray(msnos)), add_missing=False)
+        ids = ids[(ids >= 0) & (ids < len(self))]
+        end_day = 0 if self.last_log_day is None else self.last_log_day
+        # The users' positions in `ids` are the user codes of the sweep.
+        codes = pd.Index(ids).get_indexer(self.recent_ids)
+        keep = (codes >= 0) & (self.recent_days > end_day - max(windows))
+        return aggregate_trailing_windows(
+            get_msno_dictionary().decode(ids), codes[keep],
+            self.recent_days[keep].astype(np.int64), self.recent_values[keep], end_day, windows,
+        )
+
+    def statistics_df(self, msno_ids):
+        """The transaction statistics of the users `msno_ids`, like `get_or_build_statistics_df`."""
+        msno_ids = np.asarray(msno_ids)
+        self._grow(len(get_msno_dictionary()))
+        count = self.transaction_count[msno_ids]
+        sums = self.transaction_sums[msno_ids]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means = np.column_stack([
+                sums[:, TRANSACTION_SUM_COLS.index(col)] for col in TRANSACTION_MEAN_COLS
+            ]) / self.transaction_nonnull[msno_ids]
+        means[self.transaction_nonnull[msno_ids] == 0] = np.nan
+
+        def total(col):
+            return sums[:, TRANSACTION_SUM_COLS.index(col)]
+
+        def mean(col):
+            return means[:, TRANSACTION_MEAN_COLS.index(col)]
+
+        stats_df = pd.DataFrame({
+            MSNO_ID: msno_ids,
+            # The full build left-joins the users onto the transactions, so a user without any
+            # gets a single all-NaN row, which counts as one transaction.
+            'num_transactions': np.maximum(count, 1),
+            'plan_net_worth': total('plan_list_price'),
+            'mean_payment': mean('actual_amount_paid'),
+            'total_payments': total('actual_amount_paid'),
+            'times_canceled': total('is_cancel'),
+            'num_discounts': total('is_discount'),
+            'total_discount': total('discount'),
+            'mean_membership_duration': mean('membership_duration'),
+            'total_membership_duration': total('membership_duration'),
+            'mean_amt_per_day': mean('amt_per_day'),
+            'total_amt_per_day': total('amt_per_day'),
+        })
+        return stats_df[[MSNO_ID] + STATISTICS_COLUMNS]
+
+    def last_dates_df(self, msno_ids):
+        """Each user's last log, transaction and membership expiry date ('%Y%m%d', 0 if none)."""
+        msno_ids = np.asarray(msno_ids)
+        self._grow(len(get_msno_dictionary()))
+        return pd.DataFrame({
+            MSNO_ID: msno_ids,
+            'last_log_date': self.last_log_date[msno_ids],
+            'last_transaction_date': self.last_transaction_date[msno_ids],
+            'last_expire_date': self.last_expire_date[msno_ids],
+        })
+
+    def save(self, path=FEATURE_STATE_PATH):
+        """Write the state to `path`, replacing any older state only once it's fully written."""
+        meta = json.dumps({
+            'generation': self.generation,
+            'applied': self.applied,
+            'last_log_day': None if self.last_log_day is None else int(self.last_log_day),
+        })
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as state_file:
+            np.savez(
+                state_file,
+                meta=np.array(meta),
+                ulog_count=self.ulog.count,
+                ulog_sum=self.ulog.sum,
+                ulog_sumsq=self.ulog.sumsq,
+                ulog_min=self.ulog.min,
+                ulog_max=self.ulog.max,
+                last_log_date=self.last_log_date,
+                transaction_count=self.transaction_count,
+                transaction_sums=self.transaction_sums,
+                transaction_nonnull=self.transaction_nonnull,
+                last_transaction_date=self.last_transaction_date,
+                last_expire_date=self.last_expire_date,
+                recent_ids=self.recent_ids,
+                recent_days=self.recent_days,
+                recent_values=self.recent_values,
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=FEATURE_STATE_PATH):
+        state = cls()
+        with np.load(path) as saved:
+            meta = json.loads(str(saved['meta']))
+            if meta['generation'] != state.generation:
+                raise ValueError(
+                    "{} was built with a different msno dictionary; delete it and apply the full "
+                    "history again".format(path)
+                )
+            if 'recent_ids' not in saved.files:
+                raise ValueError(
+                    "{} has no recent log rows for the windowed features; delete it and apply the "
+                    "full history again".format(path)
+                )
+            state.applied = meta['applied']
+            state.last_log_day = meta['last_log_day']
+            state.ulog = UlogAccumulator(np.arange(len(saved['ulog_count'])))
+            state.ulog.count = saved['ulog_count']
+            state.ulog.sum = saved['ulog_sum']
+            state.ulog.sumsq = saved['ulog_sumsq']
+            state.ulog.min = saved['ulog_min']
+            state.ulog.max = saved['ulog_max']
+            state.last_log_date = saved['last_log_date']
+            state.transaction_count = saved['transaction_count']
+            state.transaction_sums = saved['transaction_sums']
+            state.transaction_nonnull = saved['transaction_nonnull']
+            state.last_transaction_date = saved['last_transaction_date']
+            state.last_expire_date = saved['last_expire_date']
+            state.recent_ids = saved['recent_ids']
+            state.recent_days = saved['recent_days']
+            state.recent_values = saved['recent_values']
+        return state
+
+
+def load_feature_state(state_path=FEATURE_STATE_PATH):
+    """Load the saved state, or return an empty one if nothing was saved yet."""
+    if os.path.isfile(state_path):
+        return FeatureState.load(state_path)
+    return FeatureState()
+
+
+@profiled()
+def apply_delta(ulogs_csv_path=None, transactions_csv_path=None, state_path=FEATURE_STATE_PATH):
+    """Fold new user log and/or transaction files into the saved state, and save it.
+
+    The time taken is proportional to the size of the new files, not of the history. To start a
+    state from scratch, apply the full history files first ('user_logs.csv', 'transactions.csv').
+    Files that were applied before (by content) are skipped.
+
+    Returns:
+        The updated `FeatureState`.
+    """
+    state = load_feature_state(state_path)
+    deltas = [
+        ('user_logs', ulogs_csv_path, state.add_user_logs),
+        ('transactions', transactions_csv_path, state.add_transactions),
+    ]
+    for kind, csv_path, add_fn in deltas:
+        if csv_path is None:
+            continue
+        delta_fingerprint = fingerprint(kind, file_fingerprint(csv_path, hash_contents=True))
+        if delta_fingerprint in state.applied:
+            print("{} was already applied, skipping it".format(csv_path))
+            continue
+        add_fn(csv_path)
+        state.applied.append(delta_fingerprint)
+    state.save(state_path)
+    print("All done updating {}!".format(state_path))
+    return state
+
+
+def write_ulog_features_from_state(state, validation=False, windows=ULOG_WINDOWS):
+    """Write 'train_ulog_features.csv' (or the validation one) from the state, not the logs.
+
+    The columns are the same as `get_or_build_ulog_features_df` writes with the same `windows`.
+    """
+    labels_csv_path = VALIDATION_CSV_PATH if validation else TRAIN_CSV_PATH
+    ulog_path = VALIDATION_ULOG_PATH if validation else TRAIN_ULOG_PATH
+    msnos = read_csv_with_schema(labels_csv_path, LABELS_SCHEMA, usecols=['msno']).msno.values
+    ulog_df = state.ulog_features_df(msnos)
+    if windows:
+        window_df = state.windowed_ulog_features_df(msnos, windows)
+        ulog_df = pd.merge(ulog_df, window_df, how='left', on='msno')
+    ulog_df.to_csv(ulog_path, index=False)
+    print("All done writing to {}!".format(ulog_path))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fold daily deltas into the saved feature state")
+    parser.add_argument('--user-logs', help="A user log CSV to fold in")
+    parser.add_argument('--transactions', help="A transactions CSV to fold in")
+    parser.add_argument('--state', default=FEATURE_STATE_PATH)
+    parser.add_argument('--write-ulog-features', action='store_true',
+                        help="Rewrite the train/validation user log feature CSVs afterwards")
+    args = parser.parse_args()
+
+    state = apply_delta(args.user_logs, args.transactions, args.state)
+    if args.write_ulog_features:
+        write_ulog_features_from_state(state, validation=False)
+        write_ulog_features_from_state(state, validation=True)
+
+
+if __name__ == '__main__':
+    main()
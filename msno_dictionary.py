@@ -0,0 +1,117 @@
+"""A persisted msno -> int32 id dictionary, so frames can be keyed and joined on small ints.
+
+The msnos are 44-character base64 strings; as an object column they cost ~100 bytes a row and every
+merge on them hashes strings. Instead, every loader in `utils.py` swaps 'msno' for an int32
+'msno_id' as soon as a file is read, all joins and caches use the id, and the string is only put
+back on the frames handed to callers.
+
+The dictionary is a text file with one msno per line, where the line number is the id. It is
+append-only: msnos seen for the first time get the next free ids and are appended, so ids that are
+already in use (and cached frames keyed by them) never change. The first line holds a random
+generation tag, which goes into cache fingerprints so that caches keyed by a deleted and rebuilt
+dictionary are not reused.
+"""
+import os
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from profiling import annotate, profiled
+
+MSNO_DICTIONARY_PATH = './data/msno_dictionary.txt'
+MSNO_ID = 'msno_id'
+
+
+class MsnoDictionary(object):
+
+    def __init__(self, path=MSNO_DICTIONARY_PATH):
+        self.path = path
+        if os.path.isfile(path):
+            with open(path, 'r') as dictionary_file:
+                self.generation = dictionary_file.readline().split()[-1]
+                msnos = dictionary_file.read().split('\n')
+            msnos = [msno for msno in msnos if msno]
+        else:
+            self.generation = uuid.uuid4().hex
+            msnos = []
+            with open(path, 'w') as dictionary_file:
+                dictionary_file.write('# generation {}\n'.format(self.generation))
+        self.msnos = np.array(msnos, dtype=object)
+        self.index = pd.Index(self.msnos)
+
+    def __len__(self):
+        return len(self.msnos)
+
+    def add(self, msnos):
+        """Assign ids to any msnos not in the dictionary yet, and persist them."""
+        msnos = pd.unique(np.asarray(msnos, dtype=object))
+        new_msnos = msnos[self.index.get_indexer(msnos) < 0]
+        if not len(new_msnos):
+            return
+        if len(self.msnos) + len(new_msnos) > np.iinfo(np.int32).max:
+            raise ValueError("Too many msnos for int32 ids")
+        with open(self.path, 'a') as dictionary_file:
+            dictionary_file.write('\n'.join(new_msnos) + '\n')
+        self.msnos = np.concatenate([self.msnos, new_msnos])
+        self.index = pd.Index(self.msnos)
+
+    def encode(self, msnos, add_missing=True):
+        """Return the int32 ids of `msnos`.
+
+        Unknown msnos are added to the dictionary, or get the id -1 if `add_missing` is False.
+        """
+        msnos = np.asarray(msnos, dtype=object)
+        ids = self.index.get_indexer(msnos)
+        if add_missing and (ids < 0).any():
+            self.add(msnos[ids < 0])
+            ids = self.index.get_indexer(msnos)
+        return ids.astype(np.int32)
+
+    def decode(self, ids):
+        """Return the msno strings of int ids, as an object array."""
+        return self.msnos[np.asarray(ids)]
+
+
+_msno_dictionary = None
+
+
+def get_msno_dictionary():
+    global _msno_dictionary
+    if _msno_dictionary is None:
+        _msno_dictionary = MsnoDictionary()
+    return _msno_dictionary
+
+
+def encode_msno_column(df, add_missing=True):
+    """Replace the 'msno' column of `df` with an int32 'msno_id' column in the same position."""
+    position = df.columns.get_loc('msno')
+    ids = get_msno_dictionary().encode(df.msno.values, add_missing=add_missing)
+    df = df.drop('msno', axis=1)
+    df.insert(position, MSNO_ID, ids)
+    return df
+
+
+def restore_msno_column(df):
+    """Replace the 'msno_id' column of `df` with the msno strings, for handing frames to callers."""
+    if MSNO_ID not in df.columns:
+        return df
+    position = df.columns.get_loc(MSNO_ID)
+    msnos = get_msno_dictionary().decode(df[MSNO_ID].values)
+    df = df.drop(MSNO_ID, axis=1)
+    df.insert(position, 'msno', msnos)
+    return df
+
+
+@profiled('merge')
+def left_join_on_msno_id(left_df, right_df):
+    """Left join `right_df` onto `left_df` by 'msno_id' with an index lookup.
+
+    `right_df` must hold each msno_id at most once. Rows of `left_df` keep their order, and left
+    rows without a match get NaNs, like a left `pd.merge` on 'msno_id' would give them.
+    """
+    annotate(rows_in=len(left_df), right_rows=len(right_df))
+    right_df = right_df.set_index(MSNO_ID)
+    joined = right_df.reindex(left_df[MSNO_ID].values)
+    joined.index = left_df.index
+    return pd.concat([left_df, joined], axis=1)
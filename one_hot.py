@@ -0,0 +1,147 @@
+"""One-hot encoding of the categorical member columns into a `scipy.sparse` CSR block.
+
+`pd.get_dummies` learns its columns from whatever frame it's given, so train and validation frames
+can end up with different columns, and concatenating its dense uint8 output copies the whole frame.
+`SparseOneHotEncoder` learns the category vocabulary once (from the training users), can be saved
+and loaded so validation is encoded with exactly the same columns, and builds its output straight
+into CSR arrays: every row has at most one non-zero per categorical column, so the row pointers are
+a cumulative count and nothing is densified along the way.
+
+The CSR matrices can be handed to `xgboost.DMatrix` or to sklearn estimators as they are.
+"""
+import json
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+from features import USER_CATEGORICAL
+from profiling import profiled
+
+# One-hot columns are named '<prefix>_<value>', like `pd.get_dummies(column, prefix=prefix)` names
+# them. Gender has never been prefixed ('female', 'male', 'not_specified').
+ONE_HOT_PREFIXES = {
+    'gender': None,
+    'city': 'city',
+    'registered_via': 'registered_via',
+}
+
+
+def _factorize(column):
+    """Return (codes, uniques) for a column, like `pd.factorize`, with -1 codes for missing values.
+
+    Categorical columns use their own codes, so only the (few) categories are ever converted.
+    Numeric values (city, registered_via) come back as ints or floats depending on whether a join
+    introduced NaNs, so they are always returned as floats.
+    """
+    if column.dtype.name == 'category':
+        codes, uniques = column.cat.codes.values, column.cat.categories
+    else:
+        codes, uniques = pd.factorize(column)
+    if pd.api.types.is_numeric_dtype(uniques.dtype):
+        return codes, np.asarray(uniques, dtype=np.float64)
+    return codes, np.asarray(uniques, dtype=object)
+
+
+def _format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class SparseOneHotEncoder(object):
+    """Maps the categorical columns of a frame to a CSR matrix of one-hot indicators.
+
+    Values that weren't seen by `fit` (and missing values) get no indicator at all.
+    """
+
+    def __init__(self, columns=USER_CATEGORICAL):
+        self.columns = list(columns)
+        self.vocabularies = None
+
+    def fit(self, df):
+        """Learn the sorted, non-null values of every column in `df`."""
+        self.vocabularies = {}
+        for col in self.columns:
+            codes, uniques = _factorize(df[col])
+            # 'tolist' turns NumPy scalars into Python ones, which keeps the vocabulary JSON-able.
+            self.vocabularies[col] = sorted(uniques[np.unique(codes[codes >= 0])].tolist())
+        return self
+
+    @property
+    def feature_names(self):
+        names = []
+        for col in self.columns:
+            prefix = ONE_HOT_PREFIXES.get(col, col)
+            for value in self.vocabularies[col]:
+                value = _format_value(value)
+                names.append(value if prefix is None else '{}_{}'.format(prefix, value))
+        return names
+
+    @property
+    def feature_columns(self):
+        """The categorical column each of `feature_names` indicates a value of."""
+        return [col for col in self.columns for _ in self.vocabularies[col]]
+
+    def transform(self, df):
+        """Return the one-hot indicators of `df`, as a float32 CSR matrix with a row per row."""
+        if self.vocabularies is None:
+            raise ValueError("The encoder has to be fit (or loaded) before transforming")
+        num_rows = len(df)
+        # The column index of each row's indicator, per categorical column, or -1 for none.
+        indices = np.empty((num_rows, len(self.columns)), dtype=np.int32)
+        offset = 0
+        for j, col in enumerate(self.columns):
+            vocabulary = pd.Index(self.vocabularies[col])
+            codes, uniques = _factorize(df[col])
+            # Look the (few) unique values up in the vocabulary, then spread that over the rows.
+            unique_indices = np.append(vocabulary.get_indexer(uniques), -1)
+            column_indices = unique_indices[codes]
+            indices[:, j] = np.where(column_indices >= 0, column_indices + offset, -1)
+            offset += len(vocabulary)
+
+        present = indices >= 0
+        indptr = np.zeros(num_rows + 1, dtype=np.int64)
+        np.cumsum(present.sum(axis=1), out=indptr[1:])
+        # Row-major order keeps each row's column indices sorted, since the offsets only increase.
+        column_indices = indices[present]
+        data = np.ones(len(column_indices), dtype=np.float32)
+        return scipy.sparse.csr_matrix(
+            (data, column_indices, indptr),
+            shape=(num_rows, offset),
+        )
+
+    def fit_transform(self, df):
+        return self.fit(df).transform(df)
+
+    def save(self, path):
+        with open(path, 'w') as vocabulary_file:
+            json.dump({'columns': self.columns, 'vocabularies': self.vocabularies}, vocabulary_file)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as vocabulary_file:
+            saved = json.load(vocabulary_file)
+        encoder = cls(saved['columns'])
+        encoder.vocabularies = saved['vocabularies']
+        return encoder
+
+
+@profiled()
+def build_sparse_feature_matrix(df, encoder, exclude=('msno', 'is_churn')):
+    """Stack the numerical columns of `df` and its one-hot indicators into one CSR matrix.
+
+    Args:
+        df - A frame with the raw categorical columns, like the `for_vw=True` frames.
+        encoder - A fitted `SparseOneHotEncoder`.
+        exclude - Columns that aren't features.
+
+    Returns:
+        A (CSR matrix, feature names) tuple. The numerical columns come first, as float32.
+    """
+    numerical_cols = [
+        col for col in df.columns if col not in exclude and col not in encoder.columns
+    ]
+    numerical = scipy.sparse.csr_matrix(df[numerical_cols].values.astype(np.float32))
+    matrix = scipy.sparse.hstack([numerical, encoder.transform(df)], format='csr')
+    return matrix, numerical_cols + encoder.feature_names
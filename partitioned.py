@@ -0,0 +1,314 @@
+"""Build the train/validation feature frame out of core, one hash bucket of users at a time.
+
+`utils.get_or_build_training_or_validation_df` holds the members, the whole transactions table, the
+statistics and the user log features in memory at once. Here every input is instead streamed once
+and split by 'msno_id' into `num_buckets` on-disk buckets, so that all the rows of a user, in every
+input, land in the same bucket. Each bucket is then joined and featurized on its own (optionally in
+a process pool), exactly like the in-memory build does for all users, and written out as one part
+of a partitioned dataset:
+
+    ./data/partitioned/train_df.<fingerprint>/part-00000.feather
+    ./data/partitioned/train_df.<fingerprint>/part-00001.feather
+    ...
+
+The number of buckets is picked from the size of the inputs so that a bucket, times the number of
+workers, fits under `memory_limit_mb`. That ceiling covers the data being processed; the msno
+dictionary and the libraries themselves come on top of it. The bucketed inputs are kept under a
+fingerprint of the input file, the bucket count and the msno dictionary, so rebuilds with new
+features reuse them.
+
+Usage:
+    python partitioned.py --memory-limit-mb 1024 --workers 4 [--validation] [--for-vw]
+"""
+import argparse
+import glob
+import multiprocessing
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from cache import file_fingerprint, fingerprint
+from features import LABEL
+from msno_dictionary import MSNO_ID, encode_msno_column, get_msno_dictionary, restore_msno_column
+from profiling import annotate, profiled
+from schemas import (
+    LABELS_SCHEMA, MEMBERS_SCHEMA, READ_CHUNK_SIZE, TRANSACTIONS_SCHEMA, iter_csv_with_schema,
+)
+from utils import (
+    CACHE_BACKEND, MEMBERS_CSV_PATH, STATISTICS_FEATURE_STATE_PATH, TRAIN_CSV_PATH, TRAIN_ULOG_PATH,
+    TRANSACTIONS_CSV_PATH, VALIDATION_CSV_PATH, VALIDATION_ULOG_PATH, build_statistics_df,
+    categorize_member_columns,
+    features_fingerprint, get_or_fit_one_hot_encoder, join_training_features,
+    members_df_fingerprint, read_statistics_from_feature_state, transactions_fingerprint,
+)
+
+PARTITIONED_DATA_PATH = './data/partitioned'
+MEMORY_LIMIT_MB = 2048
+# Rough peak memory of joining and featurizing a bucket, per byte of CSV input in the bucket: the
+# parsed frames, the merge copies and the one-hot block.
+MEMORY_PER_CSV_BYTE = 4.
+# Rough peak memory per row of a CSV chunk being read and split up (wide parse plus msno strings).
+MEMORY_PER_CSV_ROW = 2048
+SUCCESS_MARKER = '_SUCCESS'
+
+
+def bucket_of(msno_ids, num_buckets):
+    """The bucket of each msno id. Ids are handed out in order of appearance, so this is even."""
+    return np.asarray(msno_ids) % num_buckets
+
+
+def choose_num_buckets(csv_paths, memory_limit_mb=MEMORY_LIMIT_MB, num_workers=1):
+    """The fewest buckets for which `num_workers` buckets at a time fit in `memory_limit_mb`."""
+    total_bytes = sum(os.path.getsize(path) for path in csv_paths if os.path.isfile(path))
+    bytes_per_worker = memory_limit_mb * 1024. * 1024. / num_workers
+    return max(1, int(np.ceil(total_bytes * MEMORY_PER_CSV_BYTE / bytes_per_worker)))
+
+
+def choose_chunksize(memory_limit_mb=MEMORY_LIMIT_MB):
+    """How many CSV rows to read at a time while partitioning, within `memory_limit_mb`."""
+    return int(min(READ_CHUNK_SIZE, memory_limit_mb * 1024 * 1024 // MEMORY_PER_CSV_ROW))
+
+
+def _part_path(bucket_dir, part):
+    return os.path.join(bucket_dir, 'part-{:05d}{}'.format(part, CACHE_BACKEND.extension))
+
+
+def _bucket_dir(partitions_path, bucket):
+    return os.path.join(partitions_path, 'bucket-{:05d}'.format(bucket))
+
+
+def _empty_path(partitions_path):
+    return os.path.join(partitions_path, 'empty' + CACHE_BACKEND.extension)
+
+
+@profiled()
+def partition_csv(csv_path, schema, partitions_path, num_buckets, chunksize=READ_CHUNK_SIZE,
+                  add_missing=False):
+    """Split a raw CSV into `num_buckets` on-disk buckets of msno-id keyed frames.
+
+    Args:
+        csv_path - A CSV with an 'msno' column.
+        schema - The schema to read it with (see 'schemas.py'), or {} to infer dtypes.
+        partitions_path - The directory to write to. Bucket b gets a 'bucket-<b>' directory of
+                          parts, one per chunk of the CSV that had rows in that bucket.
+        num_buckets - The number of buckets.
+        chunksize - Number of rows read into memory at a time.
+        add_missing - Whether msnos not in the dictionary yet are added to it. If not, their rows
+                      are dropped, since no user we build features for can join onto them.
+    """
+    if os.path.isfile(os.path.join(partitions_path, SUCCESS_MARKER)):
+        return
+    if os.path.isdir(partitions_path):
+        # Left behind by an interrupted run.
+        shutil.rmtree(partitions_path)
+    for bucket in range(num_buckets):
+        os.makedirs(_bucket_dir(partitions_path, bucket))
+
+    print("Partitioning {} into {} buckets...".format(csv_path, num_buckets))
+    num_rows = 0
+    for part, chunk in enumerate(iter_csv_with_schema(csv_path, schema, chunksize=chunksize)):
+        chunk = encode_msno_column(chunk, add_missing=add_missing)
+        if part == 0:
+            # Keeps the columns and dtypes around for buckets that end up with no rows at all.
+            CACHE_BACKEND.write(chunk.iloc[:0], _empty_path(partitions_path))
+        chunk = chunk[chunk[MSNO_ID].values >= 0]
+        buckets = bucket_of(chunk[MSNO_ID].values, num_buckets)
+        order = np.argsort(buckets, kind='mergesort')
+        sorted_buckets = buckets[order]
+        starts = np.flatnonzero(np.r_[True, sorted_buckets[1:] != sorted_buckets[:-1]])
+        ends = np.r_[starts[1:], len(order)]
+        for start, end in zip(starts, ends):
+            bucket_df = chunk.iloc[order[start:end]]
+            bucket_dir = _bucket_dir(partitions_path, sorted_buckets[start])
+            CACHE_BACKEND.write(bucket_df, _part_path(bucket_dir, part))
+        num_rows += len(chunk)
+        print("Partitioned {} rows of {} so far...".format(num_rows, csv_path))
+    open(os.path.join(partitions_path, SUCCESS_MARKER), 'w').close()
+    annotate(csv_path=csv_path, rows_in=num_rows)
+    print("Finished partitioning {}".format(csv_path))
+
+
+def read_bucket(partitions_path, bucket):
+    """Read every part of one bucket written by `partition_csv` into one frame."""
+    bucket_dir = _bucket_dir(partitions_path, bucket)
+    part_paths = sorted(glob.glob(os.path.join(bucket_dir, 'part-*' + CACHE_BACKEND.extension)))
+    if not part_paths:
+        return CACHE_BACKEND.read(_empty_path(partitions_path))
+    return pd.concat([CACHE_BACKEND.read(path) for path in part_paths], ignore_index=True)
+
+
+def get_or_partition_inputs(validation, num_buckets, chunksize=READ_CHUNK_SIZE):
+    """Partition the labels, members, transactions and user log features, unless already done.
+
+    Returns:
+        A dict of input name -> partitions directory.
+    """
+    labels_csv_path = VALIDATION_CSV_PATH if validation else TRAIN_CSV_PATH
+    ulog_path = VALIDATION_ULOG_PATH if validation else TRAIN_ULOG_PATH
+    # The labels come first, so that their new msnos are in the dictionary for the others.
+    inputs = [
+        ('labels', labels_csv_path, LABELS_SCHEMA, True),
+        ('members', MEMBERS_CSV_PATH, MEMBERS_SCHEMA, False),
+        ('transactions', TRANSACTIONS_CSV_PATH, TRANSACTIONS_SCHEMA, False),
+        ('ulog', ulog_path, {}, False),
+    ]
+    if STATISTICS_FEATURE_STATE_PATH is not None:
+        # The statistics come from the feature state, so the transactions aren't needed.
+        inputs = [input_args for input_args in inputs if input_args[0] != 'transactions']
+    partitions_paths = {}
+    for name, csv_path, schema, add_missing in inputs:
+        # The other inputs drop the rows of msnos that aren't in the dictionary, so their buckets
+        # are only good for as long as the dictionary doesn't grow.
+        partitions_path = os.path.join(PARTITIONED_DATA_PATH, '{}.{}'.format(
+            os.path.splitext(os.path.basename(csv_path))[0],
+            fingerprint(
+                'partitions', file_fingerprint(csv_path), num_buckets,
+                get_msno_dictionary().generation,
+                None if add_missing else len(get_msno_dictionary()),
+            ),
+        ))
+        partition_csv(csv_path, schema, partitions_path, num_buckets, chunksize, add_missing)
+        partitions_paths[name] = partitions_path
+    return partitions_paths
+
+
+@profiled()
+def build_bucket(bucket_args):
+    """Join and featurize the users of one bucket, and write them out as one part."""
+    bucket, partitions_paths, validation, for_vw, encoder, output_path = bucket_args
+    df = read_bucket(partitions_paths['labels'], bucket)
+    if validation:
+        df.drop(LABEL, axis=1, inplace=True)
+    members_df = categorize_member_columns(read_bucket(partitions_paths['members'], bucket))
+    if 'transactions' in partitions_paths:
+        # Like `get_or_build_statistics_df`, only the transactions of the bucket's users are needed.
+        df_transactions = pd.merge(
+            df[[MSNO_ID]], read_bucket(partitions_paths['transactions'], bucket),
+            how='left', on=MSNO_ID,
+        )
+        stats_df = build_statistics_df(df_transactions)
+        del df_transactions
+    else:
+        stats_df = read_statistics_from_feature_state(df[MSNO_ID].values)
+    ulog_df = read_bucket(partitions_paths['ulog'], bucket)
+    df = join_training_features(df, members_df, stats_df, ulog_df, for_vw, encoder)
+    del members_df, stats_df, ulog_df
+    CACHE_BACKEND.write(df, _part_path(output_path, bucket))
+    annotate(bucket=bucket, rows_out=len(df))
+    return bucket, len(df)
+
+
+@profiled()
+def build_partitioned_training_or_validation_df(validation=False, for_vw=False,
+                                                memory_limit_mb=MEMORY_LIMIT_MB, num_workers=1,
+                                                num_buckets=None, force_build=False):
+    """Build the features of the train (or validation) users as a partitioned dataset.
+
+    The parts hold the same columns as `get_or_build_training_or_validation_df` returns, keyed by
+    'msno_id', and together the same rows (in bucket order rather than label file order).
+
+    Args:
+        validation - Build the validation users instead of the training ones.
+        for_vw - Keep the raw categorical columns instead of one-hot encoding them.
+        memory_limit_mb - Roughly how much memory the build may use, across all workers.
+        num_workers - With more than one worker, buckets are built in a process pool.
+        num_buckets - How many buckets to split the users into. By default the fewest buckets that
+                      fit `memory_limit_mb`.
+        force_build - Rebuild the dataset even if one was built from the same inputs before.
+
+    Returns:
+        The directory holding the parts; see `iter_partitioned_df` and `read_partitioned_df`.
+    """
+    labels_csv_path = VALIDATION_CSV_PATH if validation else TRAIN_CSV_PATH
+    ulog_path = VALIDATION_ULOG_PATH if validation else TRAIN_ULOG_PATH
+    if num_buckets is None:
+        num_buckets = choose_num_buckets(
+            [labels_csv_path, MEMBERS_CSV_PATH, TRANSACTIONS_CSV_PATH, ulog_path],
+            memory_limit_mb, num_workers,
+        )
+    encoder = None
+    if not for_vw:
+        encoder = get_or_fit_one_hot_encoder()
+    output_path = os.path.join(PARTITIONED_DATA_PATH, '{}.{}'.format(
+        'validation_df' if validation else 'train_df',
+        fingerprint(
+            'partitioned_df',
+            file_fingerprint(labels_csv_path),
+            file_fingerprint(ulog_path),
+            transactions_fingerprint(),
+            members_df_fingerprint(),
+            features_fingerprint(),
+            for_vw,
+            None if encoder is None else encoder.vocabularies,
+            num_buckets,
+        ),
+    ))
+    if os.path.isfile(os.path.join(output_path, SUCCESS_MARKER)) and not force_build:
+        return output_path
+    if os.path.isdir(output_path):
+        shutil.rmtree(output_path)
+    os.makedirs(output_path)
+
+    partitions_paths = get_or_partition_inputs(
+        validation, num_buckets, choose_chunksize(memory_limit_mb),
+    )
+    bucket_args = [
+        (bucket, partitions_paths, validation, for_vw, encoder, output_path)
+        for bucket in range(num_buckets)
+    ]
+    print("Building {} buckets with {} workers...".format(num_buckets, num_workers))
+    if num_workers > 1:
+        pool = multiprocessing.Pool(num_workers)
+        built_buckets = pool.imap_unordered(build_bucket, bucket_args)
+    else:
+        pool = None
+        built_buckets = (build_bucket(args) for args in bucket_args)
+    try:
+        num_rows = 0
+        for num_built, (bucket, bucket_rows) in enumerate(built_buckets, 1):
+            num_rows += bucket_rows
+            print("Built bucket {} ({} of {}, {} users so far)".format(
+                bucket, num_built, num_buckets, num_rows,
+            ))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    open(os.path.join(output_path, SUCCESS_MARKER), 'w').close()
+    print("All done writing {} users to {}!".format(num_rows, output_path))
+    return output_path
+
+
+def iter_partitioned_df(output_path, columns=None):
+    """Yield the parts of a partitioned dataset one at a time, with the 'msno' strings restored."""
+    if columns is not None:
+        columns = [MSNO_ID if col == 'msno' else col for col in columns]
+    part_paths = glob.glob(os.path.join(output_path, 'part-*' + CACHE_BACKEND.extension))
+    for part_path in sorted(part_paths):
+        yield restore_msno_column(CACHE_BACKEND.read(part_path, columns=columns))
+
+
+def read_partitioned_df(output_path, columns=None):
+    """Read a whole partitioned dataset into one frame (only when it does fit in memory)."""
+    return pd.concat(list(iter_partitioned_df(output_path, columns)), ignore_index=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the feature frame one bucket at a time")
+    parser.add_argument('--validation', action='store_true')
+    parser.add_argument('--for-vw', action='store_true')
+    parser.add_argument('--memory-limit-mb', type=int, default=MEMORY_LIMIT_MB)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--num-buckets', type=int, default=None)
+    parser.add_argument('--force-build', action='store_true')
+    args = parser.parse_args()
+    build_partitioned_training_or_validation_df(
+        args.validation, args.for_vw, args.memory_limit_mb, args.workers, args.num_buckets,
+        args.force_build,
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,406 @@
+"""Stage-level timing and memory instrumentation for the feature pipeline, written to a JSON trace.
+
+Pipeline steps are wrapped in stages, either with the `profiled` decorator (used on the
+`get_or_build_*` functions, the CSV reads and the export loops) or the `stage` context manager:
+
+    with stage('merge_members', rows_in=len(df)) as record:
+        df = ...
+        record.rows_out = len(df)
+
+Profiling is off unless a trace path is set, through `enable_profiling` or the environment:
+
+    WSDM_PROFILE_TRACE=./data/trace.jsonl - Append one JSON record per finished stage to this file.
+    WSDM_PROFILE_TRACEMALLOC=1 - Also record Python allocations per stage with `tracemalloc`
+                                 (NumPy buffers included), which slows everything down a lot.
+    WSDM_PROFILE_CPROFILE_DIR=./data/profiles - Dump a cProfile of every outermost stage there.
+
+Every record has the stage's name and its path through the enclosing stages, the wall and CPU
+time, rows in/out where they're known, RSS at the start and end, the peak RSS while the stage ran
+(Linux only), the tracemalloc growth and peak if enabled, and a run id shared by all the stages of
+one process. Pool workers inherit the settings and append to the same trace, told apart by their
+pid. When disabled, a stage costs a function call and a couple of attribute lookups.
+
+Usage:
+    python profiling.py summary ./data/trace.jsonl
+    python profiling.py compare ./data/last_night.jsonl ./data/tonight.jsonl --threshold 0.2
+"""
+import argparse
+import contextlib
+import cProfile
+import functools
+import json
+import os
+import re
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+
+PROFILE_TRACE_ENV = 'WSDM_PROFILE_TRACE'
+PROFILE_TRACEMALLOC_ENV = 'WSDM_PROFILE_TRACEMALLOC'
+PROFILE_CPROFILE_DIR_ENV = 'WSDM_PROFILE_CPROFILE_DIR'
+# Stages whose wall time or peak memory grew by more than this fraction count as regressions.
+REGRESSION_THRESHOLD = 0.2
+# Below these, differences are noise rather than regressions.
+MIN_COMPARED_SECS = 0.5
+MIN_COMPARED_MB = 50.
+
+
+class _ProfilingConfig(object):
+
+    def __init__(self):
+        self.trace_path = os.environ.get(PROFILE_TRACE_ENV) or None
+        self.trace_malloc = os.environ.get(PROFILE_TRACEMALLOC_ENV, '') not in ('', '0')
+        self.cprofile_dir = os.environ.get(PROFILE_CPROFILE_DIR_ENV) or None
+        self.run_id = uuid.uuid4().hex[:12]
+        self.num_stages = 0
+        self.lock = threading.Lock()
+
+
+_config = _ProfilingConfig()
+# The stages open on each thread, innermost last.
+_open_stages = threading.local()
+
+
+def enable_profiling(trace_path, trace_malloc=False, cprofile_dir=None):
+    """Start recording stages to `trace_path` (JSON lines, appended to)."""
+    _config.trace_path = trace_path
+    _config.trace_malloc = trace_malloc
+    _config.cprofile_dir = cprofile_dir
+    # Pool workers started from here on pick the settings up from the environment.
+    os.environ[PROFILE_TRACE_ENV] = trace_path
+    os.environ[PROFILE_TRACEMALLOC_ENV] = '1' if trace_malloc else ''
+    os.environ[PROFILE_CPROFILE_DIR_ENV] = cprofile_dir or ''
+
+
+def disable_profiling():
+    _config.trace_path = None
+    for env_var in [PROFILE_TRACE_ENV, PROFILE_TRACEMALLOC_ENV, PROFILE_CPROFILE_DIR_ENV]:
+        os.environ.pop(env_var, None)
+
+
+def profiling_enabled():
+    return _config.trace_path is not None
+
+
+def _read_proc_status_kb(field):
+    """A memory field of /proc/self/status (e.g. 'VmRSS', 'VmHWM') in KB, or None off Linux."""
+    try:
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    """Restart the kernel's peak RSS (VmHWM) counter from the current RSS. False if we can't."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def _kb_to_mb(kb):
+    return None if kb is None else round(kb / 1024., 1)
+
+
+class StageRecord(object):
+    """What's known about a running stage; set `rows_in`/`rows_out` or `fields` from inside it."""
+
+    def __init__(self, name, rows_in=None, fields=None):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.fields = dict(fields or {})
+        # The highest RSS seen so far, since child stages reset the kernel's counter.
+        self.peak_rss_kb = None
+        self.peak_traced = 0
+        self.profiler = None
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+
+class _NullStageRecord(StageRecord):
+    # Handed out while profiling is off, so instrumented code never has to check.
+
+    def __init__(self):
+        StageRecord.__init__(self, None)
+
+
+def _stage_stack():
+    stack = getattr(_open_stages, 'stack', None)
+    if stack is None:
+        stack = _open_stages.stack = []
+    return stack
+
+
+def _write_trace_record(trace_record):
+    line = json.dumps(trace_record, sort_keys=True, default=str) + '\n'
+    with _config.lock:
+        # One write per record on an O_APPEND file, so concurrent processes don't interleave.
+        with open(_config.trace_path, 'a') as trace_file:
+            trace_file.write(line)
+
+
+def _cprofile_path(seq, name):
+    safe_name = re.sub(r'[^A-Za-z0-9_.-]+', '_', name)
+    return os.path.join(
+        _config.cprofile_dir, '{}-{:04d}-{}.prof'.format(_config.run_id, seq, safe_name),
+    )
+
+
+@contextlib.contextmanager
+def stage(name, rows_in=None, **fields):
+    """Record one pipeline stage; see the module docstring for what ends up in the trace."""
+    if not profiling_enabled():
+        yield _NullStageRecord()
+        return
+
+    stack = _stage_stack()
+    parent = stack[-1] if stack else None
+    on_main_thread = threading.current_thread() is threading.main_thread()
+    record = StageRecord(name, rows_in, fields)
+    with _config.lock:
+        _config.num_stages += 1
+        seq = _config.num_stages
+
+    # The peak counters are per process, so only main-thread stages reset them (and fold what
+    # they had seen into the enclosing stage first).
+    track_peaks = on_main_thread
+    rss_start_kb = _read_proc_status_kb('VmRSS')
+    if track_peaks:
+        if parent is not None:
+            parent.peak_rss_kb = max(parent.peak_rss_kb or 0, _read_proc_status_kb('VmHWM') or 0)
+        peaks_reset = _reset_peak_rss()
+        record.peak_rss_kb = rss_start_kb
+    if _config.trace_malloc:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        traced_start, traced_peak = tracemalloc.get_traced_memory()
+        if track_peaks:
+            if parent is not None:
+                parent.peak_traced = max(parent.peak_traced, traced_peak)
+            tracemalloc.reset_peak()
+
+    # Only one profiler can be active at a time, so nested stages share the outermost's profile.
+    if _config.cprofile_dir and on_main_thread and not any(s.profiler for s in stack):
+        if not os.path.isdir(_config.cprofile_dir):
+            os.makedirs(_config.cprofile_dir)
+        record.profiler = cProfile.Profile()
+    profiler = record.profiler
+
+    cpu_clock = time.process_time if on_main_thread else time.thread_time
+    started_at = time.time()
+    start_cpu = cpu_clock()
+    stack.append(record)
+    if profiler is not None:
+        profiler.enable()
+    error = None
+    try:
+        yield record
+    except BaseException as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+        raise
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        wall_secs = time.time() - started_at
+        cpu_secs = cpu_clock() - start_cpu
+        stack.pop()
+        trace_record = {
+            'run_id': _config.run_id,
+            'pid': os.getpid(),
+            'seq': seq,
+            'name': name,
+            'path': '/'.join([s.name for s in stack] + [name]),
+            'depth': len(stack),
+            'started_at': started_at,
+            'wall_secs': round(wall_secs, 6),
+            'cpu_secs': round(cpu_secs, 6),
+            'rows_in': record.rows_in,
+            'rows_out': record.rows_out,
+            'rss_start_mb': _kb_to_mb(rss_start_kb),
+            'rss_end_mb': _kb_to_mb(_read_proc_status_kb('VmRSS')),
+            'peak_rss_mb': None,
+            'error': error,
+        }
+        if track_peaks:
+            peak_rss_kb = max(record.peak_rss_kb or 0, _read_proc_status_kb('VmHWM') or 0)
+            trace_record['peak_rss_mb'] = _kb_to_mb(peak_rss_kb or None)
+            # Without a resettable counter, that's the peak of the whole process so far.
+            trace_record['peak_rss_is_process_peak'] = not peaks_reset
+        if _config.trace_malloc:
+            traced_end, traced_peak = tracemalloc.get_traced_memory()
+            if track_peaks:
+                traced_peak = max(traced_peak, record.peak_traced)
+                trace_record['tracemalloc_peak_mb'] = round((traced_peak - traced_start) / 1e6, 1)
+            trace_record['tracemalloc_delta_mb'] = round((traced_end - traced_start) / 1e6, 1)
+        if profiler is not None:
+            cprofile_path = _cprofile_path(seq, name)
+            profiler.dump_stats(cprofile_path)
+            trace_record['cprofile_path'] = cprofile_path
+        trace_record.update(record.fields)
+        _write_trace_record(trace_record)
+
+
+def annotate(**fields):
+    """Add fields (say, `cache_hit=True` or `rows_in=...`) to the innermost open stage, if any."""
+    if not profiling_enabled():
+        return
+    stack = _stage_stack()
+    if not stack:
+        return
+    record = stack[-1]
+    for key, value in fields.items():
+        if key in ('rows_in', 'rows_out'):
+            setattr(record, key, value)
+        else:
+            record.fields[key] = value
+
+
+def _num_rows(result):
+    # DataFrames, arrays and sparse matrices all have a shape; (matrix, ...) tuples count too.
+    if isinstance(result, tuple) and result:
+        result = result[0]
+    shape = getattr(result, 'shape', None)
+    if shape:
+        return int(shape[0])
+    return None
+
+
+def profiled(name=None):
+    """Decorator running a function as a stage (named after it by default).
+
+    When the function returns something with a shape, its number of rows is the stage's 'rows_out'
+    unless the function set one itself.
+    """
+    def decorator(fn):
+        stage_name = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not profiling_enabled():
+                return fn(*args, **kwargs)
+            with stage(stage_name) as record:
+                result = fn(*args, **kwargs)
+                if record.rows_out is None:
+                    record.rows_out = _num_rows(result)
+                return result
+        return wrapper
+    return decorator
+
+
+def read_trace(trace_path, run_id=None):
+    """Read the records of a trace, optionally only those of one run."""
+    records = []
+    with open(trace_path) as trace_file:
+        for line in trace_file:
+            if not line.strip():
+                continue
+            trace_record = json.loads(line)
+            if run_id is None or trace_record['run_id'] == run_id:
+                records.append(trace_record)
+    return records
+
+
+def summarize_trace(records):
+    """Total up the records per stage path.
+
+    Returns:
+        A dict of stage path -> {'calls', 'wall_secs', 'cpu_secs', 'peak_rss_mb', 'rows_in',
+        'rows_out'}, with times summed and the peak being the highest of any call.
+    """
+    summary = {}
+    for trace_record in records:
+        totals = summary.setdefault(trace_record['path'], {
+            'calls': 0, 'wall_secs': 0., 'cpu_secs': 0., 'peak_rss_mb': None,
+            'rows_in': None, 'rows_out': None,
+        })
+        totals['calls'] += 1
+        totals['wall_secs'] += trace_record['wall_secs']
+        totals['cpu_secs'] += trace_record['cpu_secs']
+        if trace_record.get('peak_rss_mb') is not None:
+            totals['peak_rss_mb'] = max(totals['peak_rss_mb'] or 0., trace_record['peak_rss_mb'])
+        for key in ['rows_in', 'rows_out']:
+            if trace_record.get(key) is not None:
+                totals[key] = (totals[key] or 0) + trace_record[key]
+    return summary
+
+
+def _format_optional(value, fmt):
+    return '-' if value is None else fmt.format(value)
+
+
+def print_summary(summary, out=sys.stdout):
+    out.write("{:<60} {:>6} {:>10} {:>10} {:>10} {:>12} {:>12}\n".format(
+        'stage', 'calls', 'wall s', 'cpu s', 'peak MB', 'rows in', 'rows out',
+    ))
+    for path, totals in sorted(summary.items()):
+        out.write("{:<60} {:>6} {:>10.2f} {:>10.2f} {:>10} {:>12} {:>12}\n".format(
+            path[-60:], totals['calls'], totals['wall_secs'], totals['cpu_secs'],
+            _format_optional(totals['peak_rss_mb'], '{:.1f}'),
+            _format_optional(totals['rows_in'], '{}'),
+            _format_optional(totals['rows_out'], '{}'),
+        ))
+
+
+def find_regressions(base_summary, new_summary, threshold=REGRESSION_THRESHOLD):
+    """List (stage path, metric, base value, new value) for every stage that got worse.
+
+    Wall time and peak RSS count as worse when they grew by more than `threshold` (a fraction) and
+    by more than `MIN_COMPARED_SECS`/`MIN_COMPARED_MB`. Stages in only one summary are skipped.
+    """
+    regressions = []
+    for path in sorted(set(base_summary) & set(new_summary)):
+        for metric, min_difference in [('wall_secs', MIN_COMPARED_SECS),
+                                       ('peak_rss_mb', MIN_COMPARED_MB)]:
+            base_value = base_summary[path][metric]
+            new_value = new_summary[path][metric]
+            if base_value is None or new_value is None:
+                continue
+            if new_value - base_value > max(min_difference, threshold * base_value):
+                regressions.append((path, metric, base_value, new_value))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize or compare pipeline profiling traces")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    summary_parser = subparsers.add_parser('summary', help="Per-stage totals of a trace")
+    summary_parser.add_argument('trace')
+    summary_parser.add_argument('--run-id', help="Only this run (default: every run in the trace)")
+    compare_parser = subparsers.add_parser(
+        'compare',
+        help="Stages that got slower or bigger; exits with 1 if there are any",
+    )
+    compare_parser.add_argument('base_trace')
+    compare_parser.add_argument('new_trace')
+    compare_parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD)
+    args = parser.parse_args()
+
+    if args.command == 'summary':
+        print_summary(summarize_trace(read_trace(args.trace, args.run_id)))
+        return
+
+    # Meant for one trace file per rebuild (pool workers append to their parent's file).
+    summaries = [summarize_trace(read_trace(path)) for path in [args.base_trace, args.new_trace]]
+    regressions = find_regressions(summaries[0], summaries[1], args.threshold)
+    for path, metric, base_value, new_value in regressions:
+        print("{}: {} {:.2f} -> {:.2f} ({:+.0%})".format(
+            path, metric, base_value, new_value, new_value / base_value - 1,
+        ))
+    if not regressions:
+        print("No regressions over {:.0%}".format(args.threshold))
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""Column dtypes for every raw CSV we read, and a loader that applies them.
+
+A bare `pd.read_csv` gives int64/float64/object columns for data that fits in a byte or two. The
+schemas below pick the narrowest dtype that holds the real KKBox value ranges, and
+`read_csv_with_schema` checks every value actually fits before downcasting, instead of letting
+numpy silently wrap around (300 read as uint8 comes back as 44).
+
+Schema values are a numpy dtype, 'category', 'object', or `DATE` for '%Y%m%d' integer dates, which
+are parsed arithmetically rather than through strings.
+"""
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from profiling import annotate, profiled
+from sampling import open_csv
+
+DATE = 'date'
+READ_CHUNK_SIZE = 1024 * 1024
+
+LABELS_SCHEMA = {
+    'msno': 'object',
+    'is_churn': np.uint8,
+}
+
+MEMBERS_SCHEMA = {
+    'msno': 'object',
+    'city': np.uint8,
+    # 'bd' (age) is full of garbage like -7000 and 2016, so it needs the wider type.
+    'bd': np.int16,
+    'gender': 'category',
+    'registered_via': np.int8,
+    'registration_init_time': DATE,
+}
+
+TRANSACTIONS_SCHEMA = {
+    'msno': 'object',
+    'payment_method_id': np.uint8,
+    'payment_plan_days': np.uint16,
+    # List prices and payments go up to ~2000, which overflows a uint8.
+    'plan_list_price': np.uint16,
+    'actual_amount_paid': np.uint16,
+    'is_auto_renew': np.uint8,
+    'transaction_date': DATE,
+    'membership_expire_date': DATE,
+    'is_cancel': np.uint8,
+}
+
+USER_LOGS_SCHEMA = {
+    'msno': 'object',
+    'date': DATE,
+    'num_25': np.uint32,
+    'num_50': np.uint32,
+    'num_75': np.uint32,
+    'num_985': np.uint32,
+    'num_100': np.uint32,
+    'num_unq': np.uint32,
+    # Has absurd outliers in both directions, keep full precision.
+    'total_secs': np.float64,
+}
+
+
+def parse_yyyymmdd(column):
+    """Convert a Series of '%Y%m%d' integers (e.g. 20170131) to datetime64.
+
+    Columns that are already datetime64 are returned as is. Invalid dates become NaT.
+    """
+    if np.issubdtype(column.dtype, np.datetime64):
+        return column
+    values = column.values.astype(np.int64)
+    parts = pd.DataFrame({
+        'year': values // 10000,
+        'month': values // 100 % 100,
+        'day': values % 100,
+    }, index=column.index)
+    return pd.to_datetime(parts, errors='coerce')
+
+
+def downcast_column(column, dtype):
+    """Cast a freshly read column to its schema dtype, checking integers fit first."""
+    if dtype == DATE:
+        return parse_yyyymmdd(column)
+    if dtype in ('category', 'object'):
+        return column.astype(dtype)
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'iu':
+        if column.isnull().any():
+            raise ValueError("Column '{}' has missing values and can't be stored as {}".format(
+                column.name, dtype,
+            ))
+        if len(column):
+            info = np.iinfo(dtype)
+            low, high = column.min(), column.max()
+            if low < info.min or high > info.max:
+                raise ValueError("Column '{}' holds values in [{}, {}], which overflow {}".format(
+                    column.name, low, high, dtype,
+                ))
+    return column.astype(dtype)
+
+
+def empty_frame_with_schema(csv_path, schema, usecols=None, **read_csv_kwargs):
+    """An empty DataFrame with the columns of `csv_path`'s header and the dtypes from `schema`."""
+    df = pd.read_csv(csv_path, usecols=usecols, nrows=0, **read_csv_kwargs)
+    for col in df.columns:
+        if col in schema:
+            df[col] = downcast_column(df[col], schema[col])
+    return df
+
+
+def iter_csv_with_schema(csv_path, schema, usecols=None, chunksize=READ_CHUNK_SIZE,
+                         sample_fraction=None, **read_csv_kwargs):
+    """Read a CSV `chunksize` rows at a time, yielding each chunk with the dtypes from `schema`.
+
+    Categorical columns get the categories of their own chunk only. With `sample_fraction`, only
+    the rows of the users in that sample (see 'sampling.py') are parsed at all.
+    """
+    # Integers are read wide so overflow can be detected; categories are read as such directly.
+    read_dtypes = {}
+    for col, dtype in schema.items():
+        if dtype == 'category':
+            read_dtypes[col] = 'category'
+        elif dtype == 'object':
+            read_dtypes[col] = object
+        elif dtype != DATE and np.dtype(dtype).kind == 'f':
+            read_dtypes[col] = np.float64
+    with open_csv(csv_path, sample_fraction) as csv_source:
+        reader = pd.read_csv(
+            csv_source,
+            usecols=usecols,
+            dtype=read_dtypes,
+            chunksize=chunksize,
+            **read_csv_kwargs
+        )
+        for chunk in reader:
+            for col in chunk.columns:
+                if col in schema and schema[col] != 'category':
+                    chunk[col] = downcast_column(chunk[col], schema[col])
+            yield chunk
+
+
+@profiled('read_csv')
+def read_csv_with_schema(csv_path, schema, usecols=None, chunksize=READ_CHUNK_SIZE,
+                         sample_fraction=None, **read_csv_kwargs):
+    """Read a CSV into a DataFrame with the dtypes from `schema`.
+
+    The file is read `chunksize` rows at a time and every chunk is validated and downcast before the
+    next is read, so the wide int64/float64 columns never exist for more than one chunk at a time.
+    Columns not in the schema are left to pandas' inference. With `sample_fraction`, only the rows
+    of the users in that sample are read. An input without any rows gives an empty DataFrame that
+    still has the schema's dtypes.
+    """
+    annotate(csv_path=csv_path, sample_fraction=sample_fraction)
+    # The per-chunk categories are unioned at the end.
+    chunks = list(iter_csv_with_schema(
+        csv_path, schema, usecols, chunksize, sample_fraction, **read_csv_kwargs
+    ))
+    if not chunks:
+        return empty_frame_with_schema(csv_path, schema, usecols, **read_csv_kwargs)
+    if len(chunks) == 1:
+        return chunks[0]
+
+    columns = list(chunks[0].columns)
+    categorical_cols = [col for col in chunks[0].columns if schema.get(col) == 'category']
+    categoricals = dict(
+        (col, union_categoricals([chunk[col] for chunk in chunks])) for col in categorical_cols
+    )
+    df = pd.concat(
+        [chunk.drop(categorical_cols, axis=1) for chunk in chunks],
+        ignore_index=True,
+    )
+    del chunks
+    for col, categorical in categoricals.items():
+        df[col] = categorical
+    return df[columns]
@@ -0,0 +1,328 @@
+"""Score msnos with a saved churn model, from the command line or over a local HTTP server.
+
+The members, statistics and user log features of every known user are joined once into a
+`FeatureIndex`: one CSR matrix with a row per msno (in the same column order the model was trained
+on), plus a row for users we know nothing about. Scoring a request is then a row lookup and a
+model call. The HTTP server funnels concurrent requests through a `MicroBatcher`, which scores
+whatever requests arrived within a couple of milliseconds of each other in a single model call, so
+the per-call overhead of the model is paid once per batch rather than once per request.
+
+Usage:
+    python scoring.py score --model ./data/model.pkl MSNO [MSNO ...]  (or msnos on stdin)
+    python scoring.py serve --model ./data/model.pkl --port 8000
+
+    curl -d '{"msnos": ["..."]}' localhost:8000/score
+"""
+import argparse
+import contextlib
+import json
+import os
+import pickle
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+from features import LABEL
+from msno_dictionary import MSNO_ID, get_msno_dictionary
+from one_hot import build_sparse_feature_matrix
+from profiling import profiled
+from utils import (
+    TRAIN_ULOG_PATH, VALIDATION_ULOG_PATH, get_or_build_members_df, get_or_build_statistics_df,
+    get_or_fit_one_hot_encoder, join_training_features, read_ulog_features_df,
+)
+
+MODEL_PATH = './data/model.pkl'
+# The statistics of every known user are cached apart from the train/validation ones, so that
+# building the index doesn't evict one of those.
+SCORING_STATISTICS_DF_CACHE = './data/scoring_statistics_df'
+MAX_BATCH_SIZE = 1024
+MAX_BATCH_WAIT_SECS = 0.002
+
+
+def save_model(model, feature_names, path=MODEL_PATH):
+    """Pickle a fitted model with the names of the feature columns it was trained on, in order.
+
+    `model` is an sklearn-style classifier with `predict_proba`, or an xgboost Booster, trained on
+    a matrix like `utils.get_training_or_validation_matrix` returns.
+    """
+    with open(path, 'wb') as model_file:
+        pickle.dump({'model': model, 'feature_names': list(feature_names)}, model_file)
+
+
+class ChurnModel(object):
+
+    def __init__(self, model, feature_names):
+        self.model = model
+        self.feature_names = list(feature_names)
+
+    @classmethod
+    def load(cls, path=MODEL_PATH):
+        with open(path, 'rb') as model_file:
+            saved = pickle.load(model_file)
+        return cls(saved['model'], saved['feature_names'])
+
+    def predict(self, matrix):
+        """Return the churn probability of every row of `matrix`."""
+        if hasattr(self.model, 'predict_proba'):
+            return self.model.predict_proba(matrix)[:, 1]
+        import xgboost
+        return self.model.predict(xgboost.DMatrix(matrix, feature_names=self.feature_names))
+
+
+class FeatureIndex(object):
+    """The feature row of every known user, looked up by msno.
+
+    Args:
+        msnos - The msno of each row of `matrix`, except the last.
+        matrix - CSR feature matrix whose last row holds the features of an unknown user.
+    """
+
+    def __init__(self, msnos, matrix):
+        self.index = pd.Index(msnos)
+        self.matrix = matrix
+        self.unknown_row = matrix.shape[0] - 1
+
+    def lookup(self, msnos):
+        """Return the feature rows for `msnos`, and whether each msno was known."""
+        rows = self.index.get_indexer(msnos)
+        known = rows >= 0
+        rows[~known] = self.unknown_row
+        return self.matrix[rows], known
+
+    @classmethod
+    def from_df(cls, df, encoder, feature_names):
+        """Build an index from a frame with one row per user, as for `build_sparse_feature_matrix`.
+
+        The frame's last row stands for unknown users, and columns are put in the order of
+        `feature_names`.
+        """
+        matrix, df_feature_names = build_sparse_feature_matrix(
+            df, encoder, exclude=('msno', MSNO_ID, LABEL),
+        )
+        if df_feature_names != feature_names:
+            missing = sorted(set(feature_names) - set(df_feature_names))
+            if missing:
+                raise ValueError("The feature tables have no {} columns".format(missing))
+            positions = dict((name, i) for i, name in enumerate(df_feature_names))
+            matrix = matrix[:, [positions[name] for name in feature_names]]
+        return cls(df.msno.values[:-1], matrix.tocsr())
+
+
+@profiled()
+def build_feature_index(feature_names):
+    """Join the cached members, statistics and user log tables for every user we have data on.
+
+    That's everyone in the members table or in either compiled user log file. The statistics are
+    built for all of those users the first time, and cached under `SCORING_STATISTICS_DF_CACHE`.
+    """
+    members_df = get_or_build_members_df()
+    ulog_dfs = [
+        read_ulog_features_df(path) for path in [TRAIN_ULOG_PATH, VALIDATION_ULOG_PATH]
+        if os.path.isfile(path)
+    ]
+    ulog_df = pd.concat(ulog_dfs, ignore_index=True).drop_duplicates(MSNO_ID)
+    users_df = pd.DataFrame({
+        MSNO_ID: np.union1d(members_df[MSNO_ID].values, ulog_df[MSNO_ID].values).astype(np.int32),
+    })
+    stats_df = get_or_build_statistics_df(users_df, base_cache_path=SCORING_STATISTICS_DF_CACHE)
+    print("Joining the features of {} users...".format(len(users_df)))
+    # Id -1 matches nothing in any table, which gives the features of an unknown user.
+    users_df = pd.concat(
+        [users_df, pd.DataFrame({MSNO_ID: np.array([-1], dtype=np.int32)})],
+        ignore_index=True,
+    )
+    df = join_training_features(users_df, members_df, stats_df, ulog_df, for_vw=True)
+    del members_df, stats_df, ulog_df
+    df['msno'] = get_msno_dictionary().decode(df[MSNO_ID].values)
+    index = FeatureIndex.from_df(df, get_or_fit_one_hot_encoder(), feature_names)
+    print("Finished building the feature index")
+    return index
+
+
+class Scorer(object):
+    """Scores lists of msnos with a model and a feature index."""
+
+    def __init__(self, model, feature_index):
+        self.model = model
+        self.feature_index = feature_index
+
+    def score(self, msnos):
+        matrix, _ = self.feature_index.lookup(msnos)
+        return self.model.predict(matrix)
+
+
+class MicroBatcher(object):
+    """Collects concurrent scoring requests into batches, scored in one call on a worker thread.
+
+    A batch is scored as soon as it holds `max_batch_size` msnos, or `max_wait_secs` after its
+    first request arrived, whichever comes first.
+    """
+
+    def __init__(self, score_fn, max_batch_size=MAX_BATCH_SIZE, max_wait_secs=MAX_BATCH_WAIT_SECS):
+        self.score_fn = score_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_secs = max_wait_secs
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, msnos):
+        """Queue `msnos` for scoring, and return a Future of their scores."""
+        future = Future()
+        self.requests.put((list(msnos), future))
+        return future
+
+    def score(self, msnos):
+        return self.submit(msnos).result()
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+
+    def _next_batch(self):
+        first = self.requests.get()
+        if first is None:
+            return None
+        batch = [first]
+        batch_size = len(first[0])
+        deadline = time.time() + self.max_wait_secs
+        while batch_size < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                # Score what we have, then stop.
+                self.requests.put(None)
+                break
+            batch.append(request)
+            batch_size += len(request[0])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            msnos = [msno for request_msnos, _ in batch for msno in request_msnos]
+            try:
+                scores = self.score_fn(msnos)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            start = 0
+            for request_msnos, future in batch:
+                future.set_result(scores[start:start + len(request_msnos)])
+                start += len(request_msnos)
+
+
+class ScoringRequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so clients don't pay for a new connection per request. With keep-alive, Nagle's
+    # algorithm holds the response body back until the headers are acked, which costs ~40ms.
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if self.path != '/health':
+            self._send_json(404, {'error': 'Not found'})
+            return
+        self._send_json(200, {'status': 'ok'})
+
+    def do_POST(self):
+        if self.path != '/score':
+            self._send_json(404, {'error': 'Not found'})
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            msnos = json.loads(body.decode('utf-8'))['msnos']
+        except (ValueError, KeyError, TypeError):
+            msnos = None
+        # Checked here, so a bad request can't fail the batch it would be scored in.
+        if not isinstance(msnos, list) or not all(isinstance(msno, str) for msno in msnos):
+            self._send_json(400, {'error': 'Expected a JSON body like {"msnos": ["...", ...]}'})
+            return
+        try:
+            scores = self.server.batcher.score(msnos)
+        except Exception as e:
+            self._send_json(500, {'error': 'Scoring failed: {}'.format(e)})
+            return
+        self._send_json(200, {'scores': [float(score) for score in scores]})
+
+    def _send_json(self, status, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # One line per request would swamp the output under any real load.
+        pass
+
+
+def make_scoring_server(scorer, host='localhost', port=8000, max_batch_size=MAX_BATCH_SIZE,
+                        max_wait_secs=MAX_BATCH_WAIT_SECS):
+    """Return an HTTP server (not yet serving) that answers POST /score with micro-batching."""
+    server = ThreadingHTTPServer((host, port), ScoringRequestHandler)
+    server.daemon_threads = True
+    server.batcher = MicroBatcher(scorer.score, max_batch_size, max_wait_secs)
+    return server
+
+
+def load_scorer(model_path=MODEL_PATH):
+    model = ChurnModel.load(model_path)
+    return Scorer(model, build_feature_index(model.feature_names))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score msnos with a saved churn model")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    score_parser = subparsers.add_parser('score', help="Print 'msno,is_churn' lines to stdout")
+    score_parser.add_argument('--model', default=MODEL_PATH)
+    score_parser.add_argument('msnos', nargs='*', help="Defaults to one msno per line of stdin")
+    serve_parser = subparsers.add_parser('serve', help="Serve POST /score over HTTP")
+    serve_parser.add_argument('--model', default=MODEL_PATH)
+    serve_parser.add_argument('--host', default='localhost')
+    serve_parser.add_argument('--port', type=int, default=8000)
+    serve_parser.add_argument('--max-batch-size', type=int, default=MAX_BATCH_SIZE)
+    serve_parser.add_argument('--max-wait-ms', type=float, default=MAX_BATCH_WAIT_SECS * 1000)
+    args = parser.parse_args()
+
+    if args.command == 'score':
+        # Progress messages go to stderr, so stdout is just the scores.
+        with contextlib.redirect_stdout(sys.stderr):
+            scorer = load_scorer(args.model)
+        msnos = args.msnos or [line.strip() for line in sys.stdin if line.strip()]
+        stdout = sys.stdout
+        stdout.write('msno,{}\n'.format(LABEL))
+        for start in range(0, len(msnos), MAX_BATCH_SIZE):
+            batch = msnos[start:start + MAX_BATCH_SIZE]
+            for msno, score in zip(batch, scorer.score(batch)):
+                stdout.write('{},{}\n'.format(msno, score))
+    else:
+        server = make_scoring_server(
+            load_scorer(args.model), args.host, args.port, args.max_batch_size,
+            args.max_wait_ms / 1000.,
+        )
+        print("Serving on http://{}:{}/score".format(args.host, server.server_address[1]))
+        try:
+            server.serve_forever()
+        finally:
+            server.batcher.close()
+
+
+if __name__ == '__main__':
+    main()
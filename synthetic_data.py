@@ -0,0 +1,322 @@
+"""Synthetic KKBox-shaped inputs, to run and benchmark the pipeline without the Kaggle files.
+
+`write_synthetic_kkbox_dataset` writes the whole './data' directory the pipeline reads, at any
+scale, streaming the big files a block of rows at a time:
+
+    python synthetic_data.py ./data --num-users 1000000 --num-ulog-rows 100000000
+"""
+import argparse
+import base64
+import csv
+import os
+
+import numpy as np
+import pandas as pd
+
+ULOG_FIELDNAMES = [
+    'msno', 'date', 'num_25', 'num_50', 'num_75', 'num_985', 'num_100', 'num_unq', 'total_secs',
+]
+LABEL_FIELDNAMES = ['msno', 'is_churn']
+MEMBERS_FIELDNAMES = ['msno', 'city', 'bd', 'gender', 'registered_via', 'registration_init_time']
+TRANSACTIONS_FIELDNAMES = [
+    'msno', 'payment_method_id', 'payment_plan_days', 'plan_list_price', 'actual_amount_paid',
+    'is_auto_renew', 'transaction_date', 'membership_expire_date', 'is_cancel',
+]
+
+ROWS_PER_WRITE = 100000
+
+# The dates the real user logs (v1 and v2 together) cover.
+ULOG_DATE_RANGE = ('2015-01-01', '2017-03-31')
+
+
+def make_msnos(num_users, seed=0):
+    """Return `num_users` distinct, KKBox-looking msno strings (44-character base64)."""
+    rng = np.random.RandomState(seed)
+    raw = rng.randint(0, 256, size=(num_users, 32)).astype(np.uint8)
+    # Stamp the row number into the first bytes so the ids are guaranteed to be unique.
+    raw[:, :4] = np.arange(num_users, dtype='>u4').view(np.uint8).reshape(num_users, 4)
+    return [base64.b64encode(row.tobytes()).decode('ascii') for row in raw]
+
+
+def write_synthetic_labels(path, msnos, churn_rate=0.09, seed=0):
+    """Write a train_v2.csv / sample_submission_v2.csv shaped file for the given msnos."""
+    rng = np.random.RandomState(seed)
+    is_churn = (rng.random_sample(len(msnos)) < churn_rate).astype(int)
+    with open(path, 'w') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(LABEL_FIELDNAMES)
+        writer.writerows(zip(msnos, is_churn))
+
+
+def make_activity_weights(num_users, rng):
+    """Per-user sampling weights with a heavy tail, so a few users account for many rows."""
+    weights = rng.pareto(1.5, size=num_users) + 1.
+    return weights / weights.sum()
+
+
+def _to_yyyymmdd(dates):
+    # Much faster than `dates.strftime('%Y%m%d').astype(np.int64)` on millions of dates.
+    return np.asarray(dates.year * 10000 + dates.month * 100 + dates.day, dtype=np.int64)
+
+
+def _random_dates(rng, date_range, size):
+    first_date, last_date = pd.to_datetime(date_range[0]), pd.to_datetime(date_range[1])
+    days = rng.randint(0, (last_date - first_date).days + 1, size=size)
+    return _to_yyyymmdd(first_date + pd.to_timedelta(days, unit='D'))
+
+
+def write_synthetic_user_logs(path, msnos, num_rows, seed=0, date_range=None):
+    """Write a user_logs.csv shaped file with `num_rows` rows spread over `msnos`.
+
+    Activity is skewed the way the real logs are: a few heavy listeners account for a large share
+    of the rows, and the per-day counts are heavy-tailed.
+
+    Args:
+        date_range - (first, last) dates, like ULOG_DATE_RANGE, to spread the rows over. By
+                     default they fall in the first 28 days of each month of 2015.
+    """
+    rng = np.random.RandomState(seed)
+    msnos = np.asarray(msnos, dtype=object)
+    weights = make_activity_weights(len(msnos), rng)
+
+    with open(path, 'w') as csv_file:
+        csv_file.write(','.join(ULOG_FIELDNAMES) + '\n')
+        rows_left = num_rows
+        while rows_left > 0:
+            n = min(rows_left, ROWS_PER_WRITE)
+            users = msnos[rng.choice(len(msnos), size=n, p=weights)]
+            if date_range is None:
+                dates = 20150101 + rng.randint(0, 12, size=n) * 100 + rng.randint(0, 28, size=n)
+            else:
+                dates = _random_dates(rng, date_range, n)
+            counts = rng.negative_binomial(1, 0.2, size=(n, 5))
+            num_unq = rng.negative_binomial(2, 0.1, size=n)
+            total_secs = (counts * [10, 60, 120, 210, 240]).sum(axis=1) + rng.random_sample(n)
+            pd.DataFrame({
+                'msno': users,
+                'date': dates,
+                'num_25': counts[:, 0],
+                'num_50': counts[:, 1],
+                'num_75': counts[:, 2],
+                'num_985': counts[:, 3],
+                'num_100': counts[:, 4],
+                'num_unq': num_unq,
+                'total_secs': total_secs,
+            }, columns=ULOG_FIELDNAMES).to_csv(
+                csv_file, header=False, index=False, float_format='%.3f',
+            )
+            rows_left -= n
+    print("Finished writing {} synthetic user log rows to {}!".format(num_rows, path))
+
+
+def make_synthetic_members_df(msnos, seed=0):
+    """Return a DataFrame shaped like 'members_v3.csv' for `msnos`."""
+    rng = np.random.RandomState(seed)
+    num_users = len(msnos)
+    # Like the real file: most users don't state an age or gender, and a few ages are nonsense.
+    bd = np.where(rng.random_sample(num_users) < 0.6, 0, rng.randint(15, 60, size=num_users))
+    bd[rng.random_sample(num_users) < 0.001] = rng.choice([-7000, 1051, 2016])
+    registration_day = rng.randint(0, 4500, size=num_users)
+    registration_date = pd.to_datetime('2004-03-26') + pd.to_timedelta(registration_day, unit='D')
+    return pd.DataFrame({
+        'msno': msnos,
+        'city': np.where(rng.random_sample(num_users) < 0.7, 1, rng.randint(3, 23, size=num_users)),
+        'bd': bd,
+        'gender': rng.choice(['male', 'female', None, None], size=num_users),
+        'registered_via': rng.choice([-1, 3, 4, 7, 9, 13], size=num_users),
+        'registration_init_time': _to_yyyymmdd(registration_date),
+    }, columns=MEMBERS_FIELDNAMES)
+
+
+def make_synthetic_transactions_df(msnos, num_rows, seed=0, weights=None):
+    """Return a DataFrame shaped like 'transactions.csv' with `num_rows` rows over `msnos`.
+
+    Args:
+        weights - How likely each msno is to appear in a row; uniform by default.
+    """
+    rng = np.random.RandomState(seed)
+    msnos = np.asarray(msnos, dtype=object)
+    plan_days = rng.choice([30, 30, 30, 30, 7, 90, 180, 410, 0], size=num_rows)
+    plan_list_price = np.where(plan_days == 0, 0, plan_days // 30 * 149 + 99)
+    # Most transactions pay list price; some get a discount, a few pay nothing at all.
+    paid_fraction = rng.choice([1., 1., 1., 1., 1., 1., 0.8, 0.], size=num_rows)
+    transaction_day = rng.randint(0, 800, size=num_rows)
+    transaction_date = pd.to_datetime('2015-01-01') + pd.to_timedelta(transaction_day, unit='D')
+    expire_date = transaction_date + pd.to_timedelta(plan_days + rng.randint(0, 3, num_rows), 'D')
+    return pd.DataFrame({
+        'msno': msnos[rng.choice(len(msnos), size=num_rows, p=weights)],
+        'payment_method_id': rng.randint(2, 42, size=num_rows),
+        'payment_plan_days': plan_days,
+        'plan_list_price': plan_list_price,
+        'actual_amount_paid': (plan_list_price * paid_fraction).astype(np.int64),
+        'is_auto_renew': (rng.random_sample(num_rows) < 0.85).astype(np.int64),
+        'transaction_date': _to_yyyymmdd(transaction_date),
+        'membership_expire_date': _to_yyyymmdd(expire_date),
+        'is_cancel': (rng.random_sample(num_rows) < 0.04).astype(np.int64),
+    }, columns=TRANSACTIONS_FIELDNAMES)
+
+
+def write_synthetic_transactions(path, msnos, num_rows, seed=0):
+    """Write a transactions.csv shaped file, a block of rows at a time, with skewed activity."""
+    rng = np.random.RandomState(seed)
+    weights = make_activity_weights(len(msnos), rng)
+    with open(path, 'w') as csv_file:
+        csv_file.write(','.join(TRANSACTIONS_FIELDNAMES) + '\n')
+        rows_written = 0
+        while rows_written < num_rows:
+            n = min(num_rows - rows_written, ROWS_PER_WRITE)
+            block_seed = rng.randint(0, 2 ** 31 - 1)
+            make_synthetic_transactions_df(msnos, n, seed=block_seed, weights=weights).to_csv(
+                csv_file, header=False, index=False,
+            )
+            rows_written += n
+    print("Finished writing {} synthetic transaction rows to {}!".format(num_rows, path))
+
+
+def write_synthetic_ulog_dataset(data_dir, num_users, num_rows, label_fraction=0.5, seed=0):
+    """Write a labels file and a user logs file into `data_dir`, returning their paths.
+
+    Only `label_fraction` of the users that appear in the logs are written to the labels file, so
+    the inner join in the aggregation actually has something to throw away.
+    """
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    msnos = make_msnos(num_users, seed=seed)
+    labels_path = os.path.join(data_dir, 'labels.csv')
+    ulogs_path = os.path.join(data_dir, 'user_logs.csv')
+    write_synthetic_labels(labels_path, msnos[:int(num_users * label_fraction)], seed=seed)
+    write_synthetic_user_logs(ulogs_path, msnos, num_rows, seed=seed)
+    return labels_path, ulogs_path
+
+
+def write_synthetic_training_inputs(data_dir, num_users, num_transactions, label_fraction=0.5,
+                                    seed=0):
+    """Write the raw inputs of the training frame into `data_dir`, named like the real ones.
+
+    That's 'train_v2.csv' (for `label_fraction` of the users), 'members_v3.csv' and
+    'transactions.csv' for all of them, and a compiled 'train_ulog_features.csv' with random
+    values for the labelled users, so `utils.get_or_build_training_or_validation_df` runs on it
+    from the directory above `data_dir`.
+    """
+    from ulog_features import ULOG_FEATURES
+
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    msnos = make_msnos(num_users, seed=seed)
+    labelled_msnos = msnos[:int(num_users * label_fraction)]
+    write_synthetic_labels(os.path.join(data_dir, 'train_v2.csv'), labelled_msnos, seed=seed)
+    make_synthetic_members_df(msnos, seed=seed).to_csv(
+        os.path.join(data_dir, 'members_v3.csv'), index=False,
+    )
+    make_synthetic_transactions_df(msnos, num_transactions, seed=seed).to_csv(
+        os.path.join(data_dir, 'transactions.csv'), index=False,
+    )
+    rng = np.random.RandomState(seed)
+    ulog_df = pd.DataFrame({'msno': labelled_msnos})
+    for col in ULOG_FEATURES:
+        ulog_df[col] = rng.lognormal(3., 1.5, size=len(labelled_msnos))
+    ulog_df.to_csv(os.path.join(data_dir, 'train_ulog_features.csv'), index=False)
+    print("Finished writing synthetic training inputs for {} users to {}!".format(
+        num_users, data_dir,
+    ))
+
+
+def write_synthetic_kkbox_dataset(data_dir, num_users, num_ulog_rows, transactions_per_user=10,
+                                  train_fraction=0.5, validation_overlap=0.9,
+                                  members_coverage=0.95, seed=0):
+    """Write the raw Kaggle inputs the pipeline reads into `data_dir`, named like the real ones.
+
+    That's 'members_v3.csv', 'transactions.csv', 'user_logs.csv', 'train_v2.csv' and
+    'sample_submission_v2.csv'. The real data has about 1M train users, 20 transactions and 400
+    user log rows per user; the generator keeps their schemas, value ranges and skew at any
+    scale. Only a sample of the users is labelled, like in the real files.
+
+    Args:
+        num_users - How many distinct msnos appear anywhere.
+        num_ulog_rows - Rows in 'user_logs.csv', which is written in blocks, so it can be far
+                        larger than memory.
+        transactions_per_user - Average transactions per user.
+        train_fraction - Share of the users in 'train_v2.csv'.
+        validation_overlap - Share of the validation users that are also train users. The
+                             validation file has as many users as the train file.
+        members_coverage - Share of the users that have a row in 'members_v3.csv'.
+    Returns:
+        A dict of the paths written, by file name.
+    """
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    rng = np.random.RandomState(seed)
+    msnos = np.asarray(make_msnos(num_users, seed=seed), dtype=object)
+    num_train = int(num_users * train_fraction)
+    num_validation_overlap = int(num_train * validation_overlap)
+    order = rng.permutation(num_users)
+    train_msnos = msnos[order[:num_train]]
+    validation_msnos = np.concatenate([
+        train_msnos[rng.permutation(num_train)[:num_validation_overlap]],
+        msnos[order[num_train:num_train + num_train - num_validation_overlap]],
+    ])
+    rng.shuffle(validation_msnos)
+    members_msnos = msnos[rng.random_sample(num_users) < members_coverage]
+
+    paths = dict((fname, os.path.join(data_dir, fname)) for fname in [
+        'members_v3.csv', 'transactions.csv', 'user_logs.csv', 'train_v2.csv',
+        'sample_submission_v2.csv',
+    ])
+    write_synthetic_labels(paths['train_v2.csv'], train_msnos, seed=seed)
+    # The submission file has a placeholder label for every user, like the one Kaggle ships.
+    write_synthetic_labels(paths['sample_submission_v2.csv'], validation_msnos, churn_rate=0.,
+                           seed=seed)
+    make_synthetic_members_df(members_msnos, seed=seed).to_csv(
+        paths['members_v3.csv'], index=False,
+    )
+    write_synthetic_transactions(
+        paths['transactions.csv'], msnos, num_users * transactions_per_user, seed=seed,
+    )
+    write_synthetic_user_logs(
+        paths['user_logs.csv'], msnos, num_ulog_rows, seed=seed, date_range=ULOG_DATE_RANGE,
+    )
+    print("Finished writing a synthetic dataset of {} users to {}!".format(num_users, data_dir))
+    return paths
+
+
+def make_synthetic_training_df(num_users, seed=0):
+    """Return a DataFrame shaped like the output of `get_or_build_training_or_validation_df`.
+
+    It has the label, the categorical member columns and float columns for the transactions stats
+    and every user log aggregate, with random values.
+    """
+    from features import NUMERICAL_NON_ULOG
+    from ulog_features import ULOG_FEATURES
+
+    rng = np.random.RandomState(seed)
+    df = pd.DataFrame({
+        'msno': make_msnos(num_users, seed=seed),
+        'is_churn': (rng.random_sample(num_users) < 0.09).astype(np.int64),
+        'bd': rng.randint(0, 100, size=num_users).astype(np.float64),
+        'gender': pd.Categorical(
+            rng.choice(['male', 'female', 'not_specified'], size=num_users),
+        ),
+        'city': pd.Categorical(rng.randint(0, 22, size=num_users)),
+        'registered_via': pd.Categorical(rng.choice([0, 3, 4, 7, 9, 13], size=num_users)),
+    })
+    for col in NUMERICAL_NON_ULOG + ULOG_FEATURES:
+        df[col] = rng.lognormal(3., 1.5, size=num_users)
+    return df
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write synthetic KKBox-shaped input CSVs")
+    parser.add_argument('data_dir', nargs='?', default='./data')
+    parser.add_argument('--num-users', type=int, default=100000)
+    parser.add_argument('--num-ulog-rows', type=int, default=10000000)
+    parser.add_argument('--transactions-per-user', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    write_synthetic_kkbox_dataset(
+        args.data_dir, args.num_users, args.num_ulog_rows, args.transactions_per_user,
+        seed=args.seed,
+    )
+
+
+if __name__ == '__main__':
+    main()
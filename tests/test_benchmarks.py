@@ -0,0 +1,25 @@
+import json
+import os
+import subprocess
+import sys
+
+from benchmarks import SUITE_STEPS
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_suite_runs_every_step(tmp_path):
+    # A tiny scale, so this only checks that no step crashes, not how fast any of them is.
+    results_path = str(tmp_path / 'results.jsonl')
+    subprocess.check_call(
+        [
+            sys.executable, os.path.join(REPO_DIR, 'benchmarks.py'), 'suite',
+            '--num-users', '500', '--num-ulog-rows', '20000', '--num-parts', '4',
+            '--results', results_path,
+        ],
+        cwd=str(tmp_path), env=dict(os.environ, PYTHONPATH=REPO_DIR),
+    )
+    with open(results_path, 'r') as results_file:
+        results = [json.loads(line) for line in results_file]
+    assert [result['step'] for result in results] == [step for step, _, _ in SUITE_STEPS]
+    assert all(result['secs'] >= 0 for result in results)
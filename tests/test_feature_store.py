@@ -0,0 +1,34 @@
+import os
+
+import pytest
+
+import msno_dictionary
+from feature_store import FeatureStore, build_manifest_columns, export_feature_store
+from features import NUMERICAL_NON_ULOG
+from synthetic_data import write_synthetic_training_inputs
+from utils import STATISTICS_COLUMNS, get_or_fit_one_hot_encoder
+
+
+@pytest.fixture
+def training_inputs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(msno_dictionary, '_msno_dictionary', None)
+    write_synthetic_training_inputs(os.path.join('data'), 2000, 20000)
+
+
+def test_manifest_groups_every_column(training_inputs):
+    store = FeatureStore(export_feature_store())
+    group_of = dict((column['name'], column['group']) for column in store.manifest['columns'])
+    for col in STATISTICS_COLUMNS:
+        expected_group = 'numerical_non_ulog' if col in NUMERICAL_NON_ULOG else 'statistics'
+        assert group_of[col] == expected_group, col
+    assert group_of['bd'] == 'member'
+    assert group_of['not_specified'] == 'user_categorical'
+    assert store.column_indices(groups=['statistics']) == [
+        store.columns.index(col) for col in STATISTICS_COLUMNS if col not in NUMERICAL_NON_ULOG
+    ]
+
+
+def test_unlisted_column_is_an_error(training_inputs):
+    with pytest.raises(ValueError):
+        build_manifest_columns(['bd', 'days_since_signup'], get_or_fit_one_hot_encoder())
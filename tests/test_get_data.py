@@ -0,0 +1,198 @@
+import concurrent.futures
+import hashlib
+import http.server
+import os
+import re
+import threading
+
+import pytest
+import requests
+
+import get_data
+from get_data import (
+    DownloadProgress, build_download_session, download_kaggle_archive_and_write_to_local_path,
+)
+
+USER_INFO = {'UserName': 'user', 'Password': 'password'}
+
+
+class ArchiveServer(object):
+    """A local stand-in for Kaggle: GET is the login page, POST streams the archive.
+
+    Args:
+        payloads - The archive bytes, by URL path.
+        honor_range - Whether POSTs with a Range header get a 206 with the rest of the archive.
+        fail_first - How many POSTs to cut off halfway through the body before serving in full.
+    """
+
+    def __init__(self, payloads, honor_range=True, fail_first=0):
+        self.payloads = payloads
+        self.honor_range = honor_range
+        self.fail_first = fail_first
+        self.lock = threading.Lock()
+        self.ranges = []
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self._send(200, b'login page')
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                payload = server.payloads[self.path]
+                range_header = self.headers.get('Range')
+                with server.lock:
+                    server.ranges.append((self.path, range_header))
+                    fail = server.fail_first > 0
+                    server.fail_first -= fail
+                start = 0
+                if range_header and server.honor_range:
+                    start = int(re.match(r'bytes=(\d+)-', range_header).group(1))
+                    if start >= len(payload):
+                        self._send(416, b'')
+                        return
+                body = payload[start:]
+                self.send_response(206 if start else 200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if fail:
+                    # Promise the whole body, send half of it, and hang up.
+                    self.wfile.write(body[:len(body) // 2])
+                    self.wfile.flush()
+                    self.close_connection = True
+                    return
+                self.wfile.write(body)
+
+            def _send(self, status, body):
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def url(self, path):
+        return 'http://127.0.0.1:{}{}'.format(self.httpd.server_address[1], path)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    # Small enough that a body cut off halfway has already been partly written out.
+    monkeypatch.setattr(get_data, 'FILE_CHUNK_SIZE', 64 * 1024)
+
+
+@pytest.fixture
+def payload():
+    return os.urandom(3 * 1024 * 1024 + 17)
+
+
+def download(server, path, local_path, **kwargs):
+    return download_kaggle_archive_and_write_to_local_path(
+        USER_INFO, server.url(path), local_path, **kwargs
+    )
+
+
+def test_download_writes_archive_and_removes_part_file(tmp_path, payload):
+    local_path = str(tmp_path / 'train_v2.csv.7z')
+    with ArchiveServer({'/train': payload}) as server:
+        download(server, '/train', local_path, expected_sha256=hashlib.sha256(payload).hexdigest())
+    assert open(local_path, 'rb').read() == payload
+    assert not os.path.exists(local_path + '.part')
+    assert server.ranges == [('/train', None)]
+
+
+def test_partial_download_resumes_with_range(tmp_path, payload):
+    local_path = str(tmp_path / 'train_v2.csv.7z')
+    with open(local_path + '.part', 'wb') as part_file:
+        part_file.write(payload[:1000])
+    with ArchiveServer({'/train': payload}) as server:
+        download(server, '/train', local_path)
+    assert open(local_path, 'rb').read() == payload
+    assert server.ranges == [('/train', 'bytes=1000-')]
+
+
+def test_complete_part_file_is_not_downloaded_again(tmp_path, payload):
+    local_path = str(tmp_path / 'train_v2.csv.7z')
+    with open(local_path + '.part', 'wb') as part_file:
+        part_file.write(payload)
+    with ArchiveServer({'/train': payload}) as server:
+        download(server, '/train', local_path)
+    assert open(local_path, 'rb').read() == payload
+
+
+def test_server_ignoring_range_restarts_download(tmp_path, payload):
+    local_path = str(tmp_path / 'train_v2.csv.7z')
+    with open(local_path + '.part', 'wb') as part_file:
+        part_file.write(payload[:1000])
+    with ArchiveServer({'/train': payload}, honor_range=False) as server:
+        download(server, '/train', local_path)
+    # The 200 carries the whole archive, which must replace the partial data, not follow it.
+    assert open(local_path, 'rb').read() == payload
+    assert server.ranges == [('/train', 'bytes=1000-')]
+
+
+def test_interrupted_download_is_retried_from_where_it_stopped(tmp_path, payload):
+    local_path = str(tmp_path / 'train_v2.csv.7z')
+    with ArchiveServer({'/train': payload}, fail_first=2) as server:
+        download(server, '/train', local_path)
+    assert open(local_path, 'rb').read() == payload
+    assert [path for path, _ in server.ranges] == ['/train'] * 3
+    assert server.ranges[0][1] is None
+    # Each retry asks for the rest of the archive after what had been written out.
+    offsets = [int(re.match(r'bytes=(\d+)-', range_header).group(1))
+               for _, range_header in server.ranges[1:]]
+    assert 0 < offsets[0] <= len(payload) // 2
+    assert offsets[0] < offsets[1] <= offsets[0] + (len(payload) - offsets[0]) // 2
+
+
+def test_download_gives_up_after_the_retries(tmp_path, payload, monkeypatch):
+    monkeypatch.setattr(get_data, 'DOWNLOAD_RETRIES', 1)
+    local_path = str(tmp_path / 'train_v2.csv.7z')
+    with ArchiveServer({'/train': payload}, fail_first=5) as server:
+        with pytest.raises(requests.exceptions.RequestException):
+            download(server, '/train', local_path)
+    assert not os.path.exists(local_path)
+    # What did arrive is kept, for the next run to resume from.
+    assert os.path.getsize(local_path + '.part') > 0
+
+
+def test_checksum_mismatch_removes_the_download(tmp_path, payload):
+    local_path = str(tmp_path / 'train_v2.csv.7z')
+    with ArchiveServer({'/train': payload}) as server:
+        with pytest.raises(ValueError):
+            download(server, '/train', local_path, expected_sha256='0' * 64)
+    assert not os.path.exists(local_path)
+    assert not os.path.exists(local_path + '.part')
+
+
+def test_concurrent_downloads_share_a_session(tmp_path):
+    payloads = dict(('/archive{}'.format(i), os.urandom(1024 * 1024 + i)) for i in range(6))
+    session = build_download_session(3)
+    progress = DownloadProgress()
+    with ArchiveServer(payloads, fail_first=2) as server:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+            futures = dict(
+                (path, executor.submit(
+                    download, server, path, str(tmp_path / path.lstrip('/')),
+                    session=session, progress=progress,
+                ))
+                for path in payloads
+            )
+            for path, future in futures.items():
+                assert open(future.result(), 'rb').read() == payloads[path]
+    # Progress counts every byte written, including the ones before an interruption.
+    assert progress.bytes_since_start == sum(len(payload) for payload in payloads.values())
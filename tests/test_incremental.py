@@ -0,0 +1,102 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import msno_dictionary
+import utils
+from csv_tools import merge_csvs
+from incremental import apply_delta, load_feature_state, write_ulog_features_from_state
+from synthetic_data import (
+    make_msnos, write_synthetic_labels, write_synthetic_transactions, write_synthetic_user_logs,
+)
+from ulog_features import build_ulog_features_df, get_or_build_ulog_features_df
+
+NUM_USERS = 3000
+NUM_HISTORY_USERS = 2700
+DELTA_DATES = ['2016-01-01', '2016-01-02']
+
+
+def assert_frames_close(expected_df, actual_df, key='msno'):
+    expected_df = expected_df.set_index(key).sort_index()
+    actual_df = actual_df.set_index(key).sort_index()
+    assert expected_df.index.equals(actual_df.index)
+    assert sorted(expected_df.columns) == sorted(actual_df.columns)
+    for col in expected_df.columns:
+        np.testing.assert_allclose(
+            actual_df[col].values.astype(np.float64), expected_df[col].values.astype(np.float64),
+            rtol=1e-9, err_msg=col,
+        )
+
+
+@pytest.fixture
+def history_and_deltas(tmp_path, monkeypatch):
+    """A './data' directory with a history and two daily deltas, all folded into a state.
+
+    Returns the state path and the (user logs, transactions) paths of the history and each delta.
+    """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(msno_dictionary, '_msno_dictionary', None)
+    os.makedirs('data')
+    msnos = make_msnos(NUM_USERS)
+    write_synthetic_labels(utils.TRAIN_CSV_PATH, msnos)
+    files = []
+    for day, date in enumerate([None] + DELTA_DATES):
+        if date is None:
+            day_msnos = msnos[:NUM_HISTORY_USERS]
+            num_ulog_rows, num_transactions, date_range = 50000, 10000, None
+        else:
+            # A slice of the existing users, plus some sign-ups.
+            day_msnos = msnos[day * 500:day * 500 + 800] + msnos[NUM_HISTORY_USERS:][day::2]
+            num_ulog_rows, num_transactions, date_range = 3000, 500, (date, date)
+        ulogs_path = os.path.join('data', 'user_logs_{}.csv'.format(day))
+        transactions_path = os.path.join('data', 'transactions_{}.csv'.format(day))
+        write_synthetic_user_logs(ulogs_path, day_msnos, num_ulog_rows, day, date_range)
+        write_synthetic_transactions(transactions_path, day_msnos, num_transactions, day)
+        files.append((ulogs_path, transactions_path))
+
+    state_path = os.path.join('data', 'feature_state.npz')
+    for ulogs_path, transactions_path in files:
+        state = apply_delta(ulogs_path, transactions_path, state_path)
+    # Applying a delta again is a no-op.
+    assert apply_delta(files[-1][0], files[-1][1], state_path).applied == state.applied
+    merge_csvs([transactions_path for _, transactions_path in files], utils.TRANSACTIONS_CSV_PATH)
+    return state_path, files
+
+
+def test_statistics_from_state_match_full_rebuild(history_and_deltas, monkeypatch):
+    state_path, _ = history_and_deltas
+    labels_df = utils.read_labels_df()
+    rebuilt_df = utils.get_or_build_statistics_df(labels_df)
+
+    monkeypatch.setattr(utils, 'STATISTICS_FEATURE_STATE_PATH', state_path)
+    # Set to a missing file, so reading the transactions at all would fail.
+    monkeypatch.setattr(utils, 'TRANSACTIONS_CSV_PATH', os.path.join('data', 'missing.csv'))
+    state_df = utils.get_or_build_statistics_df(labels_df)
+    assert_frames_close(rebuilt_df, state_df, key=msno_dictionary.MSNO_ID)
+
+
+def test_ulog_aggregates_from_state_match_full_rebuild(history_and_deltas):
+    state_path, files = history_and_deltas
+    all_ulogs_path = os.path.join('data', 'user_logs.csv')
+    merge_csvs([ulogs_path for ulogs_path, _ in files], all_ulogs_path)
+    rebuilt_df = build_ulog_features_df(utils.TRAIN_CSV_PATH, all_ulogs_path)
+
+    state = load_feature_state(state_path)
+    msnos = pd.read_csv(utils.TRAIN_CSV_PATH).msno.values
+    assert_frames_close(rebuilt_df, state.ulog_features_df(msnos))
+
+
+def test_ulog_feature_file_from_state_matches_full_rebuild(history_and_deltas):
+    state_path, files = history_and_deltas
+    all_ulogs_path = os.path.join('data', 'user_logs.csv')
+    merge_csvs([ulogs_path for ulogs_path, _ in files], all_ulogs_path)
+    # With the trailing windows, which reach back from the last delta into the history.
+    rebuilt_df = get_or_build_ulog_features_df(force_build=True, ulogs_csv_path=all_ulogs_path)
+    assert rebuilt_df['num_days_30d'].notnull().any()
+
+    write_ulog_features_from_state(load_feature_state(state_path))
+    state_df = pd.read_csv(utils.TRAIN_ULOG_PATH)
+    assert list(rebuilt_df.columns) == list(state_df.columns)
+    assert_frames_close(rebuilt_df, state_df)
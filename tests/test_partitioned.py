@@ -0,0 +1,45 @@
+import os
+
+import pandas as pd
+import pytest
+
+import msno_dictionary
+from partitioned import build_partitioned_training_or_validation_df, read_partitioned_df
+from synthetic_data import write_synthetic_training_inputs
+from utils import get_or_build_members_df, get_or_build_training_or_validation_df
+
+
+@pytest.fixture
+def training_inputs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(msno_dictionary, '_msno_dictionary', None)
+    write_synthetic_training_inputs(os.path.join('data'), 4000, 40000)
+
+
+def sorted_by_msno(df):
+    return df.sort_values('msno').reset_index(drop=True)
+
+
+@pytest.mark.parametrize('for_vw', [True, False])
+def test_partitioned_build_matches_in_memory_build(training_inputs, for_vw):
+    in_memory_df = get_or_build_training_or_validation_df(for_vw=for_vw)
+    output_path = build_partitioned_training_or_validation_df(
+        for_vw=for_vw, num_buckets=4, num_workers=2,
+    )
+    partitioned_df = read_partitioned_df(output_path)
+    # Each bucket's categoricals only know the bucket's own values.
+    for col in in_memory_df.columns:
+        if isinstance(in_memory_df[col].dtype, pd.CategoricalDtype):
+            in_memory_df[col] = in_memory_df[col].astype(object)
+            partitioned_df[col] = partitioned_df[col].astype(object)
+    pd.testing.assert_frame_equal(
+        sorted_by_msno(in_memory_df), sorted_by_msno(partitioned_df[in_memory_df.columns]),
+    )
+
+
+def test_member_columns_are_categorized(training_inputs):
+    members_df = get_or_build_members_df()
+    for col, null_category in [('gender', 'not_specified'), ('city', 0), ('registered_via', 0)]:
+        assert isinstance(members_df[col].dtype, pd.CategoricalDtype), col
+        assert null_category in members_df[col].cat.categories, col
+        assert not members_df[col].isnull().any(), col
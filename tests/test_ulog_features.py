@@ -0,0 +1,84 @@
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from sampling import in_sample
+from synthetic_data import write_synthetic_ulog_dataset
+from ulog_features import (
+    UlogAccumulator, aggregate_ulog_chunks, build_ulog_features_df,
+    build_windowed_ulog_features_df, find_shard_offsets,
+)
+
+NUM_WORKERS = 4
+# Small chunks, so every shard is folded in over several chunks.
+CHUNKSIZE = 5000
+
+
+@pytest.fixture(scope='module')
+def ulog_dataset(tmp_path_factory):
+    data_dir = str(tmp_path_factory.mktemp('ulog'))
+    return write_synthetic_ulog_dataset(data_dir, 2000, 60000)
+
+
+def test_sharded_aggregation_is_deterministic(ulog_dataset):
+    labels_path, ulogs_path = ulog_dataset
+    first_df = build_ulog_features_df(labels_path, ulogs_path, CHUNKSIZE, NUM_WORKERS)
+    second_df = build_ulog_features_df(labels_path, ulogs_path, CHUNKSIZE, NUM_WORKERS)
+    pd.testing.assert_frame_equal(first_df, second_df, check_exact=True)
+
+
+def test_shard_partials_are_merged_in_shard_order(ulog_dataset):
+    labels_path, ulogs_path = ulog_dataset
+    msnos = pd.read_csv(labels_path, usecols=['msno']).msno.values
+    expected = UlogAccumulator(msnos)
+    for byte_range in find_shard_offsets(ulogs_path, NUM_WORKERS):
+        partial = UlogAccumulator(expected.msno_index.values)
+        expected.merge(aggregate_ulog_chunks(partial, ulogs_path, CHUNKSIZE, byte_range))
+
+    sharded_df = build_ulog_features_df(labels_path, ulogs_path, CHUNKSIZE, NUM_WORKERS)
+    pd.testing.assert_frame_equal(expected.to_df(), sharded_df, check_exact=True)
+
+
+def test_sharded_aggregation_matches_single_process(ulog_dataset):
+    labels_path, ulogs_path = ulog_dataset
+    single_df = build_ulog_features_df(labels_path, ulogs_path, CHUNKSIZE, 1)
+    sharded_df = build_ulog_features_df(labels_path, ulogs_path, CHUNKSIZE, NUM_WORKERS)
+    assert list(single_df.msno) == list(sharded_df.msno)
+    # Counts, sums of the integer columns, mins and maxes are exact whatever the grouping.
+    exact_cols = [
+        col for col in single_df.columns
+        if col.startswith(('min_', 'max_')) or
+        (col.startswith('sum_') and not col.endswith('total_secs'))
+    ]
+    pd.testing.assert_frame_equal(single_df[exact_cols], sharded_df[exact_cols], check_exact=True)
+    for col in single_df.columns[1:]:
+        np.testing.assert_allclose(single_df[col], sharded_df[col], rtol=1e-9, equal_nan=True)
+
+
+def test_sampled_windows_end_on_the_last_day_of_the_whole_file(ulog_dataset, tmp_path,
+                                                                monkeypatch):
+    labels_path, ulogs_path = ulog_dataset
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('data')
+    late_ulogs_path = os.path.join('data', 'user_logs.csv')
+    shutil.copyfile(ulogs_path, late_ulogs_path)
+    sample_fraction = 0.3
+    msnos = pd.read_csv(labels_path, usecols=['msno']).msno.values
+    # The file's last day only has a row of a user outside the sample.
+    unsampled_msno = msnos[~in_sample(msnos, sample_fraction)][0]
+    with open(late_ulogs_path, 'a') as ulogs_file:
+        ulogs_file.write('{},20151231,1,0,0,0,1,1,30.0\n'.format(unsampled_msno))
+
+    full_df = build_windowed_ulog_features_df(labels_path, late_ulogs_path)
+    sampled_df = build_windowed_ulog_features_df(
+        labels_path, late_ulogs_path, sample_fraction=sample_fraction,
+    )
+    expected_df = full_df[in_sample(full_df.msno.values, sample_fraction)]
+    assert list(expected_df.msno) == list(sampled_df.msno)
+    for col in full_df.columns[1:]:
+        np.testing.assert_allclose(
+            sampled_df[col], expected_df[col], rtol=1e-9, equal_nan=True, err_msg=col,
+        )
@@ -0,0 +1,319 @@
+"""Cross-validation and hyperparameter search over a cached training matrix, in a process pool.
+
+The train users' sparse feature matrix is built once from `get_or_build_training_or_validation_df`
+(with `for_vw=True` and the one-hot encoder, like `utils.get_training_or_validation_matrix`) and
+saved as raw NumPy buffers: the CSR 'data', 'indices' and 'indptr' arrays plus the labels, next to
+a JSON file with its shape and feature names. Like the cached frames, the directory name carries a
+fingerprint of the inputs, so experiments only re-convert the frame when the features changed.
+
+Every pool worker memory-maps those buffers read-only, so the matrix sits in the page cache once
+and is shared by all the workers instead of being pickled to each of them. Only the training rows
+of a fold are copied, by the fit that needs them. Each (configuration, fold) pair is one task;
+models are fit single-threaded, so `num_workers` fits run at a time.
+
+Usage:
+    python training.py --model logistic --folds 5 --workers 8
+    python training.py --model xgboost --random 20 --workers 8 --save-best
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import time
+
+import numpy as np
+import scipy.sparse
+
+from cache import file_fingerprint, fingerprint
+from features import LABEL
+from one_hot import build_sparse_feature_matrix
+from profiling import annotate, profiled, stage
+from scoring import save_model
+from utils import (
+    ONE_HOT_VOCABULARY_PATH, TRAIN_CSV_PATH, TRAIN_ULOG_PATH,
+    get_or_build_training_or_validation_df, get_or_fit_one_hot_encoder,
+    training_or_validation_df_fingerprint,
+)
+
+TRAINING_MATRIX_CACHE = './data/training_matrix'
+SUCCESS_MARKER = '_SUCCESS'
+MATRIX_ARRAYS = ['data', 'indices', 'indptr', 'labels']
+
+# Predicted probabilities are clipped to this distance from 0 and 1 before taking logs.
+LOG_LOSS_EPS = 1e-15
+
+PARAM_GRIDS = {
+    'logistic': {
+        'C': [0.001, 0.01, 0.1, 1., 10.],
+    },
+    'xgboost': {
+        'max_depth': [2, 4, 6, 8],
+        'eta': [0.05, 0.1, 0.3, 1.],
+        'num_round': [20, 50, 100],
+        'subsample': [0.8, 1.],
+    },
+}
+
+
+def fit_logistic(matrix, labels, params, feature_names, seed):
+    from sklearn.linear_model import LogisticRegression
+    model = LogisticRegression(solver='liblinear', random_state=seed, **params)
+    return model.fit(matrix, labels)
+
+
+def predict_logistic(model, matrix, feature_names):
+    return model.predict_proba(matrix)[:, 1]
+
+
+def fit_xgboost(matrix, labels, params, feature_names, seed):
+    import xgboost
+    params = dict(params)
+    num_round = params.pop('num_round')
+    params.update({'objective': 'binary:logistic', 'nthread': 1, 'seed': seed})
+    dtrain = xgboost.DMatrix(matrix, label=labels, feature_names=feature_names)
+    return xgboost.train(params, dtrain, num_round)
+
+
+def predict_xgboost(model, matrix, feature_names):
+    import xgboost
+    return model.predict(xgboost.DMatrix(matrix, feature_names=feature_names))
+
+
+# Model name -> (fit function, predict function). The fitted models are what `scoring.ChurnModel`
+# knows how to use.
+MODELS = {
+    'logistic': (fit_logistic, predict_logistic),
+    'xgboost': (fit_xgboost, predict_xgboost),
+}
+
+
+def log_loss(labels, probabilities, eps=LOG_LOSS_EPS):
+    probabilities = np.clip(probabilities, eps, 1 - eps)
+    losses = labels * np.log(probabilities) + (1 - labels) * np.log(1 - probabilities)
+    return float(-losses.mean())
+
+
+def training_matrix_fingerprint():
+    return fingerprint(
+        'training_matrix',
+        training_or_validation_df_fingerprint(TRAIN_CSV_PATH, TRAIN_ULOG_PATH, False, True),
+        file_fingerprint(ONE_HOT_VOCABULARY_PATH, hash_contents=True),
+    )
+
+
+@profiled()
+def get_or_build_training_matrix(force_build=False):
+    """Save the train users' feature matrix and labels as NumPy buffers, unless already there.
+
+    Returns:
+        The directory holding the buffers, for `load_training_matrix`.
+    """
+    encoder = get_or_fit_one_hot_encoder()
+    matrix_path = '{}.{}'.format(TRAINING_MATRIX_CACHE, training_matrix_fingerprint())
+    if os.path.isfile(os.path.join(matrix_path, SUCCESS_MARKER)) and not force_build:
+        annotate(cache_hit=True)
+        return matrix_path
+    if os.path.isdir(matrix_path):
+        shutil.rmtree(matrix_path)
+    os.makedirs(matrix_path)
+
+    df = get_or_build_training_or_validation_df(for_vw=True)
+    matrix, feature_names = build_sparse_feature_matrix(df, encoder)
+    matrix = matrix.tocsr()
+    arrays = {
+        'data': matrix.data,
+        'indices': matrix.indices,
+        'indptr': matrix.indptr,
+        'labels': df[LABEL].values.astype(np.float64),
+    }
+    del df
+    for name in MATRIX_ARRAYS:
+        np.save(os.path.join(matrix_path, name + '.npy'), arrays[name])
+    with open(os.path.join(matrix_path, 'matrix.json'), 'w') as json_file:
+        json.dump({'shape': list(matrix.shape), 'feature_names': feature_names}, json_file)
+    open(os.path.join(matrix_path, SUCCESS_MARKER), 'w').close()
+    annotate(cache_hit=False, rows_out=matrix.shape[0])
+    print("Saved a {} x {} training matrix to {}".format(
+        matrix.shape[0], matrix.shape[1], matrix_path,
+    ))
+    return matrix_path
+
+
+def load_training_matrix(matrix_path, mmap_mode='r'):
+    """Load a matrix saved by `get_or_build_training_matrix`, memory-mapped by default.
+
+    Returns:
+        A (CSR matrix, labels, feature names) tuple.
+    """
+    with open(os.path.join(matrix_path, 'matrix.json'), 'r') as json_file:
+        meta = json.load(json_file)
+    arrays = dict(
+        (name, np.load(os.path.join(matrix_path, name + '.npy'), mmap_mode=mmap_mode))
+        for name in MATRIX_ARRAYS
+    )
+    matrix = scipy.sparse.csr_matrix(
+        (arrays['data'], arrays['indices'], arrays['indptr']), shape=tuple(meta['shape']),
+        copy=False,
+    )
+    return matrix, arrays['labels'], meta['feature_names']
+
+
+def assign_folds(num_rows, num_folds, seed=0):
+    """Return the fold of every row: a shuffled, near-even split into `num_folds` folds."""
+    folds = np.empty(num_rows, dtype=np.int64)
+    folds[np.random.RandomState(seed).permutation(num_rows)] = np.arange(num_rows) % num_folds
+    return folds
+
+
+def build_configs(param_grid, num_random=None, seed=0):
+    """Every combination of the values in `param_grid`, or `num_random` of them drawn at random."""
+    names = sorted(param_grid)
+    configs = [
+        dict(zip(names, values)) for values in itertools.product(*[param_grid[n] for n in names])
+    ]
+    if num_random is not None and num_random < len(configs):
+        picked = np.random.RandomState(seed).choice(len(configs), size=num_random, replace=False)
+        configs = [configs[i] for i in sorted(picked)]
+    return configs
+
+
+# Set up once per pool worker by `_init_cv_worker`.
+_cv_data = None
+
+
+def _init_cv_worker(matrix_path, num_folds, seed):
+    global _cv_data
+    matrix, labels, feature_names = load_training_matrix(matrix_path)
+    _cv_data = {
+        'matrix': matrix,
+        'labels': labels,
+        'feature_names': feature_names,
+        'folds': assign_folds(len(labels), num_folds, seed),
+        'seed': seed,
+    }
+
+
+def _fit_fold(task):
+    config_index, model_name, params, fold = task
+    fit, predict = MODELS[model_name]
+    in_fold = _cv_data['folds'] == fold
+    train_rows, test_rows = np.flatnonzero(~in_fold), np.flatnonzero(in_fold)
+    labels = _cv_data['labels']
+    with stage('cv_fit', rows_in=len(train_rows), model=model_name, fold=fold):
+        start_time = time.time()
+        model = fit(
+            _cv_data['matrix'][train_rows], labels[train_rows], params,
+            _cv_data['feature_names'], _cv_data['seed'],
+        )
+        fit_secs = time.time() - start_time
+        probabilities = predict(model, _cv_data['matrix'][test_rows], _cv_data['feature_names'])
+    return config_index, fold, fit_secs, log_loss(labels[test_rows], probabilities)
+
+
+@profiled()
+def run_cv_search(model_name='logistic', param_grid=None, num_folds=5, num_workers=1,
+                  num_random=None, seed=0, force_build=False):
+    """Cross-validate every configuration of a parameter grid on the cached training matrix.
+
+    Args:
+        model_name - A key of MODELS.
+        param_grid - Dict of parameter name -> values to try; PARAM_GRIDS[model_name] by default.
+        num_folds - Folds of the k-fold cross-validation.
+        num_workers - Fits to run at a time, each in its own process.
+        num_random - Try this many random configurations of the grid instead of all of them.
+        seed - Seeds the fold split, the random search and the models.
+        force_build - Rebuild the saved training matrix.
+    Returns:
+        A list with a dict per configuration (its params, mean and std log-loss over the folds,
+        mean seconds per fit), best configuration first.
+    """
+    if model_name not in MODELS:
+        raise ValueError("Unknown model '{}'".format(model_name))
+    matrix_path = get_or_build_training_matrix(force_build)
+    configs = build_configs(param_grid or PARAM_GRIDS[model_name], num_random, seed)
+    tasks = [
+        (config_index, model_name, params, fold)
+        for config_index, params in enumerate(configs)
+        for fold in range(num_folds)
+    ]
+    print("Cross-validating {} {} configurations over {} folds ({} fits, {} workers)...".format(
+        len(configs), model_name, num_folds, len(tasks), num_workers,
+    ))
+
+    fold_results = [[] for _ in configs]
+    pool = None
+    if num_workers > 1:
+        pool = multiprocessing.Pool(
+            num_workers, initializer=_init_cv_worker, initargs=(matrix_path, num_folds, seed),
+        )
+        finished = pool.imap_unordered(_fit_fold, tasks)
+    else:
+        _init_cv_worker(matrix_path, num_folds, seed)
+        finished = map(_fit_fold, tasks)
+    try:
+        for num_done, (config_index, fold, fit_secs, fold_log_loss) in enumerate(finished, 1):
+            fold_results[config_index].append((fit_secs, fold_log_loss))
+            print("Fit {} of {}: {} fold {}, log-loss {:.5f} in {:.2f}s".format(
+                num_done, len(tasks), configs[config_index], fold, fold_log_loss, fit_secs,
+            ))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    results = []
+    for params, config_results in zip(configs, fold_results):
+        fit_secs, log_losses = np.array(config_results).T
+        results.append({
+            'params': params,
+            'log_loss': float(log_losses.mean()),
+            'log_loss_std': float(log_losses.std()),
+            'secs_per_fit': float(fit_secs.mean()),
+        })
+    results.sort(key=lambda result: result['log_loss'])
+    return results
+
+
+def print_cv_results(results):
+    print("\n{:>10} {:>10} {:>12}  {}".format('log-loss', 'std', 'secs/fit', 'params'))
+    for result in results:
+        print("{:>10.5f} {:>10.5f} {:>12.2f}  {}".format(
+            result['log_loss'], result['log_loss_std'], result['secs_per_fit'],
+            json.dumps(result['params'], sort_keys=True),
+        ))
+
+
+def fit_and_save_model(model_name, params, seed=0):
+    """Fit a model on all the train users and save it for `scoring.py`."""
+    fit, _ = MODELS[model_name]
+    matrix, labels, feature_names = load_training_matrix(get_or_build_training_matrix())
+    model = fit(matrix, labels, params, feature_names, seed)
+    save_model(model, feature_names)
+    print("Saved a {} model with {}".format(model_name, json.dumps(params, sort_keys=True)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parallel cross-validation and parameter search")
+    parser.add_argument('--model', choices=sorted(MODELS), default='logistic')
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--random', type=int, default=None,
+                        help="Try this many random configurations instead of the whole grid")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--force-build', action='store_true')
+    parser.add_argument('--save-best', action='store_true',
+                        help="Refit the best configuration on all the train users and save it")
+    args = parser.parse_args()
+    results = run_cv_search(
+        args.model, num_folds=args.folds, num_workers=args.workers, num_random=args.random,
+        seed=args.seed, force_build=args.force_build,
+    )
+    print_cv_results(results)
+    if args.save_best:
+        fit_and_save_model(args.model, results[0]['params'], args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,493 @@
+"""Per-user aggregates over 'user_logs.csv', computed in a single streaming pass.
+
+This replaces the Spark notebooks (`user_logs_processing.ipynb`, `pedro_ulogs_processing.ipynb`)
+that produce 'train_ulog_features.csv' and 'validation_ulog_features.csv'. Instead of one groupby
+per aggregate function followed by a chain of joins, we read the logs in chunks and keep running
+count/sum/sum-of-squares/min/max accumulators in NumPy arrays, indexed by an msno -> int map built
+from the labels file. Memory is bounded by (number of labelled users x number of columns), no
+matter how large the logs are.
+
+For large logs the pass can also be split across a process pool: the file is cut into byte ranges at
+line boundaries, each worker reduces its shard into a partial accumulator, and the partials are
+merged in shard order before the final avg/stddev are computed. The merge order is fixed, so a
+given number of workers always gives bit-identical features; against the single-process pass the
+float sums are only added up in a different grouping, and can differ in the last bits.
+
+The trailing-window features (the last 7/14/30 days of each user's logs) are built by
+`build_windowed_ulog_features_df`: only the rows within the longest window are kept while
+streaming, sorted once by (user, day), and every window's sums are then differences of one set of
+cumulative sums, taken between each user's last row and the first row inside the window.
+
+Everything here takes a `sample_fraction` too, to aggregate only the users in that sample (see
+'sampling.py'); the log lines of every other user are dropped before they're parsed.
+"""
+import multiprocessing
+import os
+
+import numpy as np
+import pandas as pd
+
+from cache import file_fingerprint, fingerprint
+from features import (
+    NUMERICAL_AGG_AVG, NUMERICAL_AGG_MAX, NUMERICAL_AGG_MIN, NUMERICAL_AGG_STDDEV,
+    NUMERICAL_AGG_SUM, NUMERICAL_WINDOW_AVG, NUMERICAL_WINDOW_DAYS, NUMERICAL_WINDOW_SUM,
+    ULOG_AGG_COLS, ULOG_WINDOWS, window_feature_names,
+)
+from profiling import annotate, profiled
+from sampling import SampledCsvFile
+from schemas import (
+    LABELS_SCHEMA, USER_LOGS_SCHEMA, iter_csv_with_schema, parse_yyyymmdd, read_csv_with_schema,
+)
+from utils import (
+    CACHE_BACKEND, TRAIN_CSV_PATH, TRAIN_ULOG_PATH, VALIDATION_CSV_PATH, VALIDATION_ULOG_PATH,
+    read_cache_entry, sampled_path, write_cache_entry,
+)
+
+ULOGS_CSV_PATH = './data/user_logs.csv'
+ULOG_LAST_DAY_CACHE = './data/ulog_last_day'
+ULOG_CHUNK_SIZE = 2 * 1024 * 1024
+ULOG_FEATURES = (
+    NUMERICAL_AGG_AVG + NUMERICAL_AGG_MAX + NUMERICAL_AGG_MIN + NUMERICAL_AGG_SUM +
+    NUMERICAL_AGG_STDDEV
+)
+ULOG_WINDOW_FEATURES = NUMERICAL_WINDOW_DAYS + NUMERICAL_WINDOW_SUM + NUMERICAL_WINDOW_AVG
+
+
+class UlogAccumulator(object):
+    """Running count/sum/sumsq/min/max of `ULOG_AGG_COLS` for a fixed set of users.
+
+    Each row of the accumulator arrays belongs to one msno, in the order the msnos were passed in.
+    Logs for msnos that aren't in that set are dropped, which mirrors the inner join the Spark
+    notebooks do against the labels file.
+    """
+
+    def __init__(self, msnos):
+        self.msno_index = pd.Index(msnos)
+        if not self.msno_index.is_unique:
+            self.msno_index = self.msno_index.drop_duplicates()
+        num_users = len(self.msno_index)
+        num_cols = len(ULOG_AGG_COLS)
+        self.count = np.zeros(num_users, dtype=np.int64)
+        self.sum = np.zeros((num_users, num_cols), dtype=np.float64)
+        self.sumsq = np.zeros((num_users, num_cols), dtype=np.float64)
+        self.min = np.full((num_users, num_cols), np.inf, dtype=np.float64)
+        self.max = np.full((num_users, num_cols), -np.inf, dtype=np.float64)
+
+    def extend(self, msnos):
+        """Add empty accumulators for those of `msnos` that don't have one yet, after the others."""
+        msnos = pd.unique(np.asarray(msnos))
+        new_msnos = msnos[self.msno_index.get_indexer(msnos) < 0]
+        if not len(new_msnos):
+            return
+        num_new = len(new_msnos)
+        num_cols = len(ULOG_AGG_COLS)
+        self.msno_index = self.msno_index.append(pd.Index(new_msnos))
+        self.count = np.concatenate([self.count, np.zeros(num_new, dtype=np.int64)])
+        self.sum = np.vstack([self.sum, np.zeros((num_new, num_cols))])
+        self.sumsq = np.vstack([self.sumsq, np.zeros((num_new, num_cols))])
+        self.min = np.vstack([self.min, np.full((num_new, num_cols), np.inf)])
+        self.max = np.vstack([self.max, np.full((num_new, num_cols), -np.inf)])
+
+    def update(self, ulog_chunk):
+        """Fold a DataFrame of raw user log rows into the running accumulators."""
+        codes = self.msno_index.get_indexer(ulog_chunk['msno'])
+        known = codes >= 0
+        if not known.all():
+            codes = codes[known]
+            ulog_chunk = ulog_chunk[known]
+        if not len(codes):
+            return
+        values = ulog_chunk[ULOG_AGG_COLS].values.astype(np.float64)
+        self.update_arrays(codes, values)
+
+    def update_arrays(self, codes, values):
+        """Fold `values` (rows x `ULOG_AGG_COLS`) into the accumulators of users `codes`."""
+        num_users = len(self.msno_index)
+        self.count += np.bincount(codes, minlength=num_users)
+        for j in range(values.shape[1]):
+            column = values[:, j]
+            self.sum[:, j] += np.bincount(codes, weights=column, minlength=num_users)
+            self.sumsq[:, j] += np.bincount(codes, weights=column * column, minlength=num_users)
+
+        # Min/max don't decompose into a bincount, so reduce the chunk per user with a sort and
+        # 'reduceat', then fold the (unique) per-user results into the running arrays.
+        order = np.argsort(codes, kind='mergesort')
+        sorted_codes = codes[order]
+        sorted_values = values[order]
+        starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+        users = sorted_codes[starts]
+        self.min[users] = np.minimum(self.min[users], np.minimum.reduceat(sorted_values, starts))
+        self.max[users] = np.maximum(self.max[users], np.maximum.reduceat(sorted_values, starts))
+
+    def merge(self, other):
+        """Fold another accumulator built over the same msnos into this one."""
+        if not self.msno_index.equals(other.msno_index):
+            raise ValueError("Can only merge accumulators built over the same msnos")
+        self.count += other.count
+        self.sum += other.sum
+        self.sumsq += other.sumsq
+        np.minimum(self.min, other.min, out=self.min)
+        np.maximum(self.max, other.max, out=self.max)
+        return self
+
+    def to_df(self):
+        """Return a DataFrame with one row per user that had at least one log row.
+
+        Columns are 'msno' followed by the `NUMERICAL_AGG_*` features. Standard deviations are the
+        sample (n - 1) standard deviation, like Spark SQL's `stddev`, and are NaN for users with a
+        single log row.
+        """
+        seen = self.count > 0
+        count = self.count[seen].astype(np.float64)[:, np.newaxis]
+        total = self.sum[seen]
+        mean = total / count
+        with np.errstate(divide='ignore', invalid='ignore'):
+            variance = (self.sumsq[seen] - total * mean) / (count - 1)
+        # Cancellation in sumsq - sum * mean can leave tiny negative variances behind.
+        stddev = np.sqrt(np.clip(variance, 0., None))
+        stddev[np.broadcast_to(count == 1, stddev.shape)] = np.nan
+
+        ulog_df = pd.DataFrame({'msno': self.msno_index[seen]})
+        for j, col in enumerate(ULOG_AGG_COLS):
+            ulog_df['avg_{}'.format(col)] = mean[:, j]
+            ulog_df['max_{}'.format(col)] = self.max[seen, j]
+            ulog_df['min_{}'.format(col)] = self.min[seen, j]
+            ulog_df['sum_{}'.format(col)] = total[:, j]
+            ulog_df['stddev_{}'.format(col)] = stddev[:, j]
+        return ulog_df[['msno'] + ULOG_FEATURES]
+
+
+class ByteRangeFile(object):
+    """Read-only file object over the bytes [start, end) of a file, for `pd.read_csv`."""
+
+    def __init__(self, path, start, end):
+        self.file = open(path, 'rb')
+        self.file.seek(start)
+        self.remaining = end - start
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def read_csv_header(csv_path):
+    with open(csv_path, 'r') as csv_file:
+        return csv_file.readline().rstrip('\r\n').split(',')
+
+
+def find_shard_offsets(csv_path, num_shards):
+    """Split the body of a CSV into at most `num_shards` byte ranges that end on line boundaries.
+
+    Returns a list of (start, end) offsets; the header line is never part of a shard.
+    """
+    file_size = os.path.getsize(csv_path)
+    with open(csv_path, 'rb') as csv_file:
+        csv_file.readline()
+        body_start = csv_file.tell()
+        boundaries = [body_start]
+        for i in range(1, num_shards):
+            guess = body_start + (file_size - body_start) * i // num_shards
+            if guess <= boundaries[-1]:
+                continue
+            csv_file.seek(guess - 1)
+            # Move to the start of the next line, unless 'guess' already is one.
+            csv_file.readline()
+            offset = csv_file.tell()
+            if boundaries[-1] < offset < file_size:
+                boundaries.append(offset)
+        boundaries.append(file_size)
+    return [(start, end) for start, end in zip(boundaries[:-1], boundaries[1:]) if end > start]
+
+
+def read_label_msnos(labels_csv_path, sample_fraction=None):
+    """The msnos in a labels file, or only those in the `sample_fraction` sample."""
+    return read_csv_with_schema(
+        labels_csv_path, LABELS_SCHEMA, usecols=['msno'], sample_fraction=sample_fraction,
+    ).msno.values
+
+
+def iter_ulog_chunks(ulogs_csv_path=ULOGS_CSV_PATH, chunksize=ULOG_CHUNK_SIZE, byte_range=None,
+                     sample_fraction=None):
+    """Yield DataFrames of user log rows, optionally only those within a (start, end) byte range.
+
+    With `sample_fraction`, only the rows of the users in that sample are read.
+    """
+    usecols = ['msno'] + ULOG_AGG_COLS
+    if byte_range is None:
+        for ulog_chunk in iter_csv_with_schema(ulogs_csv_path, USER_LOGS_SCHEMA, usecols,
+                                               chunksize, sample_fraction):
+            yield ulog_chunk
+        return
+
+    shard_file = ByteRangeFile(ulogs_csv_path, *byte_range)
+    if sample_fraction is not None:
+        shard_file = SampledCsvFile(shard_file, sample_fraction, has_header=False)
+    try:
+        for ulog_chunk in iter_csv_with_schema(shard_file, USER_LOGS_SCHEMA, usecols, chunksize,
+                                               header=None, names=read_csv_header(ulogs_csv_path)):
+            yield ulog_chunk
+    finally:
+        shard_file.close()
+
+
+@profiled()
+def aggregate_ulog_chunks(accumulator, ulogs_csv_path, chunksize=ULOG_CHUNK_SIZE,
+                          byte_range=None, sample_fraction=None):
+    num_rows = 0
+    for ulog_chunk in iter_ulog_chunks(ulogs_csv_path, chunksize=chunksize,
+                                       byte_range=byte_range, sample_fraction=sample_fraction):
+        accumulator.update(ulog_chunk)
+        num_rows += len(ulog_chunk)
+        print("Aggregated {} user log rows so far...".format(num_rows))
+    annotate(rows_in=num_rows)
+    return accumulator
+
+
+# Set in each pool worker by `_init_ulog_worker`, so the msnos are only pickled once per worker
+# instead of once per shard.
+_worker_msnos = None
+
+
+def _init_ulog_worker(msnos):
+    global _worker_msnos
+    _worker_msnos = msnos
+
+
+def _aggregate_ulog_shard(shard_args):
+    ulogs_csv_path, byte_range, chunksize, sample_fraction = shard_args
+    accumulator = UlogAccumulator(_worker_msnos)
+    return aggregate_ulog_chunks(
+        accumulator, ulogs_csv_path, chunksize, byte_range, sample_fraction,
+    )
+
+
+@profiled()
+def build_ulog_features_df(labels_csv_path, ulogs_csv_path=ULOGS_CSV_PATH,
+                           chunksize=ULOG_CHUNK_SIZE, num_workers=1, sample_fraction=None):
+    """Aggregate the user logs of every msno in `labels_csv_path` in one pass over the logs.
+
+    Args:
+        labels_csv_path - CSV whose 'msno' column defines the users to aggregate (train_v2.csv).
+        ulogs_csv_path - The raw user logs.
+        chunksize - Number of log rows read into memory at a time (per worker).
+        num_workers - With more than one worker, the logs are split into that many byte-range shards
+                      that are reduced in a process pool and merged afterwards.
+        sample_fraction - Only aggregate the users in this sample of them.
+
+    Returns:
+        A DataFrame with 'msno' and the `NUMERICAL_AGG_*` feature columns.
+    """
+    msnos = read_label_msnos(labels_csv_path, sample_fraction)
+    accumulator = UlogAccumulator(msnos)
+    print("Aggregating {} for {} users...".format(ulogs_csv_path, len(accumulator.msno_index)))
+    if num_workers <= 1:
+        aggregate_ulog_chunks(accumulator, ulogs_csv_path, chunksize, None, sample_fraction)
+    else:
+        shards = find_shard_offsets(ulogs_csv_path, num_workers)
+        shard_args = [
+            (ulogs_csv_path, byte_range, chunksize, sample_fraction) for byte_range in shards
+        ]
+        msnos = accumulator.msno_index.values
+        pool = multiprocessing.Pool(num_workers, initializer=_init_ulog_worker, initargs=(msnos,))
+        try:
+            # Merged in shard order, not completion order, so the float sums are reproducible.
+            for partial in pool.imap(_aggregate_ulog_shard, shard_args):
+                accumulator.merge(partial)
+        finally:
+            pool.close()
+            pool.join()
+    print("Finished aggregating {}".format(ulogs_csv_path))
+    return accumulator.to_df()
+
+
+def to_day_numbers(dates):
+    """Convert '%Y%m%d' integer (or already parsed datetime64) dates to days since the epoch."""
+    days = parse_yyyymmdd(pd.Series(np.asarray(dates)))
+    return days.values.astype('datetime64[D]').astype(np.int64)
+
+
+@profiled()
+def read_last_ulog_day(ulogs_csv_path, chunksize=ULOG_CHUNK_SIZE):
+    """The last day in the user logs, in days since the epoch, over every user's rows.
+
+    Sampled reads only see the rows of the sampled users, so they take the end of the windows from
+    here instead. Reading just the dates is still a full pass, so the answer is cached per version
+    of the file.
+    """
+    cache_path = CACHE_BACKEND.path(
+        ULOG_LAST_DAY_CACHE, fingerprint(file_fingerprint(ulogs_csv_path)),
+    )
+    if os.path.isfile(cache_path):
+        return int(read_cache_entry(cache_path)['last_day'].iloc[0])
+
+    last_day = None
+    for date_chunk in iter_csv_with_schema(ulogs_csv_path, USER_LOGS_SCHEMA, ['date'], chunksize):
+        if len(date_chunk):
+            chunk_last_day = int(to_day_numbers(date_chunk['date'].values).max())
+            last_day = chunk_last_day if last_day is None else max(last_day, chunk_last_day)
+    if last_day is None:
+        raise ValueError("{} has no user log rows".format(ulogs_csv_path))
+    write_cache_entry(pd.DataFrame({'last_day': [last_day]}), ULOG_LAST_DAY_CACHE, cache_path)
+    return last_day
+
+
+@profiled()
+def read_recent_ulog_rows(msno_index, ulogs_csv_path, max_window, end_day=None,
+                          chunksize=ULOG_CHUNK_SIZE, sample_fraction=None):
+    """Read the log rows of the users in `msno_index` from the last `max_window` days.
+
+    Args:
+        msno_index - The users to keep rows of, as a pandas Index of msnos.
+        ulogs_csv_path - The raw user logs.
+        max_window - How many days back from `end_day` (inclusive) to keep.
+        end_day - The last day of the windows, in days since the epoch. By default the last day
+                  in the logs, in which case rows are kept against the latest day seen so far and
+                  filtered once more at the end. With `sample_fraction`, it's the last day over
+                  every user's rows (see `read_last_ulog_day`), not just the sampled users'.
+        chunksize - Number of log rows read into memory at a time.
+        sample_fraction - Skip the rows of the users outside this sample while reading.
+
+    Returns:
+        A (user codes into `msno_index`, days, `ULOG_AGG_COLS` values, end day) tuple.
+    """
+    if end_day is None and sample_fraction is not None:
+        end_day = read_last_ulog_day(ulogs_csv_path, chunksize)
+    latest_day = -np.inf if end_day is None else end_day
+    kept = []
+    num_rows = 0
+    for ulog_chunk in iter_csv_with_schema(ulogs_csv_path, USER_LOGS_SCHEMA,
+                                           ['msno', 'date'] + ULOG_AGG_COLS, chunksize,
+                                           sample_fraction):
+        codes = msno_index.get_indexer(ulog_chunk['msno'])
+        days = to_day_numbers(ulog_chunk['date'].values)
+        if end_day is None and len(days):
+            latest_day = max(latest_day, days.max())
+        keep = (codes >= 0) & (days > latest_day - max_window) & (days <= latest_day)
+        kept.append((
+            codes[keep], days[keep], ulog_chunk[ULOG_AGG_COLS].values[keep].astype(np.float64),
+        ))
+        num_rows += len(ulog_chunk)
+        print("Read {} user log rows so far...".format(num_rows))
+
+    codes = np.concatenate([chunk_codes for chunk_codes, _, _ in kept])
+    days = np.concatenate([chunk_days for _, chunk_days, _ in kept])
+    values = np.vstack([chunk_values for _, _, chunk_values in kept])
+    keep = days > latest_day - max_window
+    annotate(rows_in=num_rows, rows_out=int(keep.sum()))
+    return codes[keep], days[keep], values[keep], latest_day
+
+
+@profiled()
+def aggregate_trailing_windows(msnos, codes, days, values, end_day, windows=ULOG_WINDOWS):
+    """Sum and average `values` over each user's trailing windows, with one sort and one cumsum.
+
+    Args:
+        msnos - The msno of each user code.
+        codes - The user code of every log row.
+        days - The day of every log row, in days since the epoch, at most `end_day`.
+        values - The `ULOG_AGG_COLS` values of every log row.
+        end_day - The last day of every window.
+        windows - Window lengths in days.
+
+    Returns:
+        A DataFrame like `build_windowed_ulog_features_df` returns, for the users with any rows.
+    """
+    # Sorted by (user, day), each user's window is a run of rows that ends at the user's last row.
+    order = np.lexsort((days, codes))
+    codes = codes[order]
+    days = days[order]
+    cumulative = np.zeros((len(codes) + 1, len(ULOG_AGG_COLS)))
+    np.cumsum(values[order], axis=0, out=cumulative[1:])
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]) if len(codes) else codes
+    users = codes[starts]
+    ends = np.r_[starts[1:], len(codes)].astype(np.int64)
+    # (user, day) as one sortable int64, so a single searchsorted finds every window's first row.
+    keys = codes.astype(np.int64) * (1 << 32) + (days - end_day)
+
+    day_cols, sum_cols, avg_cols = window_feature_names(windows)
+    num_cols = len(ULOG_AGG_COLS)
+    window_cols = {'msno': np.asarray(msnos)[users]}
+    for i, window in enumerate(windows):
+        firsts = np.searchsorted(keys, users.astype(np.int64) * (1 << 32) + (1 - window))
+        num_days = ends - firsts
+        sums = cumulative[ends] - cumulative[firsts]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            avgs = sums / num_days[:, np.newaxis]
+        window_cols[day_cols[i]] = num_days
+        for j in range(num_cols):
+            window_cols[sum_cols[i * num_cols + j]] = sums[:, j]
+            window_cols[avg_cols[i * num_cols + j]] = avgs[:, j]
+    return pd.DataFrame(window_cols, columns=['msno'] + day_cols + sum_cols + avg_cols)
+
+
+@profiled()
+def build_windowed_ulog_features_df(labels_csv_path, ulogs_csv_path=ULOGS_CSV_PATH,
+                                    windows=ULOG_WINDOWS, end_date=None,
+                                    chunksize=ULOG_CHUNK_SIZE, sample_fraction=None):
+    """Aggregate each user's logs over trailing windows ending at `end_date`, in one sweep.
+
+    Args:
+        labels_csv_path - CSV whose 'msno' column defines the users to aggregate (train_v2.csv).
+        ulogs_csv_path - The raw user logs.
+        windows - Window lengths in days. Only the `ULOG_WINDOWS` features are in 'features.py'.
+        end_date - The last day of every window, as a '%Y%m%d' int. Defaults to the last day in
+                   the logs.
+        chunksize - Number of log rows read into memory at a time.
+        sample_fraction - Only aggregate the users in this sample of them.
+
+    Returns:
+        A DataFrame with 'msno' and, per window, the number of log rows ('num_days_<w>d', as
+        there's a row per user and day) and the sum and average of every `ULOG_AGG_COLS` column.
+        Only users with logs in the longest window have a row; averages over empty windows are NaN.
+    """
+    msno_index = pd.Index(read_label_msnos(labels_csv_path, sample_fraction))
+    if not msno_index.is_unique:
+        msno_index = msno_index.drop_duplicates()
+    end_day = None if end_date is None else to_day_numbers([end_date])[0]
+    print("Reading the last {} days of {} for {} users...".format(
+        max(windows), ulogs_csv_path, len(msno_index),
+    ))
+    codes, days, values, end_day = read_recent_ulog_rows(
+        msno_index, ulogs_csv_path, max(windows), end_day, chunksize, sample_fraction,
+    )
+
+    window_df = aggregate_trailing_windows(
+        msno_index.values, codes, days, values, end_day, windows,
+    )
+    print("Finished aggregating the trailing windows of {}".format(ulogs_csv_path))
+    return window_df
+
+
+@profiled()
+def get_or_build_ulog_features_df(validation=False, force_build=False,
+                                  ulogs_csv_path=ULOGS_CSV_PATH, num_workers=1,
+                                  windows=ULOG_WINDOWS, sample_fraction=None):
+    if not validation:
+        labels_csv_path = TRAIN_CSV_PATH
+        ulog_path = TRAIN_ULOG_PATH
+    else:
+        labels_csv_path = VALIDATION_CSV_PATH
+        ulog_path = VALIDATION_ULOG_PATH
+    ulog_path = sampled_path(ulog_path, sample_fraction)
+    if os.path.isfile(ulog_path) and not force_build:
+        annotate(cache_hit=True)
+        return pd.read_csv(ulog_path)
+
+    ulog_df = build_ulog_features_df(
+        labels_csv_path, ulogs_csv_path, num_workers=num_workers, sample_fraction=sample_fraction,
+    )
+    if windows:
+        window_df = build_windowed_ulog_features_df(
+            labels_csv_path, ulogs_csv_path, windows, sample_fraction=sample_fraction,
+        )
+        ulog_df = pd.merge(ulog_df, window_df, how='left', on='msno')
+    ulog_df.to_csv(ulog_path, index=False)
+    print("All done writing to {}!".format(ulog_path))
+    return ulog_df
+
@@ -1,53 +1,183 @@
-import csv
 import glob
-import json
 import os
 
 import numpy as np
 import pandas as pd
 
+from cache import file_fingerprint, fingerprint, get_cache_backend, series_fingerprint
+from csv_tools import merge_csvs
 from features import (
     LABEL, NUMERICAL_AGG_AVG, NUMERICAL_AGG_MIN, NUMERICAL_AGG_MAX,
-    NUMERICAL_AGG_STDDEV, NUMERICAL_AGG_SUM, NUMERICAL_NON_ULOG, USER_CATEGORICAL,
+    NUMERICAL_AGG_STDDEV, NUMERICAL_AGG_SUM, NUMERICAL_NON_ULOG, NUMERICAL_WINDOW_AVG,
+    NUMERICAL_WINDOW_DAYS, NUMERICAL_WINDOW_SUM, USER_CATEGORICAL,
+)
+from msno_dictionary import (
+    MSNO_ID, encode_msno_column, get_msno_dictionary, left_join_on_msno_id, restore_msno_column,
+)
+from one_hot import SparseOneHotEncoder, build_sparse_feature_matrix
+from profiling import annotate, profiled
+from sampling import open_csv
+from schemas import (
+    LABELS_SCHEMA, MEMBERS_SCHEMA, TRANSACTIONS_SCHEMA, parse_yyyymmdd, read_csv_with_schema,
 )
 
+# Cached DataFrames are stored at these paths plus a fingerprint of their inputs and the extension
+# of the cache backend in use (see 'cache.py'), e.g. './data/members_df.0123456789abcdef.feather'.
 MEMBERS_CSV_PATH = './data/members_v3.csv'
-MEMBERS_DF_PICKLE = './data/members_df.pkl'
+MEMBERS_DF_CACHE = './data/members_df'
 TRAIN_CSV_PATH = './data/train_v2.csv'
-TRAIN_DF_PICKLE = './data/train_df.pkl'
-TRAIN_DF_PICKLE_VW = './data/train_df_vw.pkl'
+TRAIN_DF_CACHE = './data/train_df'
+TRAIN_DF_CACHE_VW = './data/train_df_vw'
 TRAIN_ULOG_PATH = './data/train_ulog_features.csv'
 VALIDATION_CSV_PATH = './data/sample_submission_v2.csv'
-VALIDATION_DF_PICKLE = './data/validation_df.pkl'
-VALIDATION_DF_PICKLE_VW = './data/validation_df_vw.pkl'
+VALIDATION_DF_CACHE = './data/validation_df'
+VALIDATION_DF_CACHE_VW = './data/validation_df_vw'
 VALIDATION_ULOG_PATH = './data/validation_ulog_features.csv'
 TRANSACTIONS_CSV_PATH = './data/transactions.csv'
-STATISTICS_DF_PICKLE = './data/statistics_df.pkl'
+STATISTICS_DF_CACHE = './data/statistics_df'
+ONE_HOT_VOCABULARY_PATH = './data/one_hot_vocabulary.json'
+
+CACHE_BACKEND = get_cache_backend()
+# Point WSDM_FEATURE_STATE at a state saved by 'incremental.py' (the transaction history plus every
+# daily delta folded in) to take the transaction statistics from it, instead of rescanning all of
+# 'transactions.csv' every time a delta arrives.
+STATISTICS_FEATURE_STATE_PATH = os.environ.get('WSDM_FEATURE_STATE') or None
+
+
+def sampled_path(path, sample_fraction):
+    """Where the output written to `path` goes when built for a sample of the users.
+
+    Sampled outputs get paths of their own, e.g. './data/members_df_sample0.01', so they never
+    overwrite, or prune the cache entries of, the ones built for all the users.
+    """
+    if sample_fraction is None:
+        return path
+    root, extension = os.path.splitext(path)
+    return '{}_sample{}{}'.format(root, sample_fraction, extension)
+
+
+def features_fingerprint():
+    return fingerprint(
+        LABEL, USER_CATEGORICAL, NUMERICAL_NON_ULOG, NUMERICAL_AGG_AVG, NUMERICAL_AGG_MIN,
+        NUMERICAL_AGG_MAX, NUMERICAL_AGG_STDDEV, NUMERICAL_AGG_SUM, NUMERICAL_WINDOW_DAYS,
+        NUMERICAL_WINDOW_SUM, NUMERICAL_WINDOW_AVG,
+    )
+
+
+def members_df_fingerprint(sample_fraction=None):
+    return fingerprint(
+        'members_df',
+        file_fingerprint(MEMBERS_CSV_PATH),
+        get_msno_dictionary().generation,
+        sample_fraction,
+    )
+
 
+def transactions_fingerprint():
+    """Fingerprint of what the statistics are built from: the feature state, or the transactions."""
+    if STATISTICS_FEATURE_STATE_PATH is not None:
+        return fingerprint('feature_state', file_fingerprint(STATISTICS_FEATURE_STATE_PATH))
+    return file_fingerprint(TRANSACTIONS_CSV_PATH)
 
-def compile_csv_parts_to_larger_csv(csv_parts_path, to_write_path):
+
+def statistics_df_fingerprint(left_df):
+    # The statistics only depend on which msnos are in 'left_df', not on its other columns.
+    return fingerprint(
+        'statistics_df',
+        transactions_fingerprint(),
+        series_fingerprint(left_df[MSNO_ID]),
+        get_msno_dictionary().generation,
+    )
+
+
+def training_or_validation_df_fingerprint(csv_path, ulog_path, validation, for_vw,
+                                          sample_fraction=None):
+    # The users in 'csv_path' determine the statistics_df fingerprint, so the transactions file
+    # stands in for that upstream stage here. The one-hot columns come from the saved vocabulary.
+    one_hot_vocabulary = None
+    if not for_vw:
+        one_hot_vocabulary = file_fingerprint(ONE_HOT_VOCABULARY_PATH, hash_contents=True)
+    return fingerprint(
+        'training_or_validation_df',
+        file_fingerprint(csv_path),
+        file_fingerprint(ulog_path),
+        transactions_fingerprint(),
+        members_df_fingerprint(sample_fraction),
+        features_fingerprint(),
+        validation,
+        for_vw,
+        one_hot_vocabulary,
+        sample_fraction,
+    )
+
+
+def write_cache_entry(df, base_path, cache_path):
+    annotate(cache_hit=False)
+    CACHE_BACKEND.write(df, cache_path)
+    CACHE_BACKEND.prune(base_path)
+
+
+def read_cache_entry(cache_path, columns=None):
+    annotate(cache_hit=True)
+    # Cached frames are keyed by 'msno_id', so asking for 'msno' means reading the id.
+    if columns is not None:
+        columns = [MSNO_ID if col == 'msno' else col for col in columns]
+    return CACHE_BACKEND.read(cache_path, columns=columns)
+
+
+@profiled()
+def compile_csv_parts_to_larger_csv(csv_parts_path, to_write_path, output_format='csv'):
+    """Combine the part files Spark writes for a DataFrame into a single file.
+
+    The header (and so the schema) comes from the first non-empty part, and every other part must
+    have exactly the same header. For CSV output, the part bodies are block-copied after the first
+    header without parsing any rows. With `output_format='parquet'`, each part is parsed once (with
+    pyarrow's multithreaded CSV reader) and appended to a single Parquet file as its own row group;
+    numeric columns are stored as float64, so parts where a column happens to be all-integer or
+    all-null still line up.
+    """
     glob_path = os.path.join(csv_parts_path, '*.csv')
-    # TODO: clean this up somehow
-    fieldnames = [
-        'avg(num_100)', 'sum(total_secs)', 'sum(num_50)', 'min(num_75)', 'avg(num_50)',
-        'avg(num_985)', 'min(total_secs)', 'min(num_985)', 'sum(num_25)', 'min(num_unq)',
-        'sum(num_100)', 'max(num_985)', 'min(num_50)', 'min(num_100)', 'min(num_25)',
-        'is_churn', 'sum(num_75)', 'avg(total_secs)', 'avg(num_25)', 'max(num_100)',
-        'max(num_75)', 'avg(num_unq)', 'max(total_secs)', 'msno', 'sum(num_985)',
-        'max(num_25)', 'avg(num_75)', 'sum(num_unq)', 'max(num_unq)', 'max(num_50)',
-        'stddev(num_25)', 'stddev(num_unq)', 'stddev(num_100)', 'stddev(num_50)',
-        'stddev(total_secs)', 'stddev(num_75)', 'stddev(num_985)',
-    ]
-    with open(to_write_path, 'w') as csv_to_write:
-        writer = csv.DictWriter(csv_to_write, fieldnames=fieldnames)
-        writer.writeheader()
-
-        for fname in glob.glob(glob_path):
-            print("Now processing file name {}...".format(fname))
-            with open(fname, 'r') as csv_file:
-                reader = csv.DictReader(csv_file)
-                for line in reader:
-                    writer.writerow(line)
+    # Spark names parts 'part-00000-...', so sorting keeps them in partition order. Spark also
+    # writes empty files for empty partitions, which have no header at all.
+    part_paths = [path for path in sorted(glob.glob(glob_path)) if os.path.getsize(path)]
+    if not part_paths:
+        raise ValueError("No non-empty CSV parts in {}".format(csv_parts_path))
+
+    print("Compiling {} parts from {}...".format(len(part_paths), csv_parts_path))
+    if output_format == 'csv':
+        # Checks the headers match, then appends each body with a kernel-side copy.
+        merge_csvs(part_paths, to_write_path)
+    elif output_format == 'parquet':
+        import pyarrow
+        from pyarrow import csv as pyarrow_csv, parquet
+
+        # pyarrow's CSV reader parses each part on multiple threads. The types are inferred from
+        # the first part and then pinned, with numbers widened to float64.
+        first_part_schema = pyarrow_csv.read_csv(part_paths[0]).schema
+        column_types = {}
+        for field in first_part_schema:
+            column_types[field.name] = field.type
+            if (pyarrow.types.is_integer(field.type) or pyarrow.types.is_floating(field.type) or
+                    pyarrow.types.is_null(field.type)):
+                column_types[field.name] = pyarrow.float64()
+        header = first_part_schema.names
+        convert_options = pyarrow_csv.ConvertOptions(column_types=column_types)
+        writer = None
+        try:
+            for fname in part_paths:
+                table = pyarrow_csv.read_csv(fname, convert_options=convert_options)
+                if table.schema.names != header:
+                    raise ValueError("Header of {} does not match {}: {} vs. {}".format(
+                        fname, part_paths[0], table.schema.names, header,
+                    ))
+                if writer is None:
+                    writer = parquet.ParquetWriter(to_write_path, table.schema)
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+    else:
+        raise ValueError("Unknown output format '{}'".format(output_format))
     print("Finished writing to {}!".format(to_write_path))
 
 
@@ -67,168 +197,335 @@ def return_column_as_category(uncategorized_column, null_category_val=np.nan):
     Returns:
         A Categorical pandas Series.
     """
-    categories = set(uncategorized_column.get_values())
-    if null_category_val != np.nan:
-        if np.nan in categories:
-            categories.remove(np.nan)
+    # Categories can't hold NaN; missing values are filled with `null_category_val` instead.
+    categories = set(value for value in uncategorized_column.unique() if not pd.isnull(value))
+    if not pd.isnull(null_category_val):
         categories.add(null_category_val)
 
-    categorized_column = uncategorized_column.astype(
-        'category',
-        categories=categories,
-    ).fillna(
-        null_category_val,
+    categorized_column = pd.Series(
+        pd.Categorical(uncategorized_column, categories=sorted(categories)),
+        index=uncategorized_column.index,
+        name=uncategorized_column.name,
     )
-    return categorized_column
-
+    if pd.isnull(null_category_val):
+        return categorized_column
+    return categorized_column.fillna(null_category_val)
 
-def get_or_build_members_df(force_build=False):
-    if os.path.isfile(MEMBERS_DF_PICKLE) and not force_build:
-        return pd.read_pickle(MEMBERS_DF_PICKLE)
 
-    print("Getting members_df...")
-    members_df = pd.read_csv(MEMBERS_CSV_PATH)
+def categorize_member_columns(members_df):
+    """Turn the categorical member columns into categoricals with a category for missing values."""
     members_df.gender = return_column_as_category(members_df.gender, 'not_specified')
     members_df.city = return_column_as_category(members_df.city, 0)
     members_df.registered_via = return_column_as_category(members_df.registered_via, 0)
+    return members_df
+
+
+@profiled()
+def get_or_build_members_df(force_build=False, columns=None, sample_fraction=None):
+    """Returns the members, keyed by 'msno_id' (see 'msno_dictionary.py').
+
+    With `sample_fraction`, only the members in that sample of the users (see 'sampling.py').
+    """
+    base_cache_path = sampled_path(MEMBERS_DF_CACHE, sample_fraction)
+    cache_path = CACHE_BACKEND.path(base_cache_path, members_df_fingerprint(sample_fraction))
+    if os.path.isfile(cache_path) and not force_build:
+        return read_cache_entry(cache_path, columns=columns)
+
+    print("Getting members_df...")
+    members_df = encode_msno_column(read_csv_with_schema(
+        MEMBERS_CSV_PATH, MEMBERS_SCHEMA, sample_fraction=sample_fraction,
+    ))
+    members_df = categorize_member_columns(members_df)
     print("Done getting members_df")
 
-    members_df.to_pickle(MEMBERS_DF_PICKLE)
+    write_cache_entry(members_df, base_cache_path, cache_path)
+    if columns is not None:
+        members_df = members_df[[MSNO_ID if col == 'msno' else col for col in columns]]
     return members_df
 
 
-def get_or_build_statistics_df(left_df, force_build=False):
+STATISTICS_COLUMNS = [
+    'num_transactions', 'plan_net_worth', 'mean_payment', 'total_payments',
+    'times_canceled', 'num_discounts', 'total_discount', 'mean_membership_duration',
+    'total_membership_duration', 'mean_amt_per_day', 'total_amt_per_day',
+]
+
+
+def build_transaction_features_df(df_transactions, key=MSNO_ID):
+    """Derive the per-transaction columns that `build_statistics_df` aggregates per user."""
+    transaction_date = parse_yyyymmdd(df_transactions.transaction_date)
+    membership_expire_date = parse_yyyymmdd(df_transactions.membership_expire_date)
+    # Prices are read as unsigned ints, so widen before subtracting.
+    discount = (
+        df_transactions.plan_list_price.astype(np.float64) - df_transactions.actual_amount_paid
+    )
+    return pd.DataFrame({
+        key: df_transactions[key],
+        'plan_list_price': df_transactions.plan_list_price,
+        'actual_amount_paid': df_transactions.actual_amount_paid,
+        'is_cancel': (df_transactions.is_cancel == 1).astype(np.int64),
+        'is_discount': (discount > 0).astype(np.int64),
+        'discount': discount,
+        # Left as float so users without transactions get NaN rather than failing the cast.
+        'membership_duration': (
+            (membership_expire_date - transaction_date) / np.timedelta64(1, 'D')
+        ),
+        'amt_per_day': df_transactions.actual_amount_paid / df_transactions.payment_plan_days,
+    })
+
+
+@profiled()
+def build_statistics_df(df_transactions, key=MSNO_ID):
+    """Aggregate raw transaction rows into one row of statistics per user.
+
+    Everything is computed with column arithmetic and cythonized groupby reductions (count/sum/
+    mean), rather than Python lambdas evaluated per row or per group.
+
+    Args:
+        df_transactions - Rows of 'transactions.csv', possibly left-joined onto a set of msnos (in
+                          which case users without transactions have a single all-NaN row).
+        key - The column identifying users, 'msno_id' or 'msno'.
+
+    Returns:
+        A DataFrame with `key` and the `STATISTICS_COLUMNS`, one row per user.
+    """
+    annotate(rows_in=len(df_transactions))
+    features_df = build_transaction_features_df(df_transactions, key)
+
+    grouped = features_df.groupby(key)
+    sums = grouped.sum()
+    means = grouped[['actual_amount_paid', 'membership_duration', 'amt_per_day']].mean()
+    stats_df = pd.DataFrame({
+        # How many times an individual user showed up in 'df_transactions'
+        'num_transactions': grouped.size(),
+        'plan_net_worth': sums.plan_list_price,
+        'mean_payment': means.actual_amount_paid,
+        'total_payments': sums.actual_amount_paid,
+        'times_canceled': sums.is_cancel,
+        'num_discounts': sums.is_discount,
+        'total_discount': sums.discount,
+        'mean_membership_duration': means.membership_duration,
+        'total_membership_duration': sums.membership_duration,
+        'mean_amt_per_day': means.amt_per_day,
+        'total_amt_per_day': sums.amt_per_day,
+    })
+    stats_df.index.name = key
+    return stats_df.reset_index()[[key] + STATISTICS_COLUMNS]
+
+
+@profiled()
+def read_statistics_from_feature_state(msno_ids):
+    """The statistics of the users `msno_ids`, from the state at `STATISTICS_FEATURE_STATE_PATH`."""
+    # 'incremental.py' builds on this module, so it can only be imported once it's needed.
+    from incremental import FeatureState
+    print("Reading the statistics from {}...".format(STATISTICS_FEATURE_STATE_PATH))
+    return FeatureState.load(STATISTICS_FEATURE_STATE_PATH).statistics_df(msno_ids)
+
+
+@profiled()
+def get_or_build_statistics_df(left_df, force_build=False, columns=None, sample_fraction=None,
+                               base_cache_path=STATISTICS_DF_CACHE):
     """Builds valuable statistics from 'transactions.csv' to use as features
+
+    Both 'left_df' and the returned frame are keyed by 'msno_id'. If the users of 'left_df' are all
+    in a `sample_fraction` sample, passing it skips the transactions of everyone else while reading.
+    Only the two newest entries under `base_cache_path` are kept, which fits the train and
+    validation users; other populations of users should be cached under a base path of their own,
+    so they don't push those out. With `STATISTICS_FEATURE_STATE_PATH` set, the statistics are
+    computed from that feature state instead, without reading any transactions.
     """
-    if os.path.isfile(STATISTICS_DF_PICKLE) and not force_build:
-        return pd.read_pickle(STATISTICS_DF_PICKLE)
-
-    print("Reading and grouping transactions_df...")
-    df_transactions = pd.read_csv(TRANSACTIONS_CSV_PATH)
-    # Join here to get rid of those rows in df_transactions that do not appear in 'left_df'.
-    df_transactions = pd.merge(left_df, df_transactions, how='left', on='msno')
-    # Add some new features to df_transactions
-    df_transactions['discount'] = (
-        df_transactions['plan_list_price'] - df_transactions['actual_amount_paid']
+    annotate(rows_in=len(left_df))
+    base_cache_path = sampled_path(base_cache_path, sample_fraction)
+    cache_path = CACHE_BACKEND.path(base_cache_path, statistics_df_fingerprint(left_df))
+    if os.path.isfile(cache_path) and not force_build:
+        return read_cache_entry(cache_path, columns=columns)
+
+    if STATISTICS_FEATURE_STATE_PATH is not None:
+        stats_df = read_statistics_from_feature_state(left_df[MSNO_ID].values)
+        write_cache_entry(stats_df, base_cache_path, cache_path)
+        if columns is not None:
+            stats_df = stats_df[[MSNO_ID if col == 'msno' else col for col in columns]]
+        return stats_df
+
+    print("Reading transactions_df...")
+    df_transactions = read_csv_with_schema(
+        TRANSACTIONS_CSV_PATH, TRANSACTIONS_SCHEMA, sample_fraction=sample_fraction,
     )
-    df_transactions['is_discount'] = df_transactions.discount.apply(lambda x: 1 if x > 0 else 0)
-    df_transactions['amt_per_day'] = (
-        df_transactions['actual_amount_paid'] / df_transactions['payment_plan_days']
-    )
-    date_cols = ['transaction_date', 'membership_expire_date']
-    for col in date_cols:
-        df_transactions[col] = pd.to_datetime(df_transactions[col], format='%Y%m%d')
-    df_transactions['membership_duration'] = (
-        df_transactions.membership_expire_date - df_transactions.transaction_date
-    )
-    df_transactions['membership_duration'] = (
-        df_transactions['membership_duration'] / np.timedelta64(1, 'D')
-    )
-    df_transactions['membership_duration'] = df_transactions['membership_duration'].astype(int)
-
-    grouped_transactions = df_transactions.groupby('msno')
-    print("Finished reading and grouping df_transactions")
+    # Users that only appear in the transactions get id -1 and are dropped by the join below, so
+    # they don't need a place in the dictionary.
+    df_transactions = encode_msno_column(df_transactions, add_missing=False)
+    # Join here to get rid of those rows in df_transactions that do not appear in 'left_df'. Only
+    # the msnos matter for the statistics, so don't drag the rest of 'left_df' through the merge.
+    df_transactions = pd.merge(left_df[[MSNO_ID]], df_transactions, how='left', on=MSNO_ID)
+    print("Finished reading transactions_df")
 
     print("Preparing statistics DataFrame from df_transactions...")
-    stats_df = grouped_transactions.agg({
-        # How many times an individual 'msno' showed up in 'df_transactions'
-        'msno': {'num_transactions': 'count'},
-        'plan_list_price': {'plan_net_worth': 'sum'},
-        'actual_amount_paid': {
-            'mean_payment': 'mean',
-            'total_payments': 'sum',
-        },
-        'is_cancel': {
-            'times_canceled': lambda x: sum(x == 1)
-        },
-        'is_discount': {
-            'num_discounts': lambda x: sum(x == 1)
-        },
-        'discount': {
-            'total_discount': 'sum'
-        },
-        'membership_duration': {
-            'mean_membership_duration': 'mean',
-            'total_membership_duration': 'sum',
-        },
-        'amt_per_day': {
-            'mean_amt_per_day': 'mean',
-            'total_amt_per_day': 'sum',
-        },
-    })
-    stats_df.columns = stats_df.columns.droplevel(0)
-    stats_df.reset_index(inplace=True)
+    stats_df = build_statistics_df(df_transactions)
     print("Finished preparing statistics DataFrame")
 
-    stats_df.to_pickle(STATISTICS_DF_PICKLE)
+    write_cache_entry(stats_df, base_cache_path, cache_path)
+    if columns is not None:
+        stats_df = stats_df[[MSNO_ID if col == 'msno' else col for col in columns]]
     return stats_df
 
 
-def get_or_build_training_or_validation_df(validation=False, force_build=False, for_vw=False):
-    if not validation:
-        csv_path = TRAIN_CSV_PATH
-        if not for_vw:
-            pickle_path = TRAIN_DF_PICKLE
-        else:
-            pickle_path = TRAIN_DF_PICKLE_VW
-    else:
-        csv_path = VALIDATION_CSV_PATH
-        if not for_vw:
-            pickle_path = VALIDATION_DF_PICKLE
-        else:
-            pickle_path = VALIDATION_DF_PICKLE_VW
-    if os.path.isfile(pickle_path) and not force_build:
-        return pd.read_pickle(pickle_path)
-
-    df = pd.read_csv(csv_path)
+def read_labels_df(validation=False, sample_fraction=None):
+    """Read the train (or validation) users, keyed by 'msno_id'. Validation has no 'is_churn'."""
+    csv_path = VALIDATION_CSV_PATH if validation else TRAIN_CSV_PATH
+    df = encode_msno_column(read_csv_with_schema(
+        csv_path, LABELS_SCHEMA, sample_fraction=sample_fraction,
+    ))
     if validation:
         df.drop('is_churn', axis=1, inplace=True)
-    members_df = get_or_build_members_df(force_build=force_build)
-
-    print("Merging with members_df...")
-    df = pd.merge(df, members_df, how='left', on='msno')
-    del members_df
-    df.gender.fillna('not_specified', inplace=True)
-    df.city.fillna(0, inplace=True)
-    df.registered_via.fillna(0, inplace=True)
-    df.bd = df.bd.clip(0, 100)
-    df.bd.fillna(0., inplace=True)
+    return df
+
+
+def read_ulog_features_df(ulog_path, sample_fraction=None):
+    """Read compiled user log features, keyed by 'msno_id' and limited to msnos we know about."""
+    with open_csv(ulog_path, sample_fraction) as csv_source:
+        ulog_df = encode_msno_column(pd.read_csv(csv_source), add_missing=False)
+    return ulog_df[ulog_df[MSNO_ID] >= 0]
+
+
+@profiled()
+def join_member_features(df, members_df):
+    """Join the members' features onto the users in `df`, filling in users with no member row."""
+    df = left_join_on_msno_id(df, members_df)
+    df['gender'] = df.gender.fillna('not_specified')
+    df['city'] = df.city.fillna(0)
+    df['registered_via'] = df.registered_via.fillna(0)
+    df['bd'] = df.bd.clip(0, 100).fillna(0.)
+    return df
+
+
+@profiled()
+def get_or_fit_one_hot_encoder(force_build=False):
+    """Return the one-hot encoder for the categorical member columns, fit on the training users.
+
+    The vocabulary is saved to `ONE_HOT_VOCABULARY_PATH` and reused from there, so train and
+    validation frames always get the same one-hot columns, in the same order.
+    """
+    if os.path.isfile(ONE_HOT_VOCABULARY_PATH) and not force_build:
+        return SparseOneHotEncoder.load(ONE_HOT_VOCABULARY_PATH)
+
+    print("Fitting the one-hot encoder on the training users...")
+    df = join_member_features(read_labels_df(validation=False), get_or_build_members_df())
+    encoder = SparseOneHotEncoder(USER_CATEGORICAL).fit(df)
+    encoder.save(ONE_HOT_VOCABULARY_PATH)
+    print("Finished fitting the one-hot encoder")
+    return encoder
+
+
+@profiled()
+def join_training_features(df, members_df, stats_df, ulog_df, for_vw=False, encoder=None):
+    """Join the members, statistics and user log features onto the users in `df`.
+
+    All frames are keyed by 'msno_id'. This works on any subset of the users just as well as on all
+    of them, which is what lets `vw_export.iter_vw_example_batches` build the features a chunk of
+    users at a time. Without `for_vw`, the categorical columns are one-hot encoded with `encoder`
+    (by default the one from `get_or_fit_one_hot_encoder`).
+    """
+    annotate(rows_in=len(df))
+    df = join_member_features(df, members_df)
     if not for_vw:
         # If we *are* preparing a DataFrame for VowpalWabbit, we do not want to one-hot encode the
         # categorical variables, as that happens in VowPalWabbit via the hashing trick.
-        df = pd.concat(
-            [df, pd.get_dummies(df.gender)],
-            axis=1,
-        ).drop('gender', axis=1)
-        df = pd.concat(
-            [df, pd.get_dummies(df.city, prefix='city')],
-            axis=1,
-        ).drop('city', axis=1)
-        df = pd.concat(
-            [df, pd.get_dummies(df.registered_via, prefix='registered_via')],
-            axis=1,
-        ).drop('registered_via', axis=1)
-
-    print("Finished merging with members_df")
-
-    stats_df = get_or_build_statistics_df(df, force_build=force_build)
-
-    print("Merging with stats_df...")
-    df = pd.merge(df, stats_df, how='left', on='msno')
-    del stats_df
-    print("Finished merging with stats_df")
-
-    ulog_path = TRAIN_ULOG_PATH if not validation else VALIDATION_ULOG_PATH
-    ulog_df = pd.read_csv(ulog_path)
-    print("Merging with compiled user log data...")
-    df = pd.merge(df, ulog_df, how='left', on='msno')
+        if encoder is None:
+            encoder = get_or_fit_one_hot_encoder()
+        one_hot_df = pd.DataFrame(
+            encoder.transform(df).toarray().astype(np.uint8),
+            index=df.index,
+            columns=encoder.feature_names,
+        )
+        df = pd.concat([df.drop(encoder.columns, axis=1), one_hot_df], axis=1)
+
+    df = left_join_on_msno_id(df, stats_df)
+    df = left_join_on_msno_id(df, ulog_df)
     df.drop(['registration_init_time'], axis=1, inplace=True)
     na_cols = df.columns[df.isnull().any()].tolist()
     df[na_cols] = df[na_cols].fillna(0.)
-
-    df.to_pickle(pickle_path)
     return df
 
+
+@profiled()
+def get_training_or_validation_matrix(validation=False, force_build=False, sample_fraction=None):
+    """Return the train (or validation) features as a CSR matrix, for xgboost or sklearn.
+
+    The matrix is built from the `for_vw` frame, which keeps the raw categorical columns, with
+    those columns one-hot encoded as a sparse block (see `one_hot.build_sparse_feature_matrix`).
+
+    Returns:
+        A (matrix, labels, msnos, feature names) tuple. The labels are None for validation.
+    """
+    df = get_or_build_training_or_validation_df(
+        validation, force_build, for_vw=True, sample_fraction=sample_fraction,
+    )
+    matrix, feature_names = build_sparse_feature_matrix(df, get_or_fit_one_hot_encoder())
+    labels = df[LABEL].values if LABEL in df.columns else None
+    return matrix, labels, df.msno.values, feature_names
+
+
+@profiled()
+def get_or_build_training_or_validation_df(validation=False, force_build=False, for_vw=False,
+                                           columns=None, sample_fraction=None):
+    """Builds the full feature frame for the train or validation users.
+
+    Every stage (members, statistics and this frame) is cached under a fingerprint of its own
+    inputs, so only the stages whose inputs changed get rebuilt. `force_build` rebuilds this frame
+    even if its inputs are unchanged, but leaves the upstream stages to their own fingerprints.
+
+    With `sample_fraction` (say 0.01), the frame only has the users in that sample (see
+    'sampling.py'), and every input is filtered down to them while it's read. The user log
+    features come from `ulog_features.get_or_build_ulog_features_df` run with the same
+    `sample_fraction` if that's been done, else from the full file. The one-hot vocabulary is
+    always fit on all the train users, so sampled frames have the same columns.
+
+    All the joins and the cache are keyed by 'msno_id'; the returned frame has the 'msno' strings.
+    """
+    if not validation:
+        csv_path = TRAIN_CSV_PATH
+        ulog_path = TRAIN_ULOG_PATH
+        if not for_vw:
+            base_cache_path = TRAIN_DF_CACHE
+        else:
+            base_cache_path = TRAIN_DF_CACHE_VW
+    else:
+        csv_path = VALIDATION_CSV_PATH
+        ulog_path = VALIDATION_ULOG_PATH
+        if not for_vw:
+            base_cache_path = VALIDATION_DF_CACHE
+        else:
+            base_cache_path = VALIDATION_DF_CACHE_VW
+    base_cache_path = sampled_path(base_cache_path, sample_fraction)
+    if os.path.isfile(sampled_path(ulog_path, sample_fraction)):
+        ulog_path = sampled_path(ulog_path, sample_fraction)
+    encoder = None
+    if not for_vw:
+        # The vocabulary is part of the fingerprint, so it has to exist before the lookup.
+        encoder = get_or_fit_one_hot_encoder()
+    cache_path = CACHE_BACKEND.path(
+        base_cache_path,
+        training_or_validation_df_fingerprint(
+            csv_path, ulog_path, validation, for_vw, sample_fraction,
+        ),
+    )
+    if os.path.isfile(cache_path) and not force_build:
+        return restore_msno_column(read_cache_entry(cache_path, columns=columns))
+
+    df = read_labels_df(validation, sample_fraction)
+    members_df = get_or_build_members_df(sample_fraction=sample_fraction)
+    stats_df = get_or_build_statistics_df(df, sample_fraction=sample_fraction)
+    ulog_df = read_ulog_features_df(ulog_path, sample_fraction)
+    print("Merging with members_df, stats_df and compiled user log data...")
+    df = join_training_features(df, members_df, stats_df, ulog_df, for_vw, encoder)
+    del members_df, stats_df, ulog_df
+    print("Finished merging")
+
+    write_cache_entry(df, base_cache_path, cache_path)
+    if columns is not None:
+        df = df[[MSNO_ID if col == 'msno' else col for col in columns]]
+    return restore_msno_column(df)
+
 ###
 ### UTILITIES FOR WORKING WITH VOWPAL WABBIT
 ###
@@ -266,13 +563,13 @@ def build_vw_json_obj_from_csv_dict(csv_dict):
 
 
 def write_vw_json_lines(csv_file_to_read, json_file_to_write):
-    with open(json_file_to_write, 'w') as json_file:
-        with open(csv_file_to_read, 'r') as csv_file:
-            reader = csv.DictReader(csv_file)
-            for i, row in enumerate(reader):
-                if i % 4000 == 0:
-                    print("Now processing line {} of {}...".format(i, csv_file_to_read))
-                json_obj = build_vw_json_obj_from_csv_dict(row)
-                json_file.write('{}\n'.format(json.dumps(json_obj)))
-    print("All done writing to {}!".format(json_file_to_write))
-    return
+    """Write a CSV of (for_vw) features as VW JSON lines; see `vw_export.write_vw_examples`.
+
+    The CSV is read and written out `vw_export.VW_CHUNK_SIZE` rows at a time, so it's never in
+    memory as a whole.
+    """
+    from vw_export import VW_CHUNK_SIZE, write_vw_examples
+    # Start from an empty file, in case the CSV doesn't have any rows.
+    open(json_file_to_write, 'wb').close()
+    for chunk in pd.read_csv(csv_file_to_read, chunksize=VW_CHUNK_SIZE):
+        write_vw_examples(chunk, json_file_to_write, output_format='json', append=True)
@@ -0,0 +1,339 @@
+"""Export the feature frames to Vowpal Wabbit input, in native text format or as JSON lines.
+
+`write_vw_json_lines` used to go through a `csv.DictReader` dict per row, look every key up in
+seven feature lists and `json.dumps` the result. Here the column -> namespace mapping is worked out
+once per frame, each namespace becomes part of one '%'-format template per line, and rows are
+formatted a chunk at a time from plain Python lists. Chunks can be formatted (and gzipped) in a
+process pool; gzip members can be concatenated, so the compressed chunks are simply appended to the
+output in order.
+
+Text lines look like
+
+    1 'msno |user_categorical city=13 gender=male |numerical_non_ulog plan_net_worth:149.0 ...
+
+and JSON lines hold the same namespaces as objects, with '_label' and '_tag' keys.
+
+For online learning, `iter_vw_example_batches` builds and formats the examples a batch of users at
+a time, so they can be piped into vw as they're produced instead of going through a file:
+
+    python vw_export.py | vw --loss_function logistic -f model.vw
+"""
+import argparse
+import collections
+import contextlib
+import gzip
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+from csv_tools import GZIP_COMPRESS_LEVEL
+from features import (
+    LABEL, NUMERICAL_AGG_AVG, NUMERICAL_AGG_MAX, NUMERICAL_AGG_MIN, NUMERICAL_AGG_STDDEV,
+    NUMERICAL_AGG_SUM, NUMERICAL_NON_ULOG, NUMERICAL_WINDOW_AVG, NUMERICAL_WINDOW_DAYS,
+    NUMERICAL_WINDOW_SUM, USER_CATEGORICAL,
+)
+from msno_dictionary import restore_msno_column
+from profiling import annotate, profiled
+from utils import (
+    TRAIN_ULOG_PATH, VALIDATION_ULOG_PATH, get_or_build_members_df, get_or_build_statistics_df,
+    get_or_build_training_or_validation_df, join_training_features, read_labels_df,
+    read_ulog_features_df,
+)
+
+VW_BINARY = 'vw'
+VW_CHUNK_SIZE = 100000
+# VW namespaces are told apart by their first character (e.g. for '-q' interactions), hence the
+# digits prepended to the ones that would clash.
+VW_NAMESPACES = [
+    ('user_categorical', USER_CATEGORICAL),
+    ('numerical_non_ulog', NUMERICAL_NON_ULOG),
+    ('avg_ulog', NUMERICAL_AGG_AVG),
+    ('min_ulog', NUMERICAL_AGG_MIN),
+    ('1max_ulog', NUMERICAL_AGG_MAX),
+    ('sum_ulog', NUMERICAL_AGG_SUM),
+    ('2stddev_ulog', NUMERICAL_AGG_STDDEV),
+    ('window_ulog', NUMERICAL_WINDOW_DAYS + NUMERICAL_WINDOW_SUM + NUMERICAL_WINDOW_AVG),
+]
+VW_COLUMN_NAMESPACES = dict(
+    (col, namespace) for namespace, cols in VW_NAMESPACES for col in cols
+)
+VW_OUTPUT_FORMATS = ['text', 'json']
+# VW keeps feature values as float32, and 9 significant digits round-trip any float32. It's also
+# about twice as fast to format as the shortest repr of the float64.
+VW_FLOAT_FORMAT = '%.9g'
+
+
+def _vw_safe(value):
+    # Spaces, ':' and '|' are separators in the text format.
+    return str(value).replace(' ', '_').replace(':', '_').replace('|', '_')
+
+
+def _format_category(value, output_format):
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if output_format == 'text':
+        return _vw_safe(value)
+    return json.dumps(str(value))
+
+
+def build_vw_line_template(columns, output_format='text', labelled=True, tagged=True):
+    """Return a '%'-format template for one line, and the columns it takes values from, in order.
+
+    Categorical columns are filled in with preformatted strings (see `prepare_vw_chunk`) and
+    numerical ones with floats, formatted with `VW_FLOAT_FORMAT`. Columns that aren't in
+    `VW_COLUMN_NAMESPACES` are left out.
+    """
+    value_cols = []
+    if output_format == 'text':
+        template = '%d' if labelled else ''
+        if tagged:
+            template += " '%s"
+        for namespace, namespace_cols in VW_NAMESPACES:
+            namespace_cols = [col for col in namespace_cols if col in columns]
+            if not namespace_cols:
+                continue
+            template += ' |' + namespace
+            for col in namespace_cols:
+                if namespace == 'user_categorical':
+                    template += ' {}=%s'.format(_vw_safe(col))
+                else:
+                    template += ' {}:{}'.format(_vw_safe(col), VW_FLOAT_FORMAT)
+            value_cols.extend(namespace_cols)
+        template = template.lstrip(' ')
+    elif output_format == 'json':
+        fields = []
+        if labelled:
+            fields.append('"_label": %d')
+        if tagged:
+            fields.append('"_tag": %s')
+        for namespace, namespace_cols in VW_NAMESPACES:
+            namespace_cols = [col for col in namespace_cols if col in columns]
+            value_format = '%s' if namespace == 'user_categorical' else VW_FLOAT_FORMAT
+            fields.append('{}: {{{}}}'.format(json.dumps(namespace), ', '.join(
+                '{}: {}'.format(json.dumps(col), value_format) for col in namespace_cols
+            )))
+            value_cols.extend(namespace_cols)
+        template = '{' + ', '.join(fields) + '}'
+    else:
+        raise ValueError("Unknown output format '{}', expected one of {}".format(
+            output_format, VW_OUTPUT_FORMATS,
+        ))
+    return template + '\n', value_cols
+
+
+def prepare_vw_chunk(df, value_cols, output_format='text', labelled=True, tagged=True):
+    """Turn a frame chunk into the columns of values `build_vw_line_template`'s template takes.
+
+    Returns a list of lists, one per template field, with labels mapped to -1/1 and categorical
+    values formatted through a per-column lookup of their unique values.
+    """
+    fields = []
+    if labelled:
+        fields.append(np.where(df[LABEL].values == 0, -1, 1).tolist())
+    if tagged:
+        tags = df['msno'].astype(str)
+        if output_format == 'json':
+            tags = tags.map(json.dumps)
+        fields.append(tags.tolist())
+    for col in value_cols:
+        if VW_COLUMN_NAMESPACES[col] == 'user_categorical':
+            column = df[col].astype(object)
+            formatted = dict(
+                (value, _format_category(value, output_format)) for value in column.unique()
+            )
+            fields.append(column.map(formatted).tolist())
+        else:
+            values = df[col].values.astype(np.float64)
+            if not np.isfinite(values).all():
+                raise ValueError("Column '{}' has NaN or infinite values".format(col))
+            fields.append(values.tolist())
+    return fields
+
+
+def format_vw_chunk(template, fields, compression=None):
+    """Format prepared columns into VW lines, as bytes, gzipped with `compression='gzip'`."""
+    lines = ''.join([template % row for row in zip(*fields)]).encode('utf-8')
+    if compression == 'gzip':
+        return gzip.compress(lines, compresslevel=GZIP_COMPRESS_LEVEL)
+    return lines
+
+
+def _format_vw_chunk_args(args):
+    chunk, template, value_cols, output_format, labelled, tagged, compression = args
+    fields = prepare_vw_chunk(chunk, value_cols, output_format, labelled, tagged)
+    return format_vw_chunk(template, fields, compression)
+
+
+def _imap_bounded(pool, fn, iterable, max_pending):
+    # Like 'pool.imap', which would prepare every chunk up front, but with at most `max_pending`
+    # prepared chunks in flight.
+    pending = collections.deque()
+    for args in iterable:
+        pending.append(pool.apply_async(fn, (args,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def iter_vw_chunks(df, output_format='text', chunksize=VW_CHUNK_SIZE, compression=None):
+    """Yield the arguments of `_format_vw_chunk_args` for each chunk of `df`.
+
+    The frame chunks themselves are handed over (rather than prepared values) so that the pool
+    workers do the preparation too, and only NumPy-backed columns have to be pickled.
+    """
+    labelled = LABEL in df.columns
+    tagged = 'msno' in df.columns
+    template, value_cols = build_vw_line_template(df.columns, output_format, labelled, tagged)
+    columns = ([LABEL] if labelled else []) + (['msno'] if tagged else []) + value_cols
+    for start in range(0, len(df), chunksize):
+        chunk = df.iloc[start:start + chunksize][columns]
+        yield (chunk, template, value_cols, output_format, labelled, tagged, compression)
+
+
+@profiled()
+def write_vw_examples(df, to_write_path, output_format='text', compression=None, num_workers=1,
+                      chunksize=VW_CHUNK_SIZE, append=False):
+    """Write every row of a feature frame as a VW example.
+
+    Args:
+        df - A frame like `get_or_build_training_or_validation_df(for_vw=True)` returns. Rows are
+             labelled -1/1 if it has an 'is_churn' column, and tagged with their 'msno' if it has
+             one.
+        to_write_path - Where to write the examples.
+        output_format - 'text' for VW's native format, 'json' for VW's '--json' input.
+        compression - None, or 'gzip' to write a gzipped file (read it with 'vw --compressed').
+        num_workers - With more than one worker, chunks are formatted and compressed in a process
+                      pool. Output order is always the row order of `df`.
+        chunksize - Number of rows formatted at a time.
+        append - Add the examples to the end of `to_write_path` instead of replacing it, to write a
+                 frame that's read a chunk at a time. Concatenated gzip files are a valid gzip file.
+    """
+    if compression not in (None, 'gzip'):
+        raise ValueError("Unknown compression '{}'".format(compression))
+    annotate(rows_in=len(df))
+    chunks = iter_vw_chunks(df, output_format, chunksize, compression)
+    if num_workers > 1:
+        pool = multiprocessing.Pool(num_workers)
+        formatted_chunks = _imap_bounded(pool, _format_vw_chunk_args, chunks, 2 * num_workers)
+    else:
+        pool = None
+        formatted_chunks = (_format_vw_chunk_args(args) for args in chunks)
+    num_rows = 0
+    try:
+        with open(to_write_path, 'ab' if append else 'wb') as vw_file:
+            for formatted_chunk in formatted_chunks:
+                vw_file.write(formatted_chunk)
+                num_rows = min(num_rows + chunksize, len(df))
+                print("Wrote {} of {} rows to {}...".format(num_rows, len(df), to_write_path))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    annotate(rows_out=num_rows, bytes_out=os.path.getsize(to_write_path))
+    print("All done writing to {}!".format(to_write_path))
+
+
+@profiled()
+def export_vw_examples(to_write_path, validation=False, output_format='text', compression=None,
+                       num_workers=1):
+    """Write the train (or validation) users' features to `to_write_path` as VW examples."""
+    df = get_or_build_training_or_validation_df(validation=validation, for_vw=True)
+    write_vw_examples(df, to_write_path, output_format, compression, num_workers)
+
+
+def iter_vw_example_batches(validation=False, output_format='text', batch_size=VW_CHUNK_SIZE):
+    """Lazily yield the train (or validation) users' VW examples, as bytes, `batch_size` at a time.
+
+    Unlike `export_vw_examples`, this never builds the full feature frame. The members, statistics
+    and user log features are loaded once (from their caches, when they're up to date), and then
+    each batch of users is joined against them, formatted and yielded. Memory is bounded by those
+    lookup frames plus one batch, and the first examples come out as soon as they're loaded.
+    """
+    labels_df = read_labels_df(validation)
+    members_df = get_or_build_members_df()
+    stats_df = get_or_build_statistics_df(labels_df)
+    ulog_df = read_ulog_features_df(VALIDATION_ULOG_PATH if validation else TRAIN_ULOG_PATH)
+    labelled = LABEL in labels_df.columns
+    template = None
+    for start in range(0, len(labels_df), batch_size):
+        df = join_training_features(
+            labels_df.iloc[start:start + batch_size], members_df, stats_df, ulog_df, for_vw=True,
+        )
+        df = restore_msno_column(df)
+        if template is None:
+            template, value_cols = build_vw_line_template(df.columns, output_format, labelled)
+        yield format_vw_chunk(
+            template, prepare_vw_chunk(df, value_cols, output_format, labelled),
+        )
+
+
+@profiled()
+def stream_vw_examples(out_file, validation=False, output_format='text', batch_size=VW_CHUNK_SIZE):
+    """Write lazily built VW examples to a binary file object, such as a pipe or named pipe."""
+    num_bytes = 0
+    for batch in iter_vw_example_batches(validation, output_format, batch_size):
+        out_file.write(batch)
+        num_bytes += len(batch)
+    out_file.flush()
+    annotate(bytes_out=num_bytes)
+
+
+def train_vw_on_stream(vw_args, validation=False, output_format='text', batch_size=VW_CHUNK_SIZE):
+    """Run `vw` and feed it the users' examples on stdin as they're built, without a file on disk.
+
+    Args:
+        vw_args - Command line arguments for vw, e.g. ['--loss_function', 'logistic', '-f',
+                  'model.vw']. '--json' is added for JSON examples.
+        validation, output_format, batch_size - As for `iter_vw_example_batches`.
+
+    Raises:
+        subprocess.CalledProcessError if vw exits with an error.
+    """
+    command = [VW_BINARY] + list(vw_args)
+    if output_format == 'json' and '--json' not in command:
+        command.append('--json')
+    vw_process = subprocess.Popen(command, stdin=subprocess.PIPE)
+    try:
+        stream_vw_examples(vw_process.stdin, validation, output_format, batch_size)
+    except BrokenPipeError:
+        # vw quit before reading everything; its return code says why.
+        pass
+    finally:
+        try:
+            vw_process.stdin.close()
+        except BrokenPipeError:
+            pass
+        returncode = vw_process.wait()
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, command)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Stream VW examples to stdout or a named pipe, e.g. "
+                    "'python vw_export.py | vw --loss_function logistic -f model.vw'",
+    )
+    parser.add_argument('--validation', action='store_true')
+    parser.add_argument('--format', choices=VW_OUTPUT_FORMATS, default='text')
+    parser.add_argument('--batch-size', type=int, default=VW_CHUNK_SIZE)
+    parser.add_argument('--output', default='-',
+                        help="Where to write the examples: '-' for stdout, or a (named pipe) path")
+    args = parser.parse_args()
+
+    stdout = sys.stdout.buffer
+    # Progress messages go to stderr, so they don't end up among the examples.
+    with contextlib.redirect_stdout(sys.stderr):
+        if args.output == '-':
+            stream_vw_examples(stdout, args.validation, args.format, args.batch_size)
+        else:
+            with open(args.output, 'wb') as out_file:
+                stream_vw_examples(out_file, args.validation, args.format, args.batch_size)
+
+
+if __name__ == '__main__':
+    main()